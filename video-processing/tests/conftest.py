@@ -0,0 +1,70 @@
+import multiprocessing as mp
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from video_processing.tensorflow import frame_analyzer
+from video_processing.tensorflow.inference_backends import InferenceBackend
+
+
+def pytest_addoption(parser):
+    parser.addoption("--run-benchmarks", action="store_true",
+                     help="Also run the tests that compare timings, which can fail on a loaded machine")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: compares timings, only run with --run-benchmarks")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="compares timings, only run with --run-benchmarks")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+class SquareBrightnessBackend(InferenceBackend):
+    """
+    Labels each square by how bright it is, which is quick and tells positions apart without the real weights
+    """
+
+    def predict(self, rows):
+        return (rows.mean(axis=1) / 255 * 40).astype(int) % 13
+
+
+@pytest.fixture
+def brightness_backend():
+    previous_backend = frame_analyzer._backend
+    frame_analyzer.set_backend(SquareBrightnessBackend())
+    yield
+    frame_analyzer._backend = previous_backend
+
+
+@pytest.fixture
+def forkserver():
+    """
+    Start processes the way the CLI does, so that anything that can't be sent to them fails like it would there
+    """
+    previous = mp.get_start_method(allow_none=True)
+    mp.set_start_method("forkserver", force=True)
+    yield
+    mp.set_start_method(previous, force=True)
+
+
+@pytest.fixture
+def scenes_video(tmp_path):
+    images = [cv2.resize(cv2.imread(str(Path(__file__).parent / "test_images" / f"{name}.png")), (640, 360))
+              for name in ["gothamchess_1", "gothamchess_2", "naroditsky_1"]]
+    # (image, number of frames), with positions that carry across the segment boundaries and a flicker
+    scenes = [(0, 75), (1, 45), (0, 5), (2, 90), (None, 30), (2, 45), (1, 10)]
+    video_path = tmp_path / "video.avi"
+    writer = cv2.VideoWriter(str(video_path), cv2.VideoWriter_fourcc(*"MJPG"), 30, (640, 360))
+    for image, n_frames in scenes:
+        for _ in range(n_frames):
+            writer.write(images[image] if image is not None else np.zeros_like(images[0]))
+    writer.release()
+    return video_path
@@ -1,16 +1,221 @@
-from PIL import Image
+import threading
+from pathlib import Path
 
-from video_processing.data_loading import YoutubeFrameSource
+import cv2
+import numpy as np
+import pytest
+
+from video_processing.data_loading import PROCESSING_FORMAT_POLICY, FileFrameSource, FormatPolicy, SeekAhead, \
+    YoutubeFrameSource
+from video_processing.metadata_cache import MetadataCache
 
 
 class TestYoutubeVideoLoading:
     def test_load_frames(self):
         test_video = "https://www.youtube.com/watch?v=k4T6TJGOSA0"
-        frame_source = YoutubeFrameSource(test_video)
+        frame_source = YoutubeFrameSource(test_video, resolution="480p")
 
         frame_source.stream_frames(stop_after_frames=1)
-        first_frame: Image.Image = frame_source.img_output_queue.get(timeout=3)
-        assert first_frame.height == 480
-        assert first_frame.width == 854
+        sec_into_video, first_frame = frame_source.img_output_queue.get(timeout=3)
+        assert sec_into_video == 0
+        assert first_frame.shape == (480, 854, 3)
+        assert frame_source.frame_shape == (480, 854)
         assert frame_source.fps == 30
         assert frame_source.video_id == "k4T6TJGOSA0"
+
+    def test_sampled_frames(self):
+        test_video = "https://www.youtube.com/watch?v=k4T6TJGOSA0"
+        frame_source = YoutubeFrameSource(test_video, sample_fps=5)
+        assert frame_source.frame_stride == 6
+
+        frame_source.stream_frames(stop_after_frames=12)
+        timestamps = [frame_source.img_output_queue.get(timeout=3)[0] for _ in range(2)]
+        assert timestamps == [0, 0.2]
+
+
+def test_grayscale_frames(tmp_path):
+    video_path = str(tmp_path / "gradient.avi")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (64, 48))
+    gradient = np.tile(np.linspace(0, 255, 64, dtype=np.uint8), (48, 1))
+    for i in range(3):
+        writer.write(np.dstack([gradient, np.roll(gradient, 16 * i, axis=1), 255 - gradient]))
+    writer.release()
+
+    rgb_source = FileFrameSource(video_path)
+    rgb_source.stream_frames()
+    gray_source = FileFrameSource(video_path, grayscale=True)
+    gray_source.stream_frames()
+    for _ in range(3):
+        _, rgb_frame = rgb_source.img_output_queue.get(timeout=3)
+        _, gray_frame = gray_source.img_output_queue.get(timeout=3)
+        assert gray_frame.shape == (48, 64)
+        assert gray_frame.dtype == np.uint8 and gray_frame.flags.c_contiguous
+        np.testing.assert_array_equal(gray_frame, cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2GRAY))
+        rgb_source.img_output_queue.release()
+        gray_source.img_output_queue.release()
+    assert gray_source.img_output_queue.get(timeout=3)[1] is None
+    rgb_source.img_output_queue.close()
+    gray_source.img_output_queue.close()
+
+
+def write_numbered_video(path, board_frames, n_frames):
+    """
+    Write a video whose frames have their frame number in binary across the top, and a white strip along the bottom
+      in the frames that count as having a board
+    """
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 30, (80, 48))
+    for i in range(n_frames):
+        frame = np.zeros((48, 80), dtype=np.uint8)
+        for bit in range(10):
+            frame[:16, bit * 8:(bit + 1) * 8] = 255 * ((i >> bit) & 1)
+        if i in board_frames:
+            frame[-16:] = 255
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+
+
+def read_frame_number(frame):
+    return sum(1 << bit for bit in range(10) if frame[:16, bit * 8:(bit + 1) * 8].mean() > 128)
+
+
+def test_sampled_frames_are_only_decoded_when_output(tmp_path, monkeypatch):
+    calls = {"grab": 0, "retrieve": 0}
+    VideoCapture = cv2.VideoCapture
+
+    class CountingCapture:
+        def __init__(self, source):
+            self._cap = VideoCapture(source)
+
+        def __getattr__(self, name):
+            return getattr(self._cap, name)
+
+        def grab(self):
+            calls["grab"] += 1
+            return self._cap.grab()
+
+        def retrieve(self, image=None):
+            calls["retrieve"] += 1
+            return self._cap.retrieve(image)
+
+        def read(self, image=None):
+            # The same as the real read, but through the counted calls
+            if not self.grab():
+                return False, None
+            return self.retrieve(image)
+
+    monkeypatch.setattr(cv2, "VideoCapture", CountingCapture)
+    video_path = tmp_path / "numbered.avi"
+    write_numbered_video(video_path, set(), 90)
+    frame_source = FileFrameSource(str(video_path), grayscale=True, sample_fps=5)
+    assert frame_source.frame_stride == 6
+
+    frame_source.stream_frames()
+    timestamps = []
+    while (item := frame_source.img_output_queue.get(timeout=3))[1] is not None:
+        sec_into_video, frame = item
+        timestamps.append(sec_into_video)
+        assert read_frame_number(frame) == (len(timestamps) - 1) * 6
+        frame_source.img_output_queue.release()
+    frame_source.img_output_queue.close()
+
+    assert timestamps == pytest.approx([i / 5 for i in range(15)])
+    # Every frame is demuxed, but only the sampled ones are decoded
+    assert calls["retrieve"] == 15
+    assert calls["grab"] >= 90
+
+
+def test_seek_ahead_skips_frames_without_a_board(tmp_path):
+    video_path = tmp_path / "numbered.avi"
+    board_frames = set(range(0, 60)) | set(range(660, 750))
+    write_numbered_video(video_path, board_frames, 900)
+
+    def has_board(frame):
+        probed.append(read_frame_number(frame))
+        return frame[-16:].mean() > 128
+
+    probed = []
+    seek_ahead = SeekAhead(has_board=has_board, min_empty_frames=30, initial_skip_sec=1, max_skip_sec=2,
+                           resolution_sec=.3)
+    frame_source = FileFrameSource(str(video_path), grayscale=True, seek_ahead=seek_ahead)
+    img_queue = frame_source.img_output_queue
+    streaming_thread = threading.Thread(target=frame_source.stream_frames)
+    streaming_thread.start()
+    frame_numbers = []
+    while (item := img_queue.get(timeout=3))[1] is not None:
+        sec_into_video, frame = item
+        frame_numbers.append(read_frame_number(frame))
+        # The timestamps must still line up with the frames after seeking
+        assert round(sec_into_video * 30) == frame_numbers[-1]
+        # Standing in for the board finder, which the frames go through anyway
+        frame_source.report_board(sec_into_video, frame[-16:].mean() > 128)
+        img_queue.release()
+    streaming_thread.join()
+    img_queue.close()
+
+    assert frame_numbers == sorted(frame_numbers)
+    assert board_frames <= set(frame_numbers)
+    # Each board is followed by `min_empty_frames` reported frames before skipping ahead, plus however many the decoder
+    # got ahead of the reports by, and the resume point is within `resolution_sec` of the board appearing
+    assert len(frame_numbers) <= len(board_frames) + 2 * (30 + img_queue.slots) + 9
+    # The source only looks for the board itself in the frames it seeks to
+    assert len(probed) < 30
+    assert not set(probed) & set(range(30, 60))
+
+
+def video_format(format_id, height, vcodec="avc1.4d401e", tbr=500, **kwargs):
+    return {"format_id": format_id, "height": height, "width": height * 16 // 9, "fps": 30, "vcodec": vcodec,
+            "tbr": tbr, "url": f"https://example.com/{format_id}", "protocol": "https", **kwargs}
+
+
+recorded_formats = [
+    {"format_id": "sb0", "ext": "mhtml", "vcodec": "none", "height": 90, "width": 160, "url": "https://example.com/sb",
+     "protocol": "mhtml"},
+    {"format_id": "140", "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2", "url": "https://example.com/140",
+     "protocol": "https"},
+    video_format("160", 144),
+    video_format("133", 240),
+    video_format("243", 360, vcodec="vp9"),
+    video_format("18", 360, tbr=700, acodec="mp4a.40.2"),
+    video_format("134", 360),
+    video_format("135", 480),
+    video_format("136", 720, protocol="http_dash_segments"),
+    video_format("399", 1080, vcodec="av01.0.08M.08"),
+]
+
+
+def test_format_policy_picks_the_cheapest_big_enough_format():
+    policy = FormatPolicy()
+    assert [fmt["format_id"] for fmt in policy.ranked(recorded_formats)] == ["160", "133", "134", "18", "243", "135",
+                                                                             "399"]
+    fmt = policy.select(recorded_formats)
+    assert fmt["format_id"] == "134"
+
+    # A board of 150px at 360p needs at least 480p to reach 200px
+    assert policy.upgrade(recorded_formats, fmt, 150)["format_id"] == "135"
+    assert policy.upgrade(recorded_formats, fmt, 50) is None
+    assert policy.upgrade(recorded_formats, fmt, None)["format_id"] == "135"
+    assert FormatPolicy(max_height=480).upgrade(recorded_formats, policy.upgrade(recorded_formats, fmt, None),
+                                                None) is None
+
+
+def write_board_video(path, size, board=True, n_frames=30):
+    board_img = cv2.resize(cv2.imread(str(Path(__file__).parent / "test_images" / "gothamchess_1.png")), size)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 30, size)
+    for _ in range(n_frames):
+        writer.write(board_img if board else np.full_like(board_img, 40))
+    writer.release()
+
+
+@pytest.mark.parametrize("board_at_480p, expected_format", [(True, "135"), (False, "134")])
+def test_format_falls_back_to_a_bigger_one_without_a_board(tmp_path, board_at_480p, expected_format):
+    # As if the board can't be made out at 360p
+    write_board_video(tmp_path / "360.avi", (640, 360), board=False)
+    write_board_video(tmp_path / "480.avi", (854, 480), board=board_at_480p)
+    info = {"id": "testvideo", "title": "Test video", "channel": "Test channel", "duration": 1,
+            "formats": [video_format("134", 360, url=str(tmp_path / "360.avi")),
+                        video_format("135", 480, url=str(tmp_path / "480.avi"))]}
+    metadata_cache = MetadataCache(tmp_path / "metadata", fetcher=lambda _: info)
+
+    frame_source = YoutubeFrameSource("https://www.youtube.com/watch?v=testvideo", metadata_cache=metadata_cache,
+                                      format_policy=PROCESSING_FORMAT_POLICY)
+    assert frame_source.stream_format["format_id"] == expected_format
@@ -48,6 +48,73 @@ class TestPersistence:
             assert all_processed_video_ids() == ['TsR154sQMVo']
 
 
+class TestPositionSightingWriter:
+    test_fen1 = "2kr3r/ppp2pp1/5n1p/4n1N1/2Pqp1b1/3P2P1/P1PQ1PBP/1RB2RK1"
+    test_fen2 = "8/1pq2ppk/r1p1nn1p/p1b1p3/P1N1P1BP/2P1B1P1/1P2QPK1/3R4"
+
+    @pytest.fixture(autouse=True)
+    def video(self, in_mem_db: Engine):
+        save_channel("test-channel", "Test channel", "http://example.com")
+        save_channel("test-channel", "Test channel", "http://example.com")
+        save_video("testvideo", "test-channel", "Test video", "http://example.com", 0, 60.0)
+        save_video("testvideo", "test-channel", "Test video", "http://example.com", 0, 60.0)
+
+    def test_sightings_are_written_on_close(self, in_mem_db: Engine):
+        writer = PositionSightingWriter(max_buffered=1000, flush_interval=1000)
+        for i in range(4):
+            writer.add("testvideo", self.test_fen1 if i % 2 == 0 else self.test_fen2, float(i))
+        with Session(in_mem_db) as session:
+            assert session.execute(select(PositionSighting)).first() is None
+
+        writer.close()
+        with Session(in_mem_db) as session:
+            saved_video = session.get(Video, "testvideo")
+            assert saved_video.channel.id == "test-channel"
+            assert len(saved_video.positions) == 2
+            assert sorted(s.sec_into_video for s in saved_video.position_sightings) == [0, 1, 2, 3]
+
+    def test_existing_positions_are_reused(self, in_mem_db: Engine):
+        save_position_sighting("testvideo", self.test_fen1, 0.0)
+        writer = PositionSightingWriter(max_buffered=2)
+        writer.add("testvideo", self.test_fen1, 1.0)
+        writer.add("testvideo", self.test_fen2, 2.0)
+        writer.flush()
+        writer.add("testvideo", self.test_fen2, 3.0)
+        writer.close()
+
+        with Session(in_mem_db) as session:
+            assert len(session.execute(select(Position)).scalars().all()) == 2
+            position = session.execute(select(Position).where(Position.fen == self.test_fen2)).scalars().one()
+            assert len(position.sightings) == 2
+
+    def test_buffer_is_flushed_after_interval(self, in_mem_db: Engine):
+        now = [0.0]
+        writer = PositionSightingWriter(flush_interval=.05, clock=lambda: now[0])
+        writer.add("testvideo", self.test_fen1, 0.0)
+        with writer._condition:
+            # However long it really waits, the interval isn't up until the clock says so
+            assert not writer._condition.wait_for(lambda: writer.written > 0, timeout=.2)
+            now[0] = .05
+            assert writer._condition.wait_for(lambda: writer.written > 0, timeout=5)
+        with Session(in_mem_db) as session:
+            assert len(session.execute(select(PositionSighting)).scalars().all()) == 1
+        writer.close()
+
+    def test_failed_writes_are_kept_and_reported(self, in_mem_db: Engine, mocker):
+        writer = PositionSightingWriter(flush_interval=1000)
+        write = mocker.patch.object(writer, "_write", side_effect=[OSError("DB is down"), None])
+        writer.add("testvideo", self.test_fen1, 0.0)
+        with pytest.raises(RuntimeError, match="Failed to persist 1 position sightings"):
+            writer.flush()
+
+        writer.add("testvideo", self.test_fen2, 1.0)
+        writer.close()
+        assert write.call_count == 2
+        assert [s["sec_into_video"] for s in write.call_args.args[0]] == [0.0, 1.0]
+        assert writer.written == 2
+
+
 @pytest.fixture
-def in_mem_db():
+def in_mem_db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     return init_sqlite_db()
@@ -0,0 +1,73 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from tests.test_data_loading import read_frame_number, write_numbered_video
+from video_processing.data_loading import FileFrameSource
+from video_processing.frame_archive import ArchiveFrameSource, record_frame_archive
+from video_processing.video_processing_task import SegmentedVideoProcessingTask
+
+
+class YoutubeLikeFrameSource(FileFrameSource):
+    """
+    Like `YoutubeFrameSource`, its length is in seconds rather than frames
+    """
+
+    def __len__(self):
+        return int(self.duration_sec)
+
+    @property
+    def duration_sec(self):
+        return super().__len__() / self.fps
+
+
+@pytest.fixture
+def numbered_video(tmp_path):
+    video_path = tmp_path / "numbered.avi"
+    write_numbered_video(video_path, set(), 90)
+    return video_path
+
+
+def test_replay_matches_the_recorded_source(tmp_path, numbered_video):
+    assert record_frame_archive(FileFrameSource(str(numbered_video), sample_fps=10, grayscale=True),
+                                tmp_path / "archive") == 30
+    recorded = [(sec_into_video, np.array(img)) for sec_into_video, img in
+                FileFrameSource(str(numbered_video), sample_fps=10, grayscale=True).iter_frames()]
+
+    archive = ArchiveFrameSource(tmp_path / "archive")
+    assert (len(archive), archive.fps, archive.frame_shape) == (90, 30, (48, 80))
+    assert archive.video_id == "testvideo"
+    replayed = [(sec_into_video, np.array(img)) for sec_into_video, img in archive.iter_frames()]
+    assert [sec_into_video for sec_into_video, _ in replayed] == [sec_into_video for sec_into_video, _ in recorded]
+    for (_, replayed_img), (_, recorded_img) in zip(replayed, recorded):
+        np.testing.assert_array_equal(replayed_img, recorded_img)
+
+
+def test_replay_seeks_and_samples(tmp_path, numbered_video):
+    record_frame_archive(FileFrameSource(str(numbered_video), sample_fps=10, grayscale=True), tmp_path / "archive")
+
+    # Each process maps the archive for itself
+    archive = pickle.loads(pickle.dumps(ArchiveFrameSource(tmp_path / "archive")))
+    assert [read_frame_number(img) for _, img in archive.iter_frames(stop_after_frames=60, start_frame=31)] == \
+        list(range(33, 60, 3))
+    # Only the recorded frames can be output, so sampling less often than they were recorded keeps every other one
+    archive = ArchiveFrameSource(tmp_path / "archive", sample_fps=5)
+    assert [round(sec_into_video * 30) for sec_into_video, _ in archive.iter_frames()] == list(range(0, 90, 6))
+    assert [round(sec_into_video * 30) for sec_into_video, _ in archive.sample_frames(3)] == [15, 45, 75]
+
+
+def test_only_grayscale_sources_are_recorded(tmp_path, numbered_video):
+    with pytest.raises(ValueError):
+        record_frame_archive(FileFrameSource(str(numbered_video)), tmp_path / "archive")
+
+
+def test_archive_has_the_length_of_the_video(tmp_path, numbered_video):
+    record_frame_archive(YoutubeLikeFrameSource(str(numbered_video), sample_fps=10, grayscale=True),
+                         tmp_path / "archive", stop_after_frames=45)
+
+    archive = ArchiveFrameSource(tmp_path / "archive")
+    # Only half the video was recorded, but the archive still stands in for all of it
+    assert (archive.duration_sec, len(archive)) == (3.0, 90)
+    segments = SegmentedVideoProcessingTask(archive, segment_sec=1).segments()
+    assert (len(segments), segments[-1][1]) == (3, 120)
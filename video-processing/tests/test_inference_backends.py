@@ -0,0 +1,113 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from video_processing.tensorflow.chessboard_finder import find_grayscale_tiles_in_image
+from video_processing.tensorflow.frame_analyzer import tiles_to_rows
+from video_processing.tensorflow.inference_backends import (MIN_QUANTIZED_AGREEMENT, NUMPY_WEIGHTS, InferenceBackend,
+                                                            NumpyBackend, QuantizedBackend, _VARIABLE_NAMES,
+                                                            quantization_report_path, saved_model_path)
+from video_processing.tensorflow.quantization import compare_backends, save_quantized_model, tile_rows_from_fens, \
+    tile_rows_from_images
+
+test_images = ['gothamchess_1', 'gothamchess_2', 'naroditsky_1', 'agadmator_1']
+
+
+def naive_conv2d_same(x, kernel, bias):
+    k = kernel.shape[0]
+    padded = np.pad(x, ((0, 0), (k // 2, k // 2), (k // 2, k // 2), (0, 0)))
+    out = np.zeros(x.shape[:3] + (kernel.shape[3],))
+    for y in range(x.shape[1]):
+        for x_ in range(x.shape[2]):
+            out[:, y, x_, :] = np.tensordot(padded[:, y:y + k, x_:x_ + k, :], kernel, axes=3)
+    return out + bias
+
+
+def naive_logits(weights, rows):
+    def max_pool(x):
+        n, h, w, c = x.shape
+        return np.array([[[x[:, 2 * i:2 * i + 2, 2 * j:2 * j + 2, :].max(axis=(1, 2))
+                           for j in range(w // 2)] for i in range(h // 2)]]).squeeze(0).transpose(2, 0, 1, 3)
+
+    x = rows.reshape(-1, 32, 32, 1)
+    x = max_pool(np.maximum(naive_conv2d_same(x, weights['Variable'], weights['Variable_1']), 0))
+    x = max_pool(np.maximum(naive_conv2d_same(x, weights['Variable_2'], weights['Variable_3']), 0))
+    x = np.maximum(x.reshape(len(rows), -1) @ weights['Variable_4'] + weights['Variable_5'], 0)
+    return x @ weights['Variable_6'] + weights['Variable_7']
+
+
+def test_numpy_forward_pass(tmp_path):
+    rng = np.random.default_rng(0)
+    shapes = [(5, 5, 1, 32), (32,), (5, 5, 32, 64), (64,), (4096, 1024), (1024,), (1024, 13), (13,)]
+    weights = {name: rng.normal(0, .1, shape).astype(np.float32) for name, shape in zip(_VARIABLE_NAMES, shapes)}
+    np.savez(tmp_path / 'weights.npz', **weights)
+
+    rows = rng.integers(0, 256, (3, 1024), dtype=np.uint8)
+    # The network itself takes normalized tiles, the backend normalizes them as part of the first convolution
+    expected_logits = naive_logits(weights, rows / 255)
+    backend = NumpyBackend(tmp_path / 'weights.npz')
+    assert np.allclose(backend.logits(rows), expected_logits, atol=1e-3)
+    assert np.array_equal(backend.predict(rows), np.argmax(expected_logits, axis=1))
+
+
+def test_backend_parity():
+    pytest.importorskip('tensorflow')
+    if not saved_model_path(NUMPY_WEIGHTS).exists():
+        pytest.skip("numpy weights haven't been exported")
+    from video_processing.tensorflow.inference_backends import TensorflowBackend
+
+    rows = []
+    for img_name in test_images:
+        img = Image.open(Path(__file__).parent / 'test_images' / (img_name + '.png'))
+        tiles, _ = find_grayscale_tiles_in_image(img)
+        rows.append(tiles_to_rows(tiles))
+    rows = np.concatenate(rows)
+
+    assert np.array_equal(NumpyBackend().predict(rows), TensorflowBackend().predict(rows))
+
+
+class FixedBackend(InferenceBackend):
+    def __init__(self, labels):
+        self.labels = np.array(labels)
+
+    def predict(self, rows):
+        return self.labels[:len(rows)]
+
+
+def test_compare_backends():
+    reference = [0] * 100 + [1] * 28
+    # Two of the kings on the second board are missed
+    candidate = reference[:120] + [0, 0] + reference[122:]
+    report = compare_backends(FixedBackend(reference), FixedBackend(candidate), np.zeros((128, 1024), np.uint8))
+    assert report.squares == 128
+    assert report.square_agreement == 126 / 128
+    assert report.board_agreement == .5
+    assert report.label_agreement == {'empty': 1.0, 'K': 26 / 28}
+
+
+def test_quantized_backend_needs_enough_agreement(tmp_path):
+    model_path = tmp_path / 'model.tflite'
+    model_path.write_bytes(b'')
+    with pytest.raises(ValueError, match="hasn't been validated"):
+        QuantizedBackend(model_path)
+
+    quantization_report_path(model_path).write_text('{"square_agreement": 0.98}')
+    with pytest.raises(ValueError, match="Refusing to use"):
+        QuantizedBackend(model_path, min_agreement=.99)
+
+
+def test_quantized_model(tmp_path):
+    pytest.importorskip('tensorflow')
+    if not saved_model_path(NUMPY_WEIGHTS).exists():
+        pytest.skip("numpy weights haven't been exported")
+
+    calibration_rows = tile_rows_from_images(sorted((Path(__file__).parent / 'test_images').glob('*.png')))
+    validation_rows = tile_rows_from_fens(['rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR',
+                                           'r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R'])
+    report = save_quantized_model(calibration_rows, validation_rows, tmp_path / 'model.tflite')
+    assert report.square_agreement >= MIN_QUANTIZED_AGREEMENT
+    backend = QuantizedBackend(tmp_path / 'model.tflite')
+    assert np.mean(backend.predict(calibration_rows) == NumpyBackend().predict(calibration_rows)) >= \
+        MIN_QUANTIZED_AGREEMENT
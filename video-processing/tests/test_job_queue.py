@@ -0,0 +1,171 @@
+import multiprocessing as mp
+import os
+import time
+
+import pytest
+from sqlalchemy.orm import Session
+from typer.testing import CliRunner
+
+from video_processing import db
+from video_processing.db import VideoJob, enqueue_video_urls, init_sqlite_db, save_channel, save_video
+from video_processing.job_queue import PostgresJobQueue, SqliteJobQueue, create_job_queue, default_worker_id
+
+runner = CliRunner()
+
+urls = [f"https://www.youtube.com/watch?v=video{i}" for i in range(5)]
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def job_queue_factory(request, tmp_path, monkeypatch):
+    """
+    Queues sharing a fresh DB. The postgres variant only runs when TEST_POSTGRES_HOST points at a DB that can be
+      written to (see `init_postgres_db` for the other TEST_POSTGRES_* variables)
+    """
+    monkeypatch.chdir(tmp_path)
+    if request.param == "sqlite":
+        init_sqlite_db()
+    else:
+        if "TEST_POSTGRES_HOST" not in os.environ:
+            pytest.skip("TEST_POSTGRES_HOST isn't set")
+        db.init_postgres_db(os.environ["TEST_POSTGRES_HOST"],
+                            int(os.environ.get("TEST_POSTGRES_PORT", 5432)),
+                            os.environ.get("TEST_POSTGRES_USER", "postgres"),
+                            os.environ.get("TEST_POSTGRES_PASSWORD", "postgres"),
+                            os.environ.get("TEST_POSTGRES_DB", "postgres"))
+        VideoJob.__table__.drop(db.get_engine(), checkfirst=True)
+        VideoJob.__table__.create(db.get_engine())
+
+    def create(worker_id, **kwargs):
+        return create_job_queue(worker_id=worker_id, lease_dir=tmp_path / "leases", **kwargs)
+
+    return create
+
+
+def job_statuses():
+    with Session(db.get_engine()) as session:
+        return {job.url: job.status for job in session.query(VideoJob)}
+
+
+def test_enqueue_ignores_duplicates(job_queue_factory):
+    assert enqueue_video_urls(urls[:3]) == 3
+    assert enqueue_video_urls(urls + urls[:1]) == 2
+    assert job_statuses() == {url: VideoJob.QUEUED for url in urls}
+
+
+def test_claims_are_unique_and_in_order(job_queue_factory):
+    enqueue_video_urls(urls[:3])
+    worker_a = job_queue_factory("a")
+    worker_b = job_queue_factory("b")
+    assert isinstance(worker_a, SqliteJobQueue | PostgresJobQueue)
+
+    claimed = [worker_a.claim(), worker_b.claim(), worker_a.claim()]
+    assert [job.url for job in claimed] == urls[:3]
+    assert all(job.attempts == 1 for job in claimed)
+    assert worker_b.claim() is None
+
+    worker_a.complete(claimed[0])
+    worker_b.complete(claimed[1])
+    statuses = job_statuses()
+    assert statuses[urls[0]] == statuses[urls[1]] == VideoJob.DONE
+    assert statuses[urls[2]] == VideoJob.RUNNING
+
+
+def test_expired_lease_is_reclaimed(job_queue_factory):
+    enqueue_video_urls(urls[:1])
+    crashed = job_queue_factory("crashed", lease_sec=.2)
+    survivor = job_queue_factory("survivor", lease_sec=.2)
+    job = crashed.claim()
+    assert survivor.claim() is None
+
+    time.sleep(.5)
+    reclaimed = survivor.claim()
+    assert reclaimed.id == job.id and reclaimed.attempts == 2
+    assert not crashed.heartbeat(job)
+    assert survivor.heartbeat(reclaimed)
+
+    # The crashed worker coming back to life must not clobber the new claim
+    crashed.complete(job)
+    assert job_statuses()[urls[0]] == VideoJob.RUNNING
+    survivor.complete(reclaimed)
+    assert job_statuses()[urls[0]] == VideoJob.DONE
+
+
+def test_heartbeats_keep_the_lease(job_queue_factory):
+    enqueue_video_urls(urls[:1])
+    holder = job_queue_factory("holder", lease_sec=.3)
+    other = job_queue_factory("other", lease_sec=.3)
+    job = holder.claim()
+    with holder.holding(job):
+        time.sleep(.8)
+        assert other.claim() is None
+    holder.complete(job)
+
+
+def test_failed_jobs_are_retried_until_out_of_attempts(job_queue_factory):
+    enqueue_video_urls(urls[:1])
+    worker = job_queue_factory("worker", max_attempts=2)
+    worker.fail(worker.claim(), "first")
+    assert job_statuses()[urls[0]] == VideoJob.QUEUED
+    job = worker.claim()
+    assert job.attempts == 2
+    worker.fail(job, "second")
+    assert job_statuses()[urls[0]] == VideoJob.FAILED
+    assert worker.claim() is None
+
+
+def claim_all(lease_dir, worker_id, results):
+    init_sqlite_db(reset=False)
+    job_queue = SqliteJobQueue(lease_dir, worker_id=worker_id)
+    while (job := job_queue.claim()) is not None:
+        results.put(job.url)
+
+
+def test_concurrent_sqlite_workers_never_share_a_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    init_sqlite_db()
+    many_urls = [f"https://www.youtube.com/watch?v=video{i}" for i in range(60)]
+    enqueue_video_urls(many_urls)
+
+    results = mp.Queue()
+    workers = [mp.Process(target=claim_all, args=(tmp_path / "leases", f"worker-{i}", results)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    claimed = [results.get(timeout=30) for _ in many_urls]
+    for worker in workers:
+        worker.join()
+    assert sorted(claimed) == sorted(many_urls)
+
+
+def test_enqueue_command_skips_processed_videos(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    init_sqlite_db()
+    save_channel("test-channel", "Test channel", "http://example.com")
+    save_video("video0", "test-channel", "Test video", "http://example.com", 0, 60.0)
+    (tmp_path / "urls.txt").write_text("\n".join(urls[:3]) + "\n\n")
+
+    from video_processing import main
+
+    result = runner.invoke(main.app, ["enqueue", "urls.txt", "--sqlite-db", "--db-password", "foo"])
+    if result.exception:
+        raise result.exception
+    assert job_statuses() == {url: VideoJob.QUEUED for url in urls[1:3]}
+
+
+def test_worker_threads_claim_as_separate_workers(tmp_path, monkeypatch, mocker):
+    monkeypatch.chdir(tmp_path)
+    init_sqlite_db()
+    enqueue_video_urls(urls[:4])
+    # Slow enough that every thread gets to claim a video
+    mocker.patch("video_processing.main.process_video", side_effect=lambda *args, **kwargs: time.sleep(.2))
+    mocker.patch("video_processing.tensorflow.frame_analyzer.set_backend")
+
+    from video_processing import main
+
+    result = runner.invoke(main.app, ["worker", "--threads", "2", "--exit-when-empty", "--sqlite-db",
+                                      "--db-password", "foo"])
+    if result.exception:
+        raise result.exception
+    assert job_statuses() == {url: VideoJob.DONE for url in urls[:4]}
+    with Session(db.get_engine()) as session:
+        worker_ids = {job.worker_id for job in session.query(VideoJob)}
+    assert worker_ids == {f"{default_worker_id()}-{i}" for i in range(2)}
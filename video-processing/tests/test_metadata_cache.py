@@ -0,0 +1,120 @@
+import copy
+import os
+import time
+
+import pytest
+
+from video_processing.data_loading import YoutubeFrameSource
+from video_processing.metadata_cache import MetadataCache, youtube_video_id
+
+# Trimmed down from what yt-dlp returned for the video
+recorded_info = {
+    "id": "k4T6TJGOSA0",
+    "title": "Test video",
+    "channel": "Test channel",
+    "channel_id": "UCtestchannel",
+    "channel_url": "https://www.youtube.com/channel/UCtestchannel",
+    "uploader": "Test channel",
+    "thumbnail": "https://i.ytimg.com/vi/k4T6TJGOSA0/maxresdefault.jpg",
+    "view_count": 1234,
+    "duration": 600,
+    "automatic_captions": {"en": [{"url": "https://example.com/captions"}]},
+    "formats": [
+        {"format_id": "18", "format_note": "360p", "ext": "mp4", "height": 360, "width": 640, "fps": 30,
+         "url": "https://example.com/360.mp4"},
+        {"format_id": "135", "format_note": "480p", "ext": "mp4", "height": 480, "width": 854, "fps": 30,
+         "url": "https://example.com/480.mp4", "fragments": [{"url": "https://example.com/480/1"}]},
+    ],
+}
+
+
+class RecordedFetcher:
+    def __init__(self, *infos):
+        self.infos = {info["id"]: info for info in infos}
+        self.calls = []
+
+    def __call__(self, video_url):
+        self.calls.append(video_url)
+        return copy.deepcopy(self.infos[youtube_video_id(video_url)])
+
+
+def url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+def test_cached_info_is_reused(tmp_path):
+    fetcher = RecordedFetcher(recorded_info)
+    cache = MetadataCache(tmp_path, fetcher=fetcher)
+    info = cache.video_info(url("k4T6TJGOSA0"))
+    assert cache.video_info("https://youtu.be/k4T6TJGOSA0") == info
+    assert len(fetcher.calls) == 1
+
+    # A different cache object over the same directory, eg. in another process
+    assert MetadataCache(tmp_path, fetcher=fetcher).video_info(url("k4T6TJGOSA0")) == info
+    assert len(fetcher.calls) == 1
+
+    assert "automatic_captions" not in info
+    assert "fragments" not in info["formats"][1]
+    assert info["formats"][1]["url"] == "https://example.com/480.mp4"
+
+
+def test_stream_urls_expire_before_metadata(tmp_path):
+    fetcher = RecordedFetcher(recorded_info)
+    cache = MetadataCache(tmp_path, ttl_sec=60, stream_ttl_sec=.1, fetcher=fetcher)
+    cache.video_info(url("k4T6TJGOSA0"))
+    time.sleep(.2)
+    cache.video_info(url("k4T6TJGOSA0"), need_streams=False)
+    assert len(fetcher.calls) == 1
+    cache.video_info(url("k4T6TJGOSA0"))
+    assert len(fetcher.calls) == 2
+
+
+def test_least_recently_used_videos_are_evicted(tmp_path):
+    infos = [dict(recorded_info, id=f"video{i}") for i in range(3)]
+    fetcher = RecordedFetcher(*infos)
+    cache = MetadataCache(tmp_path, max_entries=2, fetcher=fetcher)
+    for i, info in enumerate(infos[:2]):
+        cache.video_info(url(info["id"]))
+        os.utime(tmp_path / "videos" / f"{info['id']}.json", (i, i))
+    cache.video_info(url("video0"))
+    cache.video_info(url("video2"))
+    cache.evict()
+
+    assert sorted(path.stem for path in (tmp_path / "videos").glob("*.json")) == ["video0", "video2"]
+    assert len(fetcher.calls) == 3
+
+
+def test_cache_is_evicted_when_opened(tmp_path):
+    infos = [dict(recorded_info, id=f"video{i}") for i in range(3)]
+    cache = MetadataCache(tmp_path, fetcher=RecordedFetcher(*infos))
+    for i, info in enumerate(infos):
+        cache.video_info(url(info["id"]))
+        os.utime(tmp_path / "videos" / f"{info['id']}.json", (i, i))
+
+    # Eg. the next process to use the cache, which may not write enough entries to evict any itself
+    MetadataCache(tmp_path, max_entries=2)
+    assert sorted(path.stem for path in (tmp_path / "videos").glob("*.json")) == ["video1", "video2"]
+
+
+def test_frame_source_uses_the_cache(tmp_path):
+    fetcher = RecordedFetcher(recorded_info)
+    cache = MetadataCache(tmp_path, fetcher=fetcher)
+    for _ in range(2):
+        frame_source = YoutubeFrameSource(url("k4T6TJGOSA0"), metadata_cache=cache)
+        assert frame_source.video_id == "k4T6TJGOSA0"
+        assert frame_source.channel_name == "Test channel"
+        # The cheapest format that's big enough
+        assert frame_source.frame_shape == (360, 640)
+        assert frame_source._source == "https://example.com/360.mp4"
+    assert len(fetcher.calls) == 1
+
+
+@pytest.mark.parametrize("video_url, video_id", [
+    ("https://www.youtube.com/watch?v=k4T6TJGOSA0&t=10", "k4T6TJGOSA0"),
+    ("https://m.youtube.com/watch?v=k4T6TJGOSA0", "k4T6TJGOSA0"),
+    ("https://youtu.be/k4T6TJGOSA0", "k4T6TJGOSA0"),
+    ("https://www.youtube.com/shorts/k4T6TJGOSA0", "k4T6TJGOSA0"),
+    ("https://example.com/watch?v=k4T6TJGOSA0", None),
+])
+def test_youtube_video_id(video_url, video_id):
+    assert youtube_video_id(video_url) == video_id
@@ -0,0 +1,127 @@
+import json
+import multiprocessing as mp
+import os
+import time
+
+import pytest
+
+from video_processing import metrics
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    metrics.registry.clear()
+    yield
+    metrics.registry.clear()
+
+
+def test_histogram_quantiles():
+    hist = metrics.Histogram(buckets=(1.0, 2.0, 4.0))
+    for value in [0.5] * 50 + [3.0] * 50:
+        hist.observe(value)
+    assert hist.count == 100
+    assert hist.counts == [50, 0, 50, 0]
+    assert hist.quantile(.5) == pytest.approx(1.0)
+    assert hist.quantile(.9) == pytest.approx(3.6)
+
+
+def test_timed_records_latency_and_items():
+    @metrics.timed('locate', items=1)
+    def locate():
+        pass
+
+    for _ in range(3):
+        locate()
+    with metrics.timed('inference', items=8):
+        pass
+
+    snapshot = metrics.registry.snapshot()
+    latencies = {entry['labels']['stage']: entry['count'] for entry in snapshot['histograms']['stage_seconds']}
+    items = {entry['labels']['stage']: entry['value'] for entry in snapshot['counters']['items_total']}
+    assert latencies == {'locate': 3, 'inference': 1}
+    assert items == {'locate': 3, 'inference': 8}
+
+
+def test_prometheus_text():
+    metrics.registry.observe('stage_seconds', .003, stage='decode')
+    metrics.record_queue('tile_queue', 5, 30)
+    text = metrics.registry.prometheus_text()
+    assert '# TYPE video_processing_stage_seconds histogram' in text
+    assert 'video_processing_stage_seconds_bucket{stage="decode",le="0.0025"} 0' in text
+    assert 'video_processing_stage_seconds_bucket{stage="decode",le="0.005"} 1' in text
+    assert 'video_processing_stage_seconds_bucket{stage="decode",le="+Inf"} 1' in text
+    assert 'video_processing_stage_seconds_count{stage="decode"} 1' in text
+    assert 'video_processing_queue_occupancy{queue="tile_queue"} 5' in text
+    assert 'video_processing_queue_capacity{queue="tile_queue"} 30' in text
+
+
+def test_exporting_writes_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setenv(metrics.METRICS_DIR_ENV, str(tmp_path))
+    with metrics.exporting('test'):
+        metrics.count('decode', 10)
+    with metrics.exporting('test'):
+        metrics.count('decode', 5)
+
+    # The processes with the same name share a snapshot file, and the .prom files go away along with the process
+    assert [path.name for path in tmp_path.iterdir()] == ['test.jsonl']
+    snapshots = [json.loads(line) for line in (tmp_path / 'test.jsonl').read_text().splitlines()]
+    # Counters carry on from one block to the next in the same process, eg. across the videos of a warm worker
+    assert [snapshot['counters']['items_total'] for snapshot in snapshots] == \
+        [[{'labels': {'stage': 'decode'}, 'value': 10}], [{'labels': {'stage': 'decode'}, 'value': 15}]]
+    assert snapshots[0]['rates']['items_total'][0]['per_sec'] > 0
+    assert snapshots[0]['process'] == 'test'
+
+
+def count_in_child():
+    with metrics.exporting('child'):
+        metrics.count('decode', 1)
+
+
+def test_metrics_from_before_exporting_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setenv(metrics.METRICS_DIR_ENV, str(tmp_path))
+    metrics.count('prescan_locate', 3)
+    with metrics.exporting('main'):
+        pass
+    snapshot = json.loads((tmp_path / 'main.jsonl').read_text())
+    assert snapshot['counters']['items_total'] == [{'labels': {'stage': 'prescan_locate'}, 'value': 3}]
+
+    # Whereas a forked child starts over, rather than exporting its parent's metrics as its own
+    child = mp.get_context('fork').Process(target=count_in_child)
+    child.start()
+    child.join()
+    snapshot = json.loads((tmp_path / 'child.jsonl').read_text())
+    assert snapshot['counters']['items_total'] == [{'labels': {'stage': 'decode'}, 'value': 1}]
+
+
+def test_prometheus_series_are_labelled_with_their_process(tmp_path):
+    metrics.count('decode', 10)
+    metrics.registry.observe('stage_seconds', .003, stage='decode')
+    exporter = metrics.MetricsExporter(tmp_path, 'test')
+    exporter.export()
+
+    text = exporter.prom_path.read_text()
+    assert exporter.prom_path.name == f'test-{os.getpid()}.prom'
+    assert f'video_processing_items_total{{stage="decode",process="test-{os.getpid()}"}} 10' in text
+    assert f'video_processing_stage_seconds_bucket{{stage="decode",process="test-{os.getpid()}",le="0.005"}} 1' in text
+    exporter.stop()
+    assert not exporter.prom_path.exists()
+
+
+def test_prom_files_of_dead_processes_are_removed(tmp_path):
+    process = mp.Process(target=time.sleep, args=(0,))
+    process.start()
+    process.join()
+    (tmp_path / f'tiles-{process.pid}.prom').write_text('')
+    (tmp_path / f'main-{os.getpid()}.prom').write_text('')
+
+    exporter = metrics.MetricsExporter(tmp_path, 'test')
+    exporter.start()
+    exporter.stop()
+    assert [path.name for path in tmp_path.glob('*.prom')] == [f'main-{os.getpid()}.prom']
+
+
+def test_exporting_is_a_no_op_when_not_configured(tmp_path, monkeypatch):
+    monkeypatch.delenv(metrics.METRICS_DIR_ENV, raising=False)
+    with metrics.exporting('test'):
+        metrics.count('decode')
+    assert metrics.registry.snapshot()['counters']['items_total'][0]['value'] == 1
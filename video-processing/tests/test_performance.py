@@ -1,50 +1,123 @@
-import timeit
+import copy
+import time
 from pathlib import Path
 
-from PIL import Image
-
-from video_processing.data_loading import FileFrameSource
-from video_processing.db import init_sqlite_db
-from video_processing.tensorflow.chessboard_finder import find_grayscale_tiles_in_image
-from video_processing.tensorflow.frame_analyzer import extract_fen
-from video_processing.video_processing_task import VideoProcessingTask
-
-
-def test_performance():
-    init_sqlite_db()
-    vid_path = Path(__file__).parent / 'test_images' / "test_video_1.mp4"
-    frame_source = FileFrameSource('/tmp/test_video.mp4')
-    task = VideoProcessingTask(frame_source)
-    task.run()
-
-    # queue = frame_source.img_output_queue
-    # thread = Thread(target=frame_source.stream_frames)
-    # thread.start()
-    # print(timeit.Timer(lambda: queue.get()).timeit(5000) / 5000)
-    # frame_source.running = False
-    # thread.join()
-    # assert 1 == 2
-
-
-def assert_test_image_contains_fen(img_name, expected_fen):
-    img_path = Path(__file__).parent / 'test_images' / (img_name + '.png')
-    img = Image.open(img_path)
-    assert extract_fen(img) == expected_fen
-
-
-# python -m cProfile -o find-cb.prof /home/skyler/.cache/pypoetry/virtualenvs/video-processing-cjBJpIv2-py3.10/bin/pytest -k test_position_extraction_performance; gprof2dot -f pstats find-cb.prof | dot -Tpng -o find-cb.prof.png
-def test_position_extraction_performance():
-    img_path = Path(__file__).parent / 'test_images' / 'agadmator_1.png'
-    img = Image.open(img_path)
-
-    # original = 0.01471
-    # c60a6dc  = 0.01094
-    # fcb8c7d  = 0.00865
-    timeit_result = timeit.Timer(lambda: find_grayscale_tiles_in_image(img)).timeit(1000)
-    print(f"timeit result: {timeit_result / 1000}")
-
-# def test_position_extraction_performance():
-#     img_path = Path(__file__).parent / 'test_images' / 'agadmator_1.png'
-#     img = Image.open(img_path)
-#
-#     findGrayscaleTilesInImage(img)
+import cv2
+import pytest
+
+from video_processing.benchmark import BASELINE_PATH, RESULTS_VERSION, SCENARIOS, Scenario, compare_to_baseline, \
+    load_results, run_benchmarks
+from video_processing.synthetic_video import RUY_LOPEZ, START_FEN, BoardRenderer, VideoLayout, fen_to_board, \
+    fens_from_moves, scenes_from_fens, write_synthetic_video
+from video_processing.tensorflow.chessboard_finder import findChessboardCorners
+
+
+def test_fens_from_moves():
+    fens = fens_from_moves(RUY_LOPEZ)
+    assert fens[0] == START_FEN
+    assert fens[1] == "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR"
+    # Both sides have castled short by the end
+    assert fens[-1] == "r1bq1rk1/2p1bppp/p1np1n2/1p2p3/4P3/1BP2N2/PP1P1PPP/RNBQR1K1"
+
+
+def test_renderer_draws_pieces_on_either_colour():
+    renderer = BoardRenderer()
+    # Kings and queens are each only on one colour of square in the start position
+    img = renderer.render("kqKQ4/8/8/8/8/8/8/KQkq4", 400)
+    assert img.shape == (400, 400, 3)
+    assert findChessboardCorners(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)) is not None
+    with pytest.raises(ValueError):
+        BoardRenderer(fen="8/8/8/8/8/8/8/8").render(START_FEN, 400)
+
+
+def test_synthetic_video(tmp_path):
+    layout = VideoLayout(board_x=100, board_y=40, board_px=256)
+    fens = fens_from_moves(RUY_LOPEZ[:2])
+    ground_truth = write_synthetic_video(tmp_path / "video.mp4", scenes_from_fens(fens, .5, ((1, 1.0),)), layout)
+    assert ground_truth == [(0, .5, fens[0]), (.5, 1.5, None), (1.5, 2.0, fens[1]), (2.0, 2.5, fens[2])]
+    assert len(fen_to_board(fens[2])) == 8
+
+    cap = cv2.VideoCapture(str(tmp_path / "video.mp4"))
+    corners = []
+    while (frame := cap.read()[1]) is not None:
+        corners.append(findChessboardCorners(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)))
+    assert len(corners) == 75
+    assert all(corners[i] is None for i in range(15, 45))
+    for i in [*range(15), *range(45, 75)]:
+        assert corners[i] == pytest.approx([100, 40, 356, 296], abs=2)
+
+
+@pytest.fixture
+def results(tmp_path, brightness_backend, forkserver):
+    # Under forkserver, like the CLI runs it, so that end_to_end processes the video in a process of its own
+    scenario = Scenario("tiny", moves=RUY_LOPEZ[:3], sec_per_position=.5, board_free=((2, 1.0),))
+    return run_benchmarks([scenario], work_dir=tmp_path)
+
+
+def test_benchmark_suite(results):
+    result = results["scenarios"]["tiny"]
+    assert result["frames"] == 90
+    assert set(result["stages"]) == {"decode", "locate", "inference", "persist", "end_to_end"}
+    assert result["stages"]["decode"]["items"] == 90
+    assert result["stages"]["inference"]["items"] == 60
+    assert result["stages"]["end_to_end"]["items"] == 90
+    assert result["accuracy"]["sighting_precision"] is not None
+    assert all(stage["per_sec"] > 0 for stage in result["stages"].values())
+    assert result["stages"]["locate"]["latency_sec"]["mean"] > 0
+    assert result["accuracy"]["board_found"] == 1.0
+    # The stand-in backend doesn't know the pieces, so there are no right fens to count
+    assert result["accuracy"]["frame_fen"] == 0.0
+
+
+def test_compare_to_baseline(results):
+    assert compare_to_baseline(results, results) == []
+
+    baseline = copy.deepcopy(results)
+    # A little noise is fine
+    baseline["scenarios"]["tiny"]["stages"]["decode"]["per_sec"] *= 1.1
+    assert compare_to_baseline(results, baseline) == []
+
+    baseline["scenarios"]["tiny"]["stages"]["locate"]["per_sec"] *= 2
+    baseline["scenarios"]["tiny"]["accuracy"]["frame_fen"] = .9
+    regressions = compare_to_baseline(results, baseline)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("tiny: locate ran at")
+    assert regressions[1] == "tiny: frame_fen accuracy fell to 0.0%, from 90.0%"
+
+    baseline["version"] = 0
+    assert len(compare_to_baseline(results, baseline)) == 1
+
+
+def test_backend_stages_are_only_compared_with_the_same_backend(results):
+    baseline = copy.deepcopy(results)
+    baseline["environment"]["backend"] = "OtherBackend"
+    baseline["scenarios"]["tiny"]["stages"]["inference"]["per_sec"] *= 2
+    baseline["scenarios"]["tiny"]["accuracy"]["frame_fen"] = .9
+    assert compare_to_baseline(results, baseline) == []
+
+    baseline["scenarios"]["tiny"]["stages"]["locate"]["per_sec"] *= 2
+    assert len(compare_to_baseline(results, baseline)) == 1
+
+
+def test_baseline_is_current():
+    baseline = load_results(BASELINE_PATH)
+    assert baseline["version"] == RESULTS_VERSION
+    assert set(baseline["scenarios"]) == {scenario.name for scenario in SCENARIOS}
+
+
+@pytest.mark.benchmark
+def test_coarse_to_fine_is_faster():
+    imgs = [cv2.imread(str(Path(__file__).parent / "test_images" / f"{name}.png"), cv2.IMREAD_GRAYSCALE)
+            for name in ["gothamchess_2", "gothamchess_3"]]
+
+    def best_time(coarse_scale):
+        times = []
+        for _ in range(5):
+            start = time.perf_counter()
+            for img in imgs:
+                findChessboardCorners(img, coarse_scale)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    # It's about 3x faster with a board in the frame and 4x without, the rest is headroom for noisy machines
+    assert best_time(.5) * 2 < best_time(None)
@@ -0,0 +1,78 @@
+import multiprocessing as mp
+import time
+from functools import partial
+
+import pytest
+
+from tests.conftest import SquareBrightnessBackend
+from video_processing import db
+from video_processing.data_loading import FileFrameSource
+from video_processing.pipeline import PipelineConfig, VideoPipeline, unique_videos
+from video_processing.video_processing_task import VideoProcessingTask
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db.init_sqlite_db()
+
+
+def pipeline(**config) -> VideoPipeline:
+    return VideoPipeline(PipelineConfig(decode_workers=1, locate_workers=2,
+                                        inference_backend=SquareBrightnessBackend(), **config),
+                         partial(FileFrameSource, grayscale=True))
+
+
+def test_unique_videos():
+    assert unique_videos(["https://www.youtube.com/watch?v=TsR154sQMVo", "https://youtu.be/TsR154sQMVo",
+                          "video.mp4", "https://youtu.be/abc", "video.mp4"]) == \
+        ["https://www.youtube.com/watch?v=TsR154sQMVo", "video.mp4", "https://youtu.be/abc"]
+
+
+def test_pipeline_matches_task(sqlite_db, scenes_video, brightness_backend):
+    writer = db.PositionSightingWriter()
+    VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=writer).run()
+    writer.close()
+    expected = db.video_sightings("testvideo")
+    db.init_sqlite_db()
+
+    done = []
+    # The same video twice only gets processed once
+    pipeline().run([str(scenes_video), str(scenes_video)], done.append)
+
+    assert done == [str(scenes_video)]
+    assert len(expected) >= 3
+    assert db.video_sightings("testvideo") == expected
+
+
+def test_videos_of_a_dead_worker_are_failed(sqlite_db, scenes_video):
+    bystander = mp.Process(target=time.sleep, args=(30,))
+    bystander.start()
+
+    def kill_locator(url):
+        next(p for p in mp.active_children() if p.name == "locator-0").kill()
+
+    done = []
+    try:
+        pipeline().run([str(scenes_video)], done.append, kill_locator)
+        assert done == [str(scenes_video)]
+        # Only the pipeline's own workers are stopped
+        assert bystander.is_alive()
+    finally:
+        bystander.terminate()
+
+
+
+def test_pipeline_with_seek_ahead(sqlite_db, scenes_video, brightness_backend):
+    writer = db.PositionSightingWriter()
+    VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=writer).run()
+    writer.close()
+    expected = db.video_sightings("testvideo")
+    db.init_sqlite_db()
+
+    done = []
+    pipeline(seek_ahead=True).run([str(scenes_video)], done.append)
+
+    # The board reports the locators send the decoder don't hold up the shutdown, and no position is skipped over
+    assert done == [str(scenes_video)]
+    assert {fen for fen, _ in db.video_sightings("testvideo")} == {fen for fen, _ in expected}
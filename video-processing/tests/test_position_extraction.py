@@ -1,10 +1,13 @@
 from pathlib import Path
 
 import numpy as np
+import pytest
 from PIL import Image
 
-from video_processing.tensorflow.chessboard_finder import findChessboardCorners
-from video_processing.tensorflow.frame_analyzer import extract_fen
+from video_processing.tensorflow.chessboard_finder import (ChessboardTracker, findChessboardCorners,
+                                                           find_grayscale_tiles_in_image, getTiles)
+from video_processing.tensorflow.frame_analyzer import (TilePredictionCache, extract_fen, process_tiles,
+                                                        process_tiles_batch)
 
 
 def assert_test_image_contains_fen(img_name, expected_fen):
@@ -25,15 +28,72 @@ def test_position_extraction():
     assert_test_image_contains_fen('naroditsky_1', 'r1bqkbnr/pp1ppppp/2n5/2p4Q/2B1P3/8/PPPP1PPP/RNB1K1NR')
 
 
-def assert_find_chessboard_corners_result(img_name: str, expected_corners: np.array):
+def test_batched_position_extraction():
+    img_names = ['gothamchess_1', 'gothamchess_2', 'naroditsky_1', 'agadmator_1']
+    tiles_batch = [find_grayscale_tiles_in_image(load_test_img(img_name))[0] for img_name in img_names]
+    assert process_tiles_batch(tiles_batch) == [process_tiles(tiles) for tiles in tiles_batch]
+    assert process_tiles_batch([]) == []
+
+
+def test_cached_position_extraction():
+    img_names = ['gothamchess_1', 'gothamchess_1', 'gothamchess_2', 'gothamchess_2', 'gothamchess_1']
+    tiles_batch = [find_grayscale_tiles_in_image(load_test_img(img_name))[0] for img_name in img_names]
+    cache = TilePredictionCache()
+    assert process_tiles_batch(tiles_batch[:3], cache) + process_tiles_batch(tiles_batch[3:], cache) == \
+           [process_tiles(tiles) for tiles in tiles_batch]
+    # Every square of the repeated frames is reused, and at least half of the squares didn't change between the two
+    # positions
+    assert cache.reused >= 64 * 2 + 32
+
+
+def test_tile_cache_threshold(brightness_backend):
+    # The tiles are uint8, the threshold is still in normalized units
+    tiles = np.full((32, 32, 64), 200, dtype=np.uint8)
+    slightly_changed = tiles.copy()
+    slightly_changed[:, :, 3] -= 5
+    changed = tiles.copy()
+    changed[:, :, 3] += 6
+    cache = TilePredictionCache(threshold=.02)
+    process_tiles_batch([tiles, slightly_changed, changed], cache)
+    assert (cache.inferred, cache.reused) == (65, 127)
+
+
+def assert_find_chessboard_corners_result(img_name: str, expected_corners: np.array, coarse_scale=None):
     pil_img = load_test_img(img_name)
     img = np.asarray(pil_img.convert('L'), dtype=np.uint8)
-    detected_corners = findChessboardCorners(img)
+    detected_corners = findChessboardCorners(img, coarse_scale)
     assert np.allclose(detected_corners, expected_corners, atol=3)
 
 
-def test_find_cb_corners():
-    assert_find_chessboard_corners_result('gothamchess_1', np.array([28, 3, 495, 470]))
-    assert_find_chessboard_corners_result('gothamchess_2', np.array([28, 3, 495, 470]))
-    assert_find_chessboard_corners_result('naroditsky_1', np.array([370, 0, 853, 478]))
-    assert_find_chessboard_corners_result('agadmator_1', np.array([88, 70, 476, 455]))
+@pytest.mark.parametrize('coarse_scale', [None, .5, .25])
+def test_find_cb_corners(coarse_scale):
+    assert_find_chessboard_corners_result('gothamchess_1', np.array([28, 3, 495, 470]), coarse_scale)
+    assert_find_chessboard_corners_result('gothamchess_2', np.array([28, 3, 495, 470]), coarse_scale)
+    assert_find_chessboard_corners_result('naroditsky_1', np.array([370, 0, 853, 478]), coarse_scale)
+    assert_find_chessboard_corners_result('agadmator_1', np.array([88, 70, 476, 455]), coarse_scale)
+    assert findChessboardCorners(np.asarray(load_test_img('gothamchess_3').convert('L')), coarse_scale) is None
+
+
+def test_chessboard_tracker_reuses_corners():
+    tracker = ChessboardTracker()
+    img = load_test_img('naroditsky_1')
+    expected_tiles, expected_corners = find_grayscale_tiles_in_image(img)
+    for _ in range(3):
+        tiles, corners = find_grayscale_tiles_in_image(img, tracker)
+        assert np.array_equal(tiles, expected_tiles)
+        assert np.array_equal(corners, expected_corners)
+    assert (tracker.hits, tracker.misses) == (2, 1)
+
+    # The board is gone, so the cached corners must be dropped
+    assert find_grayscale_tiles_in_image(load_test_img('gothamchess_3'), tracker) == (None, None)
+    assert tracker.corners is None
+    assert (tracker.hits, tracker.misses) == (2, 2)
+
+
+def test_get_tiles_layout():
+    # Each 32x32 square of the board image is filled with its rank * 8 + file, with a1 in the bottom left corner
+    board_img = np.kron(np.arange(64, dtype=np.uint8).reshape(8, 8)[::-1], np.ones((32, 32), dtype=np.uint8))
+    tiles = getTiles(board_img)
+    assert tiles.shape == (32, 32, 64) and tiles.dtype == np.uint8
+    for square in range(64):
+        assert np.all(tiles[:, :, square] == square)
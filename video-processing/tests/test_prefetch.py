@@ -0,0 +1,169 @@
+import threading as thd
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytest
+
+from video_processing.data_loading import YoutubeFrameSource
+from video_processing.metadata_cache import MetadataCache
+from video_processing.prefetch import Prefetcher, VideoFileCache, download_file
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files with support for single range requests, which SimpleHTTPRequestHandler doesn't have
+    """
+    supports_ranges = True
+    ranges_served = []
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        if not self.supports_ranges or range_header is None:
+            return super().do_GET()
+        data = (self.directory_path / self.path.lstrip("/")).read_bytes()
+        start, end = (int(i) for i in range_header.removeprefix("bytes=").split("-"))
+        end = min(end, len(data) - 1)
+        type(self).ranges_served.append((start, end))
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    served_dir = tmp_path / "served"
+    served_dir.mkdir()
+    handler = type("Handler", (RangeRequestHandler,), {"ranges_served": [], "directory_path": served_dir})
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=str(served_dir)))
+    thread = thd.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd, handler, served_dir, f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def write_video(path, n_frames=10):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 30, (64, 48))
+    for i in range(n_frames):
+        writer.write(np.full((48, 64, 3), i * 20, dtype=np.uint8))
+    writer.release()
+
+
+def test_download_with_range_requests(server, tmp_path):
+    _, handler, served_dir, base_url = server
+    data = np.random.default_rng(0).integers(0, 256, 100_000, dtype=np.uint8).tobytes()
+    (served_dir / "video.mp4").write_bytes(data)
+
+    dest = tmp_path / "video.mp4"
+    assert download_file(f"{base_url}/video.mp4", dest, connections=3, range_bytes=16_384)
+    assert dest.read_bytes() == data
+    # The probe, then one request per range
+    assert len(handler.ranges_served) == 1 + 7
+
+
+def test_download_without_range_support(server, tmp_path):
+    _, handler, served_dir, base_url = server
+    handler.supports_ranges = False
+    (served_dir / "video.mp4").write_bytes(b"x" * 50_000)
+
+    dest = tmp_path / "video.mp4"
+    assert download_file(f"{base_url}/video.mp4", dest, range_bytes=16_384)
+    assert dest.read_bytes() == b"x" * 50_000
+    assert handler.ranges_served == []
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = VideoFileCache(tmp_path, max_bytes=250)
+    formats = [{"format_id": str(i), "ext": "mp4"} for i in range(3)]
+    for i, fmt in enumerate(formats[:2]):
+        cache.path("video", fmt).write_bytes(b"x" * 100)
+        time.sleep(.01)
+    assert cache.get("video", formats[0]) is not None
+
+    assert cache.reserve(100)
+    cache.path("video", formats[2]).write_bytes(b"x" * 100)
+    assert cache.get("video", formats[1]) is None
+    assert cache.get("video", formats[0]) is not None
+    assert cache.usage() == 200
+    assert not cache.reserve(300)
+
+
+def test_prefetcher_stays_within_lookahead(server, tmp_path):
+    _, _, served_dir, base_url = server
+    video_urls = [f"{base_url}/video{i}.avi" for i in range(4)]
+    for i in range(4):
+        write_video(served_dir / f"video{i}.avi")
+
+    def resolve(video_url):
+        video_id = video_url.rpartition("/")[2].removesuffix(".avi")
+        return video_id, {"format_id": "test", "ext": "avi", "url": video_url}
+
+    cache = VideoFileCache(tmp_path / "cache")
+    prefetcher = Prefetcher(video_urls, cache, resolve, lookahead=2).start()
+    time.sleep(.5)
+    assert sorted(path.name for path in cache.directory.iterdir()) == ["video0-test.avi", "video1-test.avi"]
+
+    prefetcher.started(video_urls[0])
+    prefetcher.started(video_urls[1])
+    deadline = time.monotonic() + 5
+    while len(list(cache.directory.iterdir())) < 4 and time.monotonic() < deadline:
+        time.sleep(.05)
+    prefetcher.stop()
+    assert sorted(path.name for path in cache.directory.iterdir()) == [f"video{i}-test.avi" for i in range(4)]
+
+
+def test_frame_source_switches_to_prefetched_file(server, tmp_path):
+    _, _, served_dir, base_url = server
+    write_video(served_dir / "video.avi")
+    info = {"id": "testvideo", "title": "Test video", "channel": "Test channel", "channel_id": "test-channel",
+            "duration": 1, "formats": [{"format_id": "135", "format_note": "480p", "ext": "mp4", "height": 48,
+                                        "width": 64, "fps": 30, "url": f"{base_url}/video.avi"}]}
+    metadata_cache = MetadataCache(tmp_path / "metadata", fetcher=lambda _: info)
+    video_cache = VideoFileCache(tmp_path / "videos")
+    video_url = "https://www.youtube.com/watch?v=testvideo"
+
+    frame_source = YoutubeFrameSource(video_url, metadata_cache=metadata_cache, video_cache=video_cache)
+    assert frame_source._source == f"{base_url}/video.avi"
+
+    prefetcher = Prefetcher([video_url], video_cache,
+                            lambda url: (frame_source.video_id, frame_source.stream_format)).start()
+    local_path = video_cache.path("testvideo", frame_source.stream_format)
+    deadline = time.monotonic() + 5
+    while not local_path.exists() and time.monotonic() < deadline:
+        time.sleep(.05)
+    prefetcher.stop()
+    assert frame_source._source == str(local_path)
+
+    frame_source.stream_frames()
+    frames = []
+    while (frame := frame_source.img_output_queue.get(timeout=3)[1]) is not None:
+        frames.append(frame.mean())
+        frame_source.img_output_queue.release()
+    frame_source.img_output_queue.close()
+    assert len(frames) == 10
+
+
+def test_prefetcher_skips_playlist_formats(server, tmp_path):
+    _, _, served_dir, base_url = server
+    (served_dir / "playlist.m3u8").write_text("#EXTM3U\n")
+    fmt = {"format_id": "hls", "ext": "mp4", "url": f"{base_url}/playlist.m3u8", "protocol": "m3u8_native"}
+
+    resolved = thd.Event()
+
+    def resolve(video_url):
+        resolved.set()
+        return "video", fmt
+
+    cache = VideoFileCache(tmp_path / "cache")
+    prefetcher = Prefetcher(["video"], cache, resolve).start()
+    assert resolved.wait(5)
+    # Stopping waits for the prefetch to finish
+    prefetcher.stop()
+    assert list(cache.directory.iterdir()) == []
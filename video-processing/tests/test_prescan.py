@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+from sqlalchemy.orm import Session
+
+from video_processing import prescan
+from video_processing.data_loading import FileFrameSource
+from video_processing.db import NoBoardVideo, Video, init_sqlite_db
+from video_processing.prescan import find_board, prescan_videos
+
+
+def write_video(path, board_frames, n_frames=300):
+    board = cv2.resize(cv2.imread(str(Path(__file__).parent / "test_images" / "gothamchess_1.png")), (640, 360))
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), 30, (640, 360))
+    for i in range(n_frames):
+        writer.write(board if i in board_frames else np.full_like(board, 40))
+    writer.release()
+
+
+@pytest.fixture
+def videos(tmp_path):
+    write_video(tmp_path / "board.mp4", range(100, 200))
+    write_video(tmp_path / "noboard.mp4", ())
+    return tmp_path
+
+
+def test_find_board(videos):
+    board_sec, frames_checked = find_board(FileFrameSource(str(videos / "board.mp4"), grayscale=True))
+    # The 4th of the 8 frames checked is the first one in the middle third of the video
+    assert frames_checked == 4
+    assert board_sec == pytest.approx(131 / 30)
+
+    assert find_board(FileFrameSource(str(videos / "noboard.mp4"), grayscale=True)) == (None, 8)
+
+
+def test_videos_without_a_board_are_recorded_and_skipped(videos, monkeypatch):
+    loaded = []
+
+    class UrlFrameSource(FileFrameSource):
+        def __init__(self, video_url, grayscale=False, format_policy=None):
+            # The prescan's samples are all the seeking into the video it does
+            assert format_policy is not None and format_policy.verify_samples == 0
+            self._video_id = video_url.rpartition("=")[2]
+            loaded.append(self._video_id)
+            super().__init__(str(videos / f"{self._video_id}.mp4"), grayscale=grayscale)
+
+        @property
+        def video_id(self):
+            return self._video_id
+
+    monkeypatch.setattr(prescan, "YoutubeFrameSource", UrlFrameSource)
+    monkeypatch.chdir(videos)
+    engine = init_sqlite_db()
+
+    urls = [f"https://www.youtube.com/watch?v={video_id}" for video_id in ["noboard", "board"]]
+    assert prescan_videos(urls, threads=2) == urls[1:]
+    with Session(engine) as session:
+        assert [video.id for video in session.query(Video)] == ["noboard"]
+        assert [video.video_id for video in session.query(NoBoardVideo)] == ["noboard"]
+
+    # The video without a board isn't even loaded again
+    loaded.clear()
+    assert prescan_videos(urls, threads=2) == urls[1:]
+    assert loaded == ["board"]
@@ -0,0 +1,63 @@
+import heapq
+
+import pytest
+
+from video_processing import scheduling
+from video_processing.metadata_cache import MetadataCache
+from video_processing.scheduling import BatchProgress, fetch_durations, longest_first_order
+
+
+def makespan(durations, workers):
+    """
+    How long a pool of `workers` takes to get through videos of these durations, each worker taking the next one as
+      soon as it's free
+    """
+    free_at = [0.0] * workers
+    for duration in durations:
+        heapq.heappush(free_at, heapq.heappop(free_at) + duration)
+    return max(free_at)
+
+
+def test_longest_first_order():
+    durations = {"a": 60, "b": 600, "c": None, "d": 60, "e": 240}
+    # c is assumed to be of average length
+    assert longest_first_order(list(durations), durations) == ["b", "c", "e", "a", "d"]
+
+    durations = {f"short{i}": 60 for i in range(8)} | {"long": 240}
+    assert makespan([durations[url] for url in durations], 2) == 480
+    assert makespan([durations[url] for url in longest_first_order(list(durations), durations)], 2) == 360
+
+
+def test_fetch_durations(tmp_path, monkeypatch):
+    def fetcher(video_url):
+        if video_url.endswith("missing"):
+            raise IOError("Video unavailable")
+        return {"id": video_url[-1], "duration": 100}
+
+    monkeypatch.setattr(scheduling, "get_default_cache", lambda: MetadataCache(tmp_path, fetcher=fetcher))
+    urls = ["https://www.youtube.com/watch?v=a", "https://www.youtube.com/watch?v=missing"]
+    assert fetch_durations(urls, threads=2) == {urls[0]: 100, urls[1]: None}
+
+
+def test_batch_progress_eta():
+    now = [0.0]
+    progress = BatchProgress({"a": 400, "b": 100, "c": 100, "d": None}, workers=2, clock=lambda: now[0])
+    assert progress.total_sec == 800
+    assert progress.eta_sec() is None
+
+    now[0] = 10
+    progress.advance("a", 50)
+    progress.advance("b", 50)
+    # 100s of video in 10s, so 700s left takes 70s
+    assert progress.eta_sec() == pytest.approx(70)
+
+    progress.finished("b")
+    progress.finished("c")
+    progress.finished("d")
+    now[0] = 25
+    # Together the workers would get through the 350s left in under 20s, but a is only worked on by one of them
+    assert progress.processed_sec == 450
+    assert progress.eta_sec() == pytest.approx(350 / (450 / 25 / 2))
+
+    progress.advance("a", 1000)
+    assert progress.eta_sec() == 0
@@ -0,0 +1,81 @@
+import math
+import multiprocessing as mp
+import queue
+
+import numpy as np
+import pytest
+
+from video_processing.shared_ring_buffer import SharedRingBuffer
+
+
+def produce(ring: SharedRingBuffer, n: int):
+    for i in range(n):
+        ring.put(np.full((32, 32, 64), i, dtype=np.float32), i / 30)
+    ring.put(None, n / 30)
+    ring.put(ValueError("bad frame"))
+    ring.put("done")
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRingBuffer(4, 32 * 32 * 64 * 4)
+    yield ring
+    ring.close()
+
+
+def test_items_cross_process_in_order(ring):
+    producer = mp.Process(target=produce, args=(ring, 20))
+    producer.start()
+    for i in range(20):
+        sec_into_video, tiles = ring.get(timeout=5)
+        assert sec_into_video == i / 30
+        assert tiles.shape == (32, 32, 64) and tiles.dtype == np.float32
+        assert np.all(tiles == i)
+        ring.release()
+
+    assert ring.get(timeout=5) == (20 / 30, None)
+    sec_into_video, e = ring.get(timeout=5)
+    assert math.isnan(sec_into_video) and isinstance(e, ValueError)
+    assert ring.get(timeout=5)[1] == "done"
+    producer.join(5)
+
+
+def test_producer_blocks_until_slots_are_released(ring):
+    for i in range(4):
+        ring.put(np.zeros(8))
+    with pytest.raises(queue.Full):
+        ring.put(np.zeros(8), timeout=.1)
+
+    # the received slot stays reserved until it's released
+    ring.get()
+    with pytest.raises(queue.Full):
+        ring.put(np.zeros(8), timeout=.1)
+    ring.release()
+    ring.put(np.zeros(8), timeout=.1)
+
+
+def test_oversized_items_keep_their_order(ring):
+    big = np.arange(ring.slot_bytes, dtype=np.float64)
+    ring.put(np.ones(4))
+    ring.put(big)
+    ring.put({"payload": "x" * ring.slot_bytes})
+    ring.put(np.ones(4) * 2)
+
+    assert np.all(ring.get()[1] == 1)
+    assert np.array_equal(ring.get()[1], big)
+    assert len(ring.get()[1]["payload"]) == ring.slot_bytes
+    assert np.all(ring.get()[1] == 2)
+    with pytest.raises(queue.Empty):
+        ring.get(timeout=.1)
+
+
+def test_qsize_where_semaphores_cant_be_counted(ring, monkeypatch):
+    ring.put(np.ones(4))
+    assert ring.qsize() == 1
+
+    def not_implemented():
+        raise NotImplementedError
+
+    # As on macOS
+    monkeypatch.setattr(ring._filled_slots, 'get_value', not_implemented)
+    assert ring.qsize() == -1
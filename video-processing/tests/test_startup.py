@@ -0,0 +1,40 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# Seconds importing the CLI may take. It's about half that with everything cached, the rest is headroom for slow
+# machines, so anything that blows it has most likely pulled in something heavy at import time
+IMPORT_BUDGET_SEC = 1.5
+
+# Modules only the commands that decode video or run inference need, which are imported as they run
+HEAVY_MODULES = ["cv2", "PIL", "pandas", "tensorflow", "yt_dlp", "video_processing.data_loading",
+                 "video_processing.pipeline", "video_processing.video_processing_task"]
+
+
+def import_main() -> tuple[float, list[str]]:
+    """
+    Import the CLI in a fresh interpreter
+
+    :return: how long the import took, and which of `HEAVY_MODULES` it imported
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         f"import sys, json, video_processing.main; "
+         f"print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))"],
+        capture_output=True, text=True, check=True, cwd=Path(__file__).parent.parent)
+    # -X importtime reports "import time: self [us] | cumulative [us] | module" for each module imported
+    main_line = next(line for line in result.stderr.splitlines() if line.endswith("| video_processing.main"))
+    cumulative_us = int(main_line.split("|")[1])
+    return cumulative_us / 1e6, json.loads(result.stdout)
+
+
+def test_cli_imports_are_lazy():
+    _, heavy_modules = import_main()
+    assert heavy_modules == []
+
+
+def test_cli_import_time_budget():
+    # The best of a few imports, so a busy machine doesn't fail it
+    import_sec = min(import_main()[0] for _ in range(3))
+    assert import_sec < IMPORT_BUDGET_SEC
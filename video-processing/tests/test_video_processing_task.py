@@ -0,0 +1,211 @@
+import random
+
+import pytest
+
+from video_processing import db
+from video_processing.data_loading import FileFrameSource
+from video_processing.frame_archive import ArchiveFrameSource, record_frame_archive
+from video_processing.video_processing_task import FenStabilizer, FenTimeline, SegmentedVideoProcessingTask, \
+    VideoProcessingTask
+from video_processing.warm_workers import WarmWorkerPool
+
+test_fen1 = "2kr3r/ppp2pp1/5n1p/4n1N1/2Pqp1b1/3P2P1/P1PQ1PBP/1RB2RK1"
+test_fen2 = "8/1pq2ppk/r1p1nn1p/p1b1p3/P1N1P1BP/2P1B1P1/1P2QPK1/3R4"
+
+
+def feed(stabilizer, observations):
+    sightings = []
+    for sec_into_video, fen in observations:
+        sighting_sec = stabilizer.update(sec_into_video, fen)
+        if sighting_sec is not None:
+            sightings.append((fen, sighting_sec))
+    return sightings
+
+
+def test_stabilizer_matches_frame_count_at_30fps():
+    # 10 identical frames in a row at 30 fps are needed before a position is recorded
+    observations = [(i / 30, test_fen1) for i in range(9)]
+    assert feed(FenStabilizer(), observations) == []
+    observations.append((9 / 30, test_fen1))
+    assert feed(FenStabilizer(), observations) == [(test_fen1, 0)]
+
+
+def test_stabilizer_is_independent_of_sampling_rate():
+    for fps in [30, 10, 5]:
+        observations = [(i / fps, test_fen1) for i in range(fps)] + \
+                       [(1 + i / fps, test_fen2) for i in range(fps)] + \
+                       [(2 + i / fps, test_fen1) for i in range(fps)]
+        assert feed(FenStabilizer(), observations) == [(test_fen1, 0), (test_fen2, 1), (test_fen1, 2)]
+
+
+def test_stabilizer_ignores_flickers():
+    observations = [(i / 30, test_fen1) for i in range(30)]
+    observations[15] = (15 / 30, test_fen2)
+    assert feed(FenStabilizer(), observations) == [(test_fen1, 0)]
+
+
+def test_joined_timelines_stabilize_like_every_frame():
+    rng = random.Random(0)
+    fens = [test_fen1, test_fen2, "8/8/8/8/8/8/8/8"]
+    observations = []
+    fen = fens[0]
+    for i in range(2000):
+        if rng.random() < .05:
+            fen = rng.choice(fens)
+        # Frames without a position aren't fed in
+        if rng.random() < .9:
+            observations.append((i / 30, fen))
+    expected = feed(FenStabilizer(), observations)
+
+    splits = sorted(rng.sample(range(len(observations)), 7))
+    timeline = FenTimeline()
+    for start, end in zip([0] + splits, splits + [len(observations)]):
+        segment = FenTimeline()
+        for sec_into_video, fen in observations[start:end]:
+            segment.add(sec_into_video, fen)
+        timeline.extend(segment)
+    assert timeline.sightings(.3) == expected
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.sightings = []
+
+    def add(self, video_id, fen, sec_into_video):
+        self.sightings.append((fen, sec_into_video))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_segmented_matches_sequential(scenes_video, brightness_backend):
+    sequential = RecordingWriter()
+    VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=sequential).run()
+    segmented = RecordingWriter()
+    task = SegmentedVideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), segment_sec=2, workers=3,
+                                        warmup_sec=.5, sighting_writer=segmented)
+    assert len(task.segments()) == 5
+    task.run()
+
+    assert len(sequential.sightings) >= 3
+    assert segmented.sightings == sequential.sightings
+
+
+def test_archive_replay_matches_video(tmp_path, scenes_video, brightness_backend):
+    from_video = RecordingWriter()
+    VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=from_video).run()
+    record_frame_archive(FileFrameSource(str(scenes_video), grayscale=True), tmp_path / "archive")
+    replayed = RecordingWriter()
+    VideoProcessingTask(ArchiveFrameSource(tmp_path / "archive"), sighting_writer=replayed).run()
+
+    assert len(from_video.sightings) >= 3
+    assert replayed.sightings == from_video.sightings
+
+
+def test_warm_workers_are_reused(scenes_video, brightness_backend):
+    fresh = RecordingWriter()
+    VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=fresh).run()
+
+    pool = WarmWorkerPool()
+    warm = RecordingWriter()
+    try:
+        for _ in range(3):
+            task = VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=warm,
+                                       worker_pool=pool)
+            task.run()
+        # A video that's stopped part way through takes its worker down with it
+        task = VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True),
+                                   sighting_writer=RecordingWriter(), worker_pool=pool)
+        task.run(task.stop)
+        task = VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=warm,
+                                   worker_pool=pool)
+        task.run()
+    finally:
+        pool.close()
+
+    assert warm.sightings == fresh.sightings * 4
+    assert pool.started == 2
+
+
+def test_ring_buffer_is_freed_when_the_process_fails_to_start(scenes_video, monkeypatch):
+    from multiprocessing.shared_memory import SharedMemory
+
+    from video_processing import video_processing_task
+
+    buffers = []
+
+    class TrackedRingBuffer(video_processing_task.SharedRingBuffer):
+        def __init__(self, *args):
+            super().__init__(*args)
+            buffers.append(self._shm.name)
+
+    def fail_to_start(process):
+        raise OSError("Can't start a process")
+
+    monkeypatch.setattr(video_processing_task, "SharedRingBuffer", TrackedRingBuffer)
+    monkeypatch.setattr(video_processing_task.mp.Process, "start", fail_to_start)
+    task = VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=RecordingWriter())
+    # Nothing is allocated for a task until it runs
+    assert not buffers
+    with pytest.raises(OSError):
+        task.run()
+
+    assert len(buffers) == 1
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=buffers[0])
+
+
+def test_frame_buffer_is_freed_when_streaming_tiles_fails(scenes_video, monkeypatch):
+    import threading
+    from multiprocessing.shared_memory import SharedMemory
+
+    from video_processing import data_loading
+    from video_processing.video_processing_task import stream_tile_tensors
+
+    buffers = []
+
+    class TrackedRingBuffer(data_loading.SharedRingBuffer):
+        def __init__(self, *args):
+            super().__init__(*args)
+            buffers.append(self._shm.name)
+
+    class BrokenTileQueue:
+        def __init__(self):
+            self.items = []
+
+        def put(self, value, timestamp, timeout=None):
+            if not isinstance(value, str):
+                raise OSError("Tile queue is broken")
+            self.items.append(value)
+
+    monkeypatch.setattr(data_loading, "SharedRingBuffer", TrackedRingBuffer)
+    tile_queue = BrokenTileQueue()
+    threads_before = threading.active_count()
+    with pytest.raises(OSError):
+        stream_tile_tensors(FileFrameSource(str(scenes_video), grayscale=True), {}, tile_queue)
+
+    # The decoder was stopped rather than left waiting for room, and the frame buffer is gone
+    assert threading.active_count() == threads_before
+    assert tile_queue.items == ["done"]
+    assert len(buffers) == 1
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=buffers[0])
+
+
+def test_task_with_a_db_writer_runs_under_forkserver(tmp_path, monkeypatch, scenes_video, brightness_backend,
+                                                     forkserver):
+    monkeypatch.chdir(tmp_path)
+    db.init_sqlite_db()
+    db.save_channel("test-channel", "Test channel", "http://example.com")
+    db.save_video("testvideo", "test-channel", "Test video", "http://example.com", 0, 10.0)
+    expected = RecordingWriter()
+    VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=expected).run()
+
+    # The writer's thread and lock can't be pickled, so it must stay in this process
+    writer = db.PositionSightingWriter()
+    VideoProcessingTask(FileFrameSource(str(scenes_video), grayscale=True), sighting_writer=writer).run()
+    writer.close()
+    assert writer.written == len(expected.sightings) >= 3
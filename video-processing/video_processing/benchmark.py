@@ -0,0 +1,304 @@
+import json
+import logging
+import platform
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional
+
+import cv2
+import numpy as np
+
+from video_processing import metrics
+from video_processing.data_loading import FileFrameSource
+from video_processing.db import PositionSightingWriter, init_sqlite_db, video_sightings
+from video_processing.synthetic_video import RUY_LOPEZ, Overlay, VideoLayout, fens_from_moves, scenes_from_fens, \
+    write_synthetic_video
+from video_processing.tensorflow import frame_analyzer
+from video_processing.tensorflow.chessboard_finder import ChessboardTracker, find_grayscale_tiles_in_image
+from video_processing.tensorflow.frame_analyzer import TilePredictionCache, process_tiles_batch
+from video_processing.video_processing_task import VideoProcessingTask
+
+log = logging.getLogger(__name__)
+
+# Bumped whenever the results change shape, or what's measured changes enough that old baselines don't compare
+RESULTS_VERSION = 1
+# The results regressions are checked against by default, see `compare_to_baseline`
+BASELINE_PATH = Path(__file__).parent / 'benchmark_assets' / 'baseline.json'
+# What depends on which inference backend is used, so is only compared with a baseline run with the same one
+_BACKEND_STAGES = {'inference', 'end_to_end'}
+_BACKEND_ACCURACY = {'frame_fen', 'sighting_recall', 'sighting_precision'}
+
+
+@dataclass
+class Scenario:
+    """
+    A synthetic video to benchmark with: the positions of a game, each on screen for `sec_per_position`, with
+      stretches without a board
+    """
+    name: str
+    layout: VideoLayout = field(default_factory=VideoLayout)
+    moves: list[str] = field(default_factory=lambda: list(RUY_LOPEZ))
+    sec_per_position: float = 1.0
+    # (index, seconds) of stretches without a board, before the position at each index
+    board_free: tuple[tuple[int, float], ...] = ((6, 3.0),)
+    fps: float = 30
+
+
+SCENARIOS = [
+    # A board on the left, and a facecam on the right
+    Scenario('facecam'),
+    # A small board in the corner of a 720p video, under a big overlay
+    Scenario('small_board_720p',
+             VideoLayout(width=1280, height=720, board_x=960, board_y=400, board_px=240,
+                         overlays=[Overlay(40, 40, 640, 360)], caption=None),
+             board_free=((4, 2.0), (12, 4.0))),
+]
+
+
+def _latency(stage: str) -> dict:
+    """
+    :return: the latency of a stage (per call of whatever it times) recorded since the registry was last cleared
+    """
+    for entry in metrics.registry.snapshot()['histograms'].get('stage_seconds', []):
+        if entry['labels'].get('stage') == stage:
+            return {name: entry[name] for name in ('mean', 'p50', 'p90', 'p99')}
+    return {}
+
+
+def _stage_result(stage: str, items: int, wall_sec: float, per: str = 'frame') -> dict:
+    return {'items': items, 'per_sec': items / wall_sec if wall_sec > 0 else None, 'latency_sec': _latency(stage),
+            'latency_per': per}
+
+
+def _fen_at(ground_truth: list[tuple[float, float, Optional[str]]], sec_into_video: float) -> Optional[str]:
+    for start_sec, end_sec, fen in ground_truth:
+        if start_sec <= sec_into_video < end_sec:
+            return fen
+    return None
+
+
+def _fraction(hits: int, total: int) -> Optional[float]:
+    return hits / total if total else None
+
+
+def _frames(video_path: Path) -> Iterator[tuple[float, np.ndarray]]:
+    """
+    Decode every frame of a video the same way it's done for processing, each frame only being valid until the next
+      one is asked for
+    """
+    return FileFrameSource(str(video_path), grayscale=True).iter_frames()
+
+
+def bench_decode(video_path: Path) -> dict:
+    metrics.registry.clear()
+    start = time.perf_counter()
+    frames = sum(1 for _ in _frames(video_path))
+    return _stage_result('decode', frames, time.perf_counter() - start)
+
+
+def bench_locate_and_infer(video_path: Path, ground_truth: list[tuple[float, float, Optional[str]]],
+                           batch_size: int = 8, coarse_scale: Optional[float] = None) -> tuple[dict, dict, dict]:
+    """
+    Find the board in every frame and run the network on the tiles of the ones it's found in, like when processing:
+      with a tracker that carries over from frame to frame, and in batches with a tile prediction cache. Each stage
+      is timed on its own, the frames are decoded in the background
+
+    :return: the results of the locate and inference stages, and how many frames the board was correctly found (or
+      not found) in and how many the right fen was found in
+    """
+    metrics.registry.clear()
+    tracker = ChessboardTracker(coarse_scale=coarse_scale)
+    tile_cache = TilePredictionCache()
+    locate_sec = infer_sec = 0.0
+    counts = {'frames': 0, 'board_found': 0, 'boards': 0, 'fen_right': 0}
+    batch = []
+
+    def infer():
+        nonlocal infer_sec
+        start = time.perf_counter()
+        fens = process_tiles_batch([tiles for _, tiles in batch], tile_cache)
+        infer_sec += time.perf_counter() - start
+        counts['fen_right'] += sum(fen == _fen_at(ground_truth, sec_into_video)
+                                   for (sec_into_video, _), fen in zip(batch, fens))
+        batch.clear()
+
+    for sec_into_video, img in _frames(video_path):
+        start = time.perf_counter()
+        tiles, _ = find_grayscale_tiles_in_image(img, tracker)
+        locate_sec += time.perf_counter() - start
+        counts['frames'] += 1
+        counts['board_found'] += (tiles is not None) == (_fen_at(ground_truth, sec_into_video) is not None)
+        if tiles is not None:
+            counts['boards'] += 1
+            batch.append((sec_into_video, tiles))
+            if len(batch) == batch_size:
+                infer()
+    if batch:
+        infer()
+    return (_stage_result('locate', counts['frames'], locate_sec),
+            _stage_result('inference', counts['boards'], infer_sec, per='batch'),
+            counts)
+
+
+def bench_persist(fens: list[str], db_path: Path, n_sightings: int = 2000) -> dict:
+    """
+    Write `n_sightings` sightings of `fens` (as if from many videos) to a fresh sqlite DB
+    """
+    init_sqlite_db(path=db_path)
+    metrics.registry.clear()
+    writer = PositionSightingWriter()
+    start = time.perf_counter()
+    for i in range(n_sightings):
+        writer.add(f"benchmark{i // len(fens)}", fens[i % len(fens)], float(i % len(fens)))
+    writer.close()
+    return _stage_result('db_write_sightings', n_sightings, time.perf_counter() - start, per='batch')
+
+
+def bench_end_to_end(video_path: Path, coarse_scale: Optional[float] = None) -> tuple[dict, list[tuple[str, float]]]:
+    """
+    Process a video with `VideoProcessingTask`, writing the sightings to whichever DB is initialized
+
+    :return: the results, and the (fen, sec into video) sightings that ended up in the DB
+    """
+    frames = 0
+
+    def frame_processed():
+        nonlocal frames
+        frames += 1
+
+    frame_source = FileFrameSource(str(video_path), grayscale=True)
+    writer = PositionSightingWriter()
+    start = time.perf_counter()
+    try:
+        VideoProcessingTask(frame_source, sighting_writer=writer, coarse_scale=coarse_scale).run(frame_processed)
+    finally:
+        writer.close()
+    wall_sec = time.perf_counter() - start
+    return {'items': frames, 'per_sec': frames / wall_sec if wall_sec > 0 else None}, \
+        video_sightings(frame_source.video_id)
+
+
+def run_scenario(scenario: Scenario, work_dir: Path, batch_size: int = 8, coarse_scale: Optional[float] = None) -> dict:
+    """
+    Render a scenario's video, and benchmark every stage on it, then the whole of processing it
+
+    :param coarse_scale: search for the board coarse to fine, see `findChessboardCorners`
+    """
+    fens = fens_from_moves(scenario.moves)
+    video_path = work_dir / f"{scenario.name}.mp4"
+    ground_truth = write_synthetic_video(video_path, scenes_from_fens(fens, scenario.sec_per_position,
+                                                                      scenario.board_free),
+                                         scenario.layout, scenario.fps)
+
+    decode = bench_decode(video_path)
+    locate, infer, counts = bench_locate_and_infer(video_path, ground_truth, batch_size, coarse_scale)
+    persist = bench_persist(fens, work_dir / f"{scenario.name}.sqlite")
+    end_to_end, sightings = bench_end_to_end(video_path, coarse_scale)
+
+    # And how well the whole video went: which of its positions were recorded, and whether anything else was
+    expected_fens = {fen for _, _, fen in ground_truth if fen is not None}
+    sighted_fens = [fen for fen, _ in sightings]
+    accuracy = {
+        # Against the positions the video was rendered with, whether a board was found in each frame (or rightly
+        # not found), and whether the right fen was found in the frames with a board
+        'board_found': _fraction(counts['board_found'], counts['frames']),
+        'frame_fen': _fraction(counts['fen_right'], counts['boards']),
+        'sighting_recall': _fraction(len(expected_fens & set(sighted_fens)), len(expected_fens)),
+        'sighting_precision': _fraction(sum(fen in expected_fens for fen in sighted_fens), len(sighted_fens)),
+    }
+    return {'frames': counts['frames'],
+            'stages': {'decode': decode, 'locate': locate, 'inference': infer, 'persist': persist,
+                       'end_to_end': end_to_end},
+            'accuracy': accuracy}
+
+
+def run_benchmarks(scenarios: list[Scenario] = SCENARIOS, work_dir: Optional[Path] = None,
+                   batch_size: int = 8, coarse_scale: Optional[float] = None) -> dict:
+    """
+    Benchmark every scenario, with whichever inference backend is set in `frame_analyzer`
+
+    :param work_dir: where to render the videos and write the DBs, a temporary directory if not given
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(work_dir or tmp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        results = {}
+        for scenario in scenarios:
+            log.info(f"Benchmarking {scenario.name}")
+            results[scenario.name] = run_scenario(scenario, work_dir, batch_size, coarse_scale)
+    return {'version': RESULTS_VERSION,
+            'time': time.time(),
+            'environment': {'backend': type(frame_analyzer.get_backend()).__name__, 'coarse_scale': coarse_scale,
+                            'python': platform.python_version(), 'opencv': cv2.__version__,
+                            'machine': platform.machine(), 'processor': platform.processor()},
+            'scenarios': results}
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = .2,
+                        accuracy_tolerance: float = .01) -> list[str]:
+    """
+    :param tolerance: fraction by which the throughput of a stage may fall below the baseline before it counts as a
+      regression, to allow for noise
+    :param accuracy_tolerance: how far (as a fraction of the frames or positions) accuracy may fall below the baseline
+    :return: a description of every regression from the baseline
+    """
+    if baseline.get('version') != results.get('version'):
+        return [f"The baseline is from version {baseline.get('version')} of the benchmarks, these results are from "
+                f"version {results.get('version')}"]
+    if baseline['environment'] != results['environment']:
+        log.warning(f"The baseline was run in a different environment: {baseline['environment']}")
+    same_backend = baseline['environment'].get('backend') == results['environment'].get('backend')
+    if not same_backend:
+        log.warning(f"The baseline was run with the {baseline['environment'].get('backend')} backend, not comparing "
+                    f"{', '.join(sorted(_BACKEND_STAGES | _BACKEND_ACCURACY))}")
+
+    regressions = []
+    for name, expected in baseline['scenarios'].items():
+        actual = results['scenarios'].get(name)
+        if actual is None:
+            regressions.append(f"{name}: not run")
+            continue
+        for stage, expected_stage in expected['stages'].items():
+            if stage in _BACKEND_STAGES and not same_backend:
+                continue
+            expected_rate = expected_stage.get('per_sec')
+            actual_rate = actual['stages'].get(stage, {}).get('per_sec')
+            if expected_rate and (actual_rate is None or actual_rate < expected_rate * (1 - tolerance)):
+                regressions.append(f"{name}: {stage} ran at {actual_rate or 0:0.1f}/s, "
+                                   f"down from {expected_rate:0.1f}/s")
+        for measure, expected_value in expected['accuracy'].items():
+            if measure in _BACKEND_ACCURACY and not same_backend:
+                continue
+            actual_value = actual['accuracy'].get(measure)
+            if expected_value is not None and (actual_value is None or
+                                               actual_value < expected_value - accuracy_tolerance):
+                regressions.append(f"{name}: {measure} accuracy fell to {actual_value or 0:.1%}, "
+                                   f"from {expected_value:.1%}")
+    return regressions
+
+
+def summary(results: dict) -> str:
+    """
+    A table of the throughput and latency of every stage, and the accuracy, of each scenario
+    """
+    lines = []
+    for name, result in results['scenarios'].items():
+        lines.append(f"{name} ({result['frames']} frames)")
+        for stage, stage_result in result['stages'].items():
+            latency = stage_result.get('latency_sec') or {}
+            latency_text = (f"  mean {latency['mean'] * 1000:7.2f}ms  p90 {latency['p90'] * 1000:7.2f}ms "
+                            f"per {stage_result['latency_per']}" if latency else '')
+            lines.append(f"  {stage:<12}{stage_result['per_sec'] or 0:9.1f}/s{latency_text}")
+        lines.append('  accuracy: ' + ', '.join(f"{measure} {value:.1%}" if value is not None else f"{measure} n/a"
+                                                for measure, value in result['accuracy'].items()))
+    return '\n'.join(lines)
+
+
+def save_results(results: dict, path: Path):
+    path.write_text(json.dumps(results, indent=2))
+
+
+def load_results(path: Path) -> dict:
+    return json.loads(path.read_text())
@@ -1,13 +1,20 @@
 import logging
+import queue
+import threading as thd
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field, replace
 from functools import cached_property, cache
-from multiprocessing import current_process, Queue
-# from queue import Queue
-from typing import Optional
+from multiprocessing import current_process
+from typing import Callable, Iterator, Optional
 
 import cv2
-from PIL import Image
-from yt_dlp import YoutubeDL
+import numpy as np
+
+from video_processing import metrics
+from video_processing.metadata_cache import MetadataCache, fetch_video_info, get_default_cache
+from video_processing.prefetch import VideoFileCache
+from video_processing.shared_ring_buffer import SharedRingBuffer
+from video_processing.tensorflow.chessboard_finder import BoardDetector, findChessboardCorners
 
 log = logging.getLogger(__name__)
 
@@ -16,19 +23,77 @@ class VideoProcessingException(Exception):
     pass
 
 
+@dataclass
+class SeekAhead:
+    """
+    Settings for skipping through the parts of a video without a chessboard on screen (intros, face cam segments,
+      sponsor reads etc.) rather than decoding every frame of them.
+
+    Whoever consumes the frames looks for the board in them anyway, so it tells the source what it found with
+      `FrameSource.report_board`, and `has_board` is only run on the frames the source seeks to. After
+      `min_empty_frames` reported frames in a row without a board, the source seeks ahead by `initial_skip_sec`,
+      doubling the jump (up to `max_skip_sec`) every time it lands on another frame without a board. Once it lands on
+      one with a board, it binary searches back to within `resolution_sec` of where the board appeared, and carries on
+      decoding every (sampled) frame from there. A board that comes and goes between two landings is missed, so one
+      that stays on screen for longer than `max_skip_sec` is always found
+    """
+    has_board: Callable[[np.ndarray], bool] = field(default_factory=BoardDetector)
+    min_empty_frames: int = 30
+    initial_skip_sec: float = 1.0
+    max_skip_sec: float = 16.0
+    resolution_sec: float = 0.3
+
+
 class FrameSource(ABC):
     """
-    Abstract strategy class for streaming a video as a series of PIL Images
+    Abstract strategy class for streaming a video as a series of RGB (or grayscale) numpy arrays
     """
 
     current_frame: int
-    img_output_queue: Queue
     running: bool
-
-    def __init__(self):
+    sample_fps: Optional[float]
+    grayscale: bool
+    seek_ahead: Optional[SeekAhead]
+    _img_output_queue: Optional[SharedRingBuffer]
+    _empty_frames: int
+    _reports_from_sec: float
+
+    def __init__(self, sample_fps: Optional[float] = None, grayscale: bool = False,
+                 seek_ahead: Optional[SeekAhead] = None):
+        """
+        :param sample_fps: if set, only (approximately) this many frames per second are decoded and output. The
+          rest are skipped without being decoded
+        :param grayscale: output HxW uint8 grayscale frames, converted straight from the decoder's BGR output, rather
+          than HxWx3 RGB frames. This is all the chessboard finder needs
+        :param seek_ahead: if set, long stretches of the video without a chessboard are skipped over by seeking, and
+          their frames aren't output
+        """
         self.current_frame = 0
-        self.img_output_queue = Queue(30)
         self.running = True
+        self.sample_fps = sample_fps
+        self.grayscale = grayscale
+        self.seek_ahead = seek_ahead
+        self._img_output_queue = None
+        # The number of frames in a row reported to have no board, counting from the last seek
+        self._empty_frames = 0
+        self._reports_from_sec = 0.0
+
+    def __getstate__(self):
+        # The frame buffer is only ever used within one process, so it gets created lazily in whichever process ends
+        # up streaming the frames
+        state = self.__dict__.copy()
+        state['_img_output_queue'] = None
+        return state
+
+    @property
+    def img_output_queue(self) -> SharedRingBuffer:
+        """
+        Buffer the frames are streamed into. Its slots are sized to fit a frame of `frame_shape`
+        """
+        if self._img_output_queue is None:
+            height, width = self.frame_shape
+            self._img_output_queue = SharedRingBuffer(30, height * width * (1 if self.grayscale else 3))
+        return self._img_output_queue
 
     @abstractmethod
     def __len__(self):
@@ -47,6 +112,14 @@ class FrameSource(ABC):
     def fps(self) -> float:
         pass
 
+    @property
+    @abstractmethod
+    def frame_shape(self) -> tuple[int, int]:
+        """
+        (height, width) of the frames of the video
+        """
+        pass
+
     @property
     @abstractmethod
     def video_id(self) -> str:
@@ -77,53 +150,322 @@ class FrameSource(ABC):
     def channel_id(self) -> str:
         pass
 
+    @property
+    @abstractmethod
+    def channel_name(self) -> str:
+        pass
+
+    @property
+    def duration_sec(self) -> float:
+        return len(self) / self.fps
+
     @property
     def current_sec_into_video(self) -> float:
         return self.current_frame / self.fps
 
-    def stream_frames(self, stop_after_frames: Optional[int] = None) -> None:
+    @property
+    def frame_stride(self) -> int:
+        """
+        Only every `frame_stride`th frame of the video is output
         """
-        Stream the video source into PIL images. Blocks until complete, and outputs to `self.img_output_queue`
+        if self.sample_fps is None:
+            return 1
+        return max(1, round(self.fps / self.sample_fps))
+
+    def report_board(self, sec_into_video: float, found: bool):
+        """
+        Tell the source whether there was a board in the frame it output at `sec_into_video`, which drives
+          `seek_ahead`. Reports can lag behind the stream, and the ones for frames from before the last seek are
+          ignored
+        """
+        if sec_into_video < self._reports_from_sec:
+            return
+        self._empty_frames = 0 if found else self._empty_frames + 1
+
+    def stream_frames(self, stop_after_frames: Optional[int] = None, start_frame: int = 0) -> None:
+        """
+        Stream the video source into RGB (or grayscale) numpy arrays. Blocks until complete, and outputs to
+          `self.img_output_queue`. Streaming starts by seeking to `start_frame`, if it's given
+
+        Each item on the queue is a `(sec_into_video, img)` tuple. The end of the video is signaled by an img of None,
+          and a failure to open the video by an img that is an exception. With `seek_ahead`, frames may be skipped,
+          but the timestamps of the output frames are still exact. Which ones depends on what's passed to
+          `report_board` as the frames are consumed
         """
         try:
             cap = cv2.VideoCapture(self._source)
             log.debug(f"hello from frame source in pid {current_process().pid}")
             if not cap.isOpened():
                 exception = VideoProcessingException(f"Video capture failed to open: {self._source}")
-                self.img_output_queue.put(exception)
+                self.img_output_queue.put(exception, self.current_sec_into_video)
                 return
 
             log.debug(f"Opencv video capture opened for {self._source}")
+            if start_frame:
+                self._seek(cap, start_frame)
+            self._empty_frames = 0
+            self._reports_from_sec = self.current_sec_into_video
+            # The decoded and converted frames are written into the same buffers every time, rather than allocating
+            # new ones per frame. The queue copies them into shared memory
+            cv2_img = None
+            converted = None
+            conversion = cv2.COLOR_BGR2GRAY if self.grayscale else cv2.COLOR_BGR2RGB
             # while the video is open, the task is still going, and we haven't passed the `stop_after_frames` arg
             while cap.isOpened() and \
                     self.running and \
                     (stop_after_frames is None or self.current_frame < stop_after_frames):
                 log.debug(f"frame source is working in pid {current_process().pid}")
-                ret, cv2_img = cap.read()
-                if ret:
+                # Skipped frames are only grabbed (demuxed), never retrieved (decoded) or converted
+                if self.current_frame % self.frame_stride != 0:
+                    if not cap.grab():
+                        break
                     self.current_frame += 1
-                    converted = cv2.cvtColor(cv2_img, cv2.COLOR_BGR2RGB)
-                    pil_im = Image.fromarray(converted)
-                    self.img_output_queue.put(pil_im)
-                else:
+                    continue
+
+                with metrics.timed('decode') as timer:
+                    ret, cv2_img = cap.read(cv2_img)
+                    if ret:
+                        converted = cv2.cvtColor(cv2_img, conversion, converted)
+                        timer.items = 1
+                if not ret:
                     break
+                sec_into_video = self.current_sec_into_video
+                self.current_frame += 1
+                self.img_output_queue.put(converted, sec_into_video)
+
+                if self.seek_ahead is not None and self._empty_frames >= self.seek_ahead.min_empty_frames:
+                    if not self._seek_to_board(cap, conversion):
+                        break
+                    # Whatever was reported while seeking is about frames from before where it landed
+                    self._empty_frames = 0
+                    self._reports_from_sec = self.current_sec_into_video
         finally:
             # cap.release()
-            self.img_output_queue.put(None)
+            self.img_output_queue.put(None, self.current_sec_into_video)
+
+    def sample_frames(self, n_samples: int) -> Iterator[tuple[float, np.ndarray]]:
+        """
+        Decode `n_samples` frames spread evenly through the video by seeking straight to them, eg. to get a quick idea
+          of what's in it. Independent of `stream_frames` and `img_output_queue`
+
+        :return: `(sec_into_video, img)` tuples, in order. Nothing if the length of the video isn't known
+        """
+        cap = cv2.VideoCapture(self._source)
+        if not cap.isOpened():
+            raise VideoProcessingException(f"Video capture failed to open: {self._source}")
+        conversion = cv2.COLOR_BGR2GRAY if self.grayscale else cv2.COLOR_BGR2RGB
+        try:
+            n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            for i in range(n_samples if n_frames > 0 else 0):
+                # The middle of each of `n_samples` equal parts, so the very start and end of the video are avoided
+                cap.set(cv2.CAP_PROP_POS_MSEC, int((i + .5) * n_frames / n_samples) / self.fps * 1000)
+                frame_num = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+                with metrics.timed('decode') as timer:
+                    ret, cv2_img = cap.read()
+                    if not ret:
+                        return
+                    timer.items = 1
+                    img = cv2.cvtColor(cv2_img, conversion)
+                yield frame_num / self.fps, img
+        finally:
+            cap.release()
+
+    def iter_frames(self, stop_after_frames: Optional[int] = None,
+                    start_frame: int = 0) -> Iterator[tuple[float, np.ndarray]]:
+        """
+        Stream the video in a background thread, like `stream_frames`, and yield the `(sec_into_video, img)` of each
+          frame. Each img is only valid until the next one is asked for
+
+        :raises VideoProcessingException: if the video couldn't be opened
+        """
+        img_queue = self.img_output_queue
+        streaming_thread = thd.Thread(target=self.stream_frames, args=(stop_after_frames, start_frame))
+        streaming_thread.start()
+        try:
+            while True:
+                sec_into_video, img = img_queue.get()
+                if img is None:
+                    break
+                if isinstance(img, Exception):
+                    raise img
+                yield sec_into_video, img
+                img_queue.release()
+        finally:
+            self.running = False
+            # The decoder may be waiting for room, if the frames weren't read to the end
+            while streaming_thread.is_alive():
+                try:
+                    img_queue.get(timeout=.1)
+                    img_queue.release()
+                except queue.Empty:
+                    pass
+            img_queue.close()
+            self._img_output_queue = None
+
+    def _seek(self, cap: cv2.VideoCapture, frame_num: int):
+        cap.set(cv2.CAP_PROP_POS_MSEC, frame_num / self.fps * 1000)
+        # Timestamps carry on from wherever the capture actually landed
+        self.current_frame = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def _probe_for_board(self, cap: cv2.VideoCapture, frame_num: int, conversion: int) -> Optional[bool]:
+        """
+        :return: whether there's a board in a frame, or None if the frame is past the end of the video
+        """
+        self._seek(cap, frame_num)
+        with metrics.timed('decode') as timer:
+            ret, cv2_img = cap.read()
+            if not ret:
+                return None
+            timer.items = 1
+            converted = cv2.cvtColor(cv2_img, conversion)
+        return self.seek_ahead.has_board(converted)
+
+    def _seek_to_board(self, cap: cv2.VideoCapture, conversion: int) -> bool:
+        """
+        Seek from the frame that was just output (the last of a run without a board) to just before the next frame with
+          a board, as described in `SeekAhead`
+
+        :return: False if no board was found before the end of the video
+        """
+        seek_ahead = self.seek_ahead
+        start = empty = self.current_frame - 1
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        last_frame = n_frames - 1 if n_frames > 0 else None
+        resolution = max(1, round(seek_ahead.resolution_sec * self.fps))
+        max_jump = max(1, round(seek_ahead.max_skip_sec * self.fps))
+        jump = min(max_jump, max(1, round(seek_ahead.initial_skip_sec * self.fps)))
+
+        # Gallop ahead until landing on a board
+        while True:
+            if not self.running:
+                return False
+            target = empty + jump if last_frame is None else min(empty + jump, last_frame)
+            if target <= empty:
+                return False
+            has_board = self._probe_for_board(cap, target, conversion)
+            if has_board is None:
+                # Past the end of a video of unknown length, so close in on the end instead
+                if jump <= resolution:
+                    return False
+                last_frame = target - 1
+                jump //= 2
+            elif has_board:
+                board = target
+                break
+            else:
+                empty = target
+                jump = min(jump * 2, max_jump)
+
+        # Narrow down where the board appeared
+        while board - empty > resolution:
+            middle = (empty + board) // 2
+            if self._probe_for_board(cap, middle, conversion):
+                board = middle
+            else:
+                empty = middle
+
+        self._seek(cap, empty + 1)
+        metrics.count('seek_ahead', self.current_frame - start - 1)
+        log.debug(f"Skipped from {start / self.fps:0.3f}s to {self.current_sec_into_video:0.3f}s without a board")
+        return True
+
+
+# Relative cost of decoding a pixel with each codec in software
+_CODEC_DECODE_COST = {'avc1': 1.0, 'h264': 1.0, 'vp9': 1.5, 'vp09': 1.5, 'av01': 2.5}
+_UNKNOWN_CODEC_DECODE_COST = 2.0
+# Protocols that opencv can stream from a format's url. DASH formats only have the url of their manifest
+_STREAMABLE_PROTOCOLS = {None, 'http', 'https', 'm3u8', 'm3u8_native'}
+
+
+def decode_cost(fmt: dict) -> float:
+    """
+    Relative cost of decoding a second of a format (from a yt-dlp info dict): its pixels per second, weighted by how
+      expensive its codec is to decode
+    """
+    codec = (fmt.get('vcodec') or '').split('.')[0]
+    return fmt['width'] * fmt['height'] * (fmt.get('fps') or 30) * \
+        _CODEC_DECODE_COST.get(codec, _UNKNOWN_CODEC_DECODE_COST)
+
+
+@dataclass
+class FormatPolicy:
+    """
+    Picks the format of a video that's cheapest to decode while still showing the board big enough to be located and
+      cut into tiles reliably. Video-only formats are fine, since the audio is never used.
+
+    Until the board has been measured it's assumed to be `board_height_fraction` of the frame height. With
+      `verify_samples`, the board is looked for in that many frames of the chosen format, and if it isn't found (or is
+      smaller than `min_board_px`) progressively bigger formats are tried, at most `max_upgrades` of them
+    """
+    min_board_px: int = 200
+    board_height_fraction: float = .8
+    max_height: int = 1080
+    verify_samples: int = 0
+    max_upgrades: int = 2
+
+    def ranked(self, formats: list[dict]) -> list[dict]:
+        """
+        :return: the formats that can be streamed, cheapest to decode first (then lowest bitrate)
+        """
+        usable = [fmt for fmt in formats
+                  if fmt.get('vcodec') != 'none' and fmt.get('height') and fmt.get('width') and fmt.get('url')
+                  and fmt.get('protocol') in _STREAMABLE_PROTOCOLS and fmt['height'] <= self.max_height]
+        return sorted(usable, key=lambda fmt: (decode_cost(fmt), fmt.get('tbr') or 0))
+
+    def select(self, formats: list[dict]) -> Optional[dict]:
+        """
+        :return: the cheapest format whose board should be big enough, or the tallest one if none are big enough
+        """
+        ranked = self.ranked(formats)
+        for fmt in ranked:
+            if fmt['height'] * self.board_height_fraction >= self.min_board_px:
+                return fmt
+        return max(ranked, key=lambda fmt: fmt['height'], default=None)
+
+    def upgrade(self, formats: list[dict], fmt: dict, board_px: Optional[int]) -> Optional[dict]:
+        """
+        :param board_px: the size of the board found in `fmt`, or None if it wasn't found at all
+        :return: the cheapest taller format that the board should be big enough in (or just the cheapest taller one
+          if the board wasn't found), or None if there isn't one
+        """
+        min_height = fmt['height'] * self.min_board_px / board_px if board_px else 0
+        for candidate in self.ranked(formats):
+            if candidate['height'] > fmt['height'] and candidate['height'] >= min_height:
+                return candidate
+        return None
+
+
+# For the videos that are actually processed, where a few seeks are worth it to make sure that the board can be found
+# in the chosen format
+PROCESSING_FORMAT_POLICY = FormatPolicy(verify_samples=3)
 
 
 class YoutubeFrameSource(FrameSource):
-    def __init__(self, video_url: str, resolution='480p', subtype='mp4'):
-        super().__init__()
+    def __init__(self, video_url: str, resolution: Optional[str] = None, subtype: str = 'mp4',
+                 sample_fps: Optional[float] = None, grayscale: bool = False,
+                 metadata_cache: Optional[MetadataCache] = None, video_cache: Optional[VideoFileCache] = None,
+                 seek_ahead: Optional[SeekAhead] = None, format_policy: Optional[FormatPolicy] = None):
+        """
+        :param resolution: stream exactly this format (eg. '480p'), with extension `subtype`, rather than letting
+          `format_policy` choose
+        :param metadata_cache: where to look up the video's info, defaults to `get_default_cache()`
+        :param video_cache: where a `Prefetcher` may have downloaded the video to. If the download is complete by the
+          time streaming starts, the local copy is read instead of streaming from youtube
+        :param format_policy: how to choose the format to stream, defaults to `FormatPolicy()`
+        """
+        super().__init__(sample_fps, grayscale, seek_ahead)
         self._url = video_url
-        self._info = self.__get_vid_info()
-        self._format = self.__find_format(resolution, subtype)
+        self._video_cache = video_cache
+        self._info = self.__get_vid_info(metadata_cache or get_default_cache())
+        if resolution is not None:
+            self._format = self.__find_format(resolution, subtype)
+        else:
+            self._format = self.__choose_format(format_policy or FormatPolicy())
 
-    def __get_vid_info(self):
-        ytdl_opts = {"quiet": True}
-        with YoutubeDL(ytdl_opts) as ydl:
-            info = ydl.extract_info(self._url, download=False)
-            return ydl.sanitize_info(info)
+    def __get_vid_info(self, metadata_cache: Optional[MetadataCache]):
+        if metadata_cache is None:
+            return fetch_video_info(self._url)
+        return metadata_cache.video_info(self._url)
 
     def __find_format(self, resolution, subtype):
         formats = self._info['formats']
@@ -134,17 +476,76 @@ class YoutubeFrameSource(FrameSource):
             raise VideoProcessingException(f"Failed to process {self._info['id']}, no worthy streams found. "
                                            f"Available streams were: {[f['format'] for f in formats]}")
 
+    def __choose_format(self, policy: FormatPolicy) -> dict:
+        formats = self._info['formats']
+        fmt = policy.select(formats)
+        if fmt is None:
+            raise VideoProcessingException(f"Failed to process {self._info['id']}, no streamable video formats. "
+                                           f"Available formats were: {[f.get('format_id') for f in formats]}")
+        if not policy.verify_samples:
+            return fmt
+
+        # If the board isn't found in any format, the video probably doesn't have one, so the cheapest format will do
+        chosen = fmt
+        for _ in range(policy.max_upgrades + 1):
+            board_px = self.__measure_board(fmt, policy.verify_samples)
+            if board_px is not None:
+                chosen = fmt
+                if board_px >= policy.min_board_px:
+                    break
+            fmt = policy.upgrade(formats, fmt, board_px)
+            if fmt is None:
+                break
+        log.debug(f"Chose format {chosen.get('format_id')} ({chosen['height']}p) for {self._info['id']}")
+        return chosen
+
+    def __measure_board(self, fmt: dict, n_samples: int) -> Optional[int]:
+        """
+        :return: the size in pixels of the biggest board found in `n_samples` frames of a format, or None if none were
+          found
+        """
+        self._format = fmt
+        board_px = None
+        try:
+            for _, img in self.sample_frames(n_samples):
+                corners = findChessboardCorners(img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_RGB2GRAY))
+                if corners is not None:
+                    board_px = max(board_px or 0, int(min(corners[2] - corners[0], corners[3] - corners[1])))
+        except Exception:
+            log.exception(f"Failed to sample format {fmt.get('format_id')} of {self._info['id']}")
+        return board_px
+
     @cache
     def __len__(self):
         return self._info['duration']
 
-    @cached_property
+    @property
+    def duration_sec(self) -> float:
+        return self._info['duration']
+
+    @property
+    def stream_format(self) -> dict:
+        """
+        The format (from the yt-dlp info dict) that is streamed
+        """
+        return self._format
+
+    @property
     def _source(self) -> str:
+        if self._video_cache is not None:
+            local_path = self._video_cache.get(self.video_id, self._format)
+            if local_path is not None:
+                log.info(f"Reading {self.video_id} from prefetched file {local_path}")
+                return str(local_path)
         return self._format['url']
 
-    @cached_property
+    @property
     def fps(self) -> float:
-        return self._format['fps']
+        return self._format.get('fps') or 30
+
+    @property
+    def frame_shape(self) -> tuple[int, int]:
+        return self._format['height'], self._format['width']
 
     @cached_property
     def video_id(self) -> str:
@@ -170,6 +571,21 @@ class YoutubeFrameSource(FrameSource):
     def channel_id(self):
         return self._info['channel_id']
 
+    @property
+    def channel_name(self) -> str:
+        return self._info.get('channel') or self._info['uploader']
+
+
+def youtube_stream_format(video_url: str) -> tuple[str, dict]:
+    """
+    Find the video id and the format that a `YoutubeFrameSource` would stream for a url, eg. for `Prefetcher`
+
+    The format isn't verified, since that takes several seeks into the stream. If verifying it makes the frame source
+      upgrade to a bigger format, that one is streamed rather than read from the download
+    """
+    frame_source = YoutubeFrameSource(video_url, format_policy=replace(PROCESSING_FORMAT_POLICY, verify_samples=0))
+    return frame_source.video_id, frame_source.stream_format
+
 
 class FileFrameSource(FrameSource):
     """
@@ -180,6 +596,10 @@ class FileFrameSource(FrameSource):
     def channel_id(self) -> str:
         return "test-channel"
 
+    @property
+    def channel_name(self) -> str:
+        return "test-channel"
+
     @property
     def channel_url(self) -> str:
         return "http://example.com"
@@ -194,8 +614,9 @@ class FileFrameSource(FrameSource):
 
     file_path: str
 
-    def __init__(self, file_path: str):
-        super().__init__()
+    def __init__(self, file_path: str, sample_fps: Optional[float] = None, grayscale: bool = False,
+                 seek_ahead: Optional[SeekAhead] = None):
+        super().__init__(sample_fps, grayscale, seek_ahead)
         self.file_path = file_path
 
     def __len__(self) -> int:
@@ -210,6 +631,11 @@ class FileFrameSource(FrameSource):
     def fps(self):
         return 30
 
+    @cached_property
+    def frame_shape(self) -> tuple[int, int]:
+        cap = cv2.VideoCapture(self._source)
+        return int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+
     @property
     def video_id(self) -> str:
         return "testvideo"
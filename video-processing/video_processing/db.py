@@ -1,13 +1,23 @@
 import logging
+import threading as thd
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
 
 from sqlalchemy import (create_engine,
-                        Column, String, ForeignKey, Integer, Float, select)
+                        Column, String, ForeignKey, Integer, Float, select, insert)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.engine import Engine, URL
 from sqlalchemy.orm import Session, declarative_base, relationship
 
+from video_processing import metrics
+
 log = logging.getLogger("video_processing")
 
 _engine: Engine
+# Channels that are known to be in the DB already, so that saving them again doesn't need a round trip
+_saved_channel_ids: set[str] = set()
 
 Base = declarative_base()
 
@@ -59,20 +69,57 @@ class PositionSighting(Base):
     video = relationship("Video", back_populates="position_sightings")
 
 
-def init_sqlite_db() -> Engine:
+class NoBoardVideo(Base):
+    """
+    A video that the prescan (see `prescan`) found no chessboard in. It only has a metadata row in `videos`, and is
+      never processed
+    """
+    __tablename__ = "no_board_videos"
+
+    video_id = Column(ForeignKey("videos.id"), primary_key=True)
+    # Number of frames that were checked for a board
+    frames_checked = Column(Integer, nullable=False)
+
+
+class VideoJob(Base):
+    """
+    A video waiting to be (or being) processed by one of the workers sharing the queue, see `job_queue`
+    """
+    __tablename__ = "video_jobs"
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    id = Column(Integer, primary_key=True)
+    url = Column(String, nullable=False, unique=True)
+    status = Column(String, nullable=False, default=QUEUED, index=True)
+    worker_id = Column(String)
+    # Unix time the current lease runs out, unless the worker renews it first
+    lease_expires_at = Column(Float)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+
+
+def init_sqlite_db(reset: bool = True, path: Path = Path("testdata.sqlite")) -> Engine:
     """
     Drops everything in a sqlite DB (if it already existed), and recreates
-    the schema from scratch. The sqlite db is created on disk at ./testdata.sqlite
+    the schema from scratch. The sqlite db is created on disk at ./testdata.sqlite unless another `path` is given
 
     must be called from the main process
 
+    :param reset: if False, keep whatever is already in the DB and only create the tables that are missing. Needed
+      when several commands share the DB, eg. `enqueue` and `worker`
     :return: A sqlalchemy Engine (for use in tests)
     """
     global _engine
-    log.info("Initializing fresh sqlite DB at ./testdata.sqlite")
-    _engine = create_engine("sqlite+pysqlite:///testdata.sqlite")
+    log.info(f"Initializing {'fresh ' if reset else ''}sqlite DB at {path}")
+    _engine = create_engine(f"sqlite+pysqlite:///{path}")
+    _saved_channel_ids.clear()
     metadata = Base.metadata
-    metadata.drop_all(_engine)
+    if reset:
+        metadata.drop_all(_engine)
     metadata.create_all(_engine)
     log.debug("sqlite DB bootstrapped successfully")
     return _engine
@@ -100,11 +147,31 @@ def init_postgres_db(hostname, port, username, password, dbname):
                      port=port,
                      database=dbname)
     _engine = create_engine(url)
+    _saved_channel_ids.clear()
     log.debug("Creating schema")
     Base.metadata.create_all(_engine)
     log.debug("postgres DB engine bootstrapped successfully")
 
 
+def get_engine() -> Engine:
+    """
+    The engine of the DB set up by `init_sqlite_db` or `init_postgres_db`
+    """
+    return _engine
+
+
+def _insert_ignoring_conflicts(table, index_elements: list[str]):
+    """
+    Build an `INSERT ... ON CONFLICT DO NOTHING` statement for the current DB
+
+    :param table: the mapped class to insert into
+    :param index_elements: the columns of the unique index that conflicts are detected on
+    """
+    dialect = postgresql if _engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(table).on_conflict_do_nothing(index_elements=index_elements)
+
+
+@metrics.timed('db_save_channel')
 def save_channel(id: str, channel_name: str, channel_url: str):
     """
     Persist a channel to the database if it doesn't already exist there. If the channel is already there,
@@ -117,13 +184,18 @@ def save_channel(id: str, channel_name: str, channel_url: str):
     :param channel_url: channel url
     :return: None
     """
+    if id in _saved_channel_ids:
+        return
     with Session(_engine) as session:
-        if session.get(Channel, id) is None:
+        result = session.execute(_insert_ignoring_conflicts(Channel, ["id"])
+                                 .values(id=id, channel_name=channel_name, channel_url=channel_url))
+        if result.rowcount:
             log.info(f"Persisting new channel: {id}")
-            session.add(Channel(id=id, channel_name=channel_name, channel_url=channel_url))
-            session.commit()
+        session.commit()
+    _saved_channel_ids.add(id)
 
 
+@metrics.timed('db_save_video', items=1)
 def save_video(video_id: str, channel_id: str, title: str, thumbnail_url: str, views: int, length: float):
     """
     Persist a video to the database if it isn't already there. If the video is there already then simply return
@@ -139,13 +211,13 @@ def save_video(video_id: str, channel_id: str, title: str, thumbnail_url: str, v
     :return: None
     """
     with Session(_engine) as session:
-        if session.get(Video, video_id) is None:
-            channel: Channel = session.get(Channel, channel_id)
-            video = Video(id=video_id, title=title, thumbnail_url=thumbnail_url, views=views, length=length)
-            channel.videos.append(video)
-            session.commit()
+        session.execute(_insert_ignoring_conflicts(Video, ["id"])
+                        .values(id=video_id, channel_id=channel_id, title=title, thumbnail_url=thumbnail_url,
+                                views=views, length=length))
+        session.commit()
 
 
+@metrics.timed('db_save_position_sighting', items=1)
 def save_position_sighting(video_id: str, fen: str, sec_into_video: float):
     """
     Persist a record of a position sighting to the database. The corresponding position and video records
@@ -170,6 +242,232 @@ def save_position_sighting(video_id: str, fen: str, sec_into_video: float):
         session.commit()
 
 
+class _LRUCache(OrderedDict):
+    """
+    A dict that holds at most `max_size` entries, evicting the least recently used ones first
+    """
+
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.max_size = max_size
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+class PositionSightingWriter:
+    """
+    Write-behind sink for position sightings. Sightings are buffered in memory, and written to the DB by a background
+    thread in bulk: the positions are upserted with a single statement, and all the sightings are inserted with
+    another. Position ids are cached by fen, so positions that were seen recently don't need to be looked up at all.
+
+    The buffer is flushed once it holds `max_buffered` sightings, `flush_interval` seconds after the first sighting
+    in it was added, and on `close`. Sightings that fail to be written stay buffered, and are retried every
+    `flush_interval` seconds (or on the next `flush`). `flush` and `close` raise the error if they fail to write
+    everything.
+    """
+    max_buffered: int
+    flush_interval: float
+    # Number of sightings written to the DB so far
+    written: int
+    _position_ids: _LRUCache
+    _buffer: list[dict]
+    _closed: bool
+    _flush_requested: bool
+    _flushed_generation: int
+    _requested_generation: int
+    _error: Optional[Exception]
+
+    # Max number of fens in a single `IN (...)` clause
+    _chunk_size = 500
+
+    def __init__(self, max_buffered: int = 256, flush_interval: float = 5.0, fen_cache_size: int = 100_000,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param max_buffered: number of buffered sightings that triggers a flush
+        :param flush_interval: max number of seconds a sighting stays buffered
+        :param fen_cache_size: max number of fen -> position id mappings to cache
+        :param clock: the time in seconds that `flush_interval` is measured with
+        """
+        self.max_buffered = max_buffered
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._clock = clock
+        self._position_ids = _LRUCache(fen_cache_size)
+        self._buffer = []
+        self._buffer_started = 0.0
+        self._closed = False
+        self._flush_requested = False
+        self._flushed_generation = 0
+        self._requested_generation = 0
+        self._error = None
+        self._condition = thd.Condition()
+        self._thread = thd.Thread(target=self._run, daemon=True, name="sighting-writer")
+        self._thread.start()
+
+    def add(self, video_id: str, fen: str, sec_into_video: float):
+        """
+        Buffer a position sighting. Returns immediately, the sighting is written later by the background thread
+        """
+        with self._condition:
+            if self._closed:
+                raise ValueError("Can't add a sighting to a closed writer")
+            if not self._buffer:
+                # wake up the background thread so that it starts the flush_interval countdown
+                self._buffer_started = self._clock()
+                self._condition.notify_all()
+            self._buffer.append({"video_id": video_id, "fen": fen, "sec_into_video": sec_into_video})
+            if len(self._buffer) >= self.max_buffered:
+                self._condition.notify_all()
+
+    def flush(self):
+        """
+        Block until everything that has been added so far is written to the DB
+
+        :raises Exception: whatever writing them failed with. They stay buffered, to be retried
+        """
+        with self._condition:
+            self._requested_generation += 1
+            generation = self._requested_generation
+            self._flush_requested = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._flushed_generation >= generation or not self._thread.is_alive())
+            self._raise_error()
+
+    def close(self):
+        """
+        Flush the remaining sightings, and stop the background thread
+
+        :raises Exception: whatever writing them failed with, in which case they're lost
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        with self._condition:
+            self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"Failed to persist {len(self._buffer)} position sightings") from self._error
+
+    def _should_flush(self) -> bool:
+        if self._closed or self._flush_requested:
+            return True
+        if not self._buffer:
+            return False
+        # After a failed write, the sightings are only retried once the interval is up
+        return (len(self._buffer) >= self.max_buffered and self._error is None) or \
+            self._clock() - self._buffer_started >= self.flush_interval
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._should_flush():
+                    timeout = None
+                    if self._buffer:
+                        timeout = max(0.0, self._buffer_started + self.flush_interval - self._clock())
+                    self._condition.wait(timeout)
+                sightings, self._buffer = self._buffer, []
+                generation = self._requested_generation
+                self._flush_requested = False
+                closed = self._closed
+
+            error = None
+            if sightings:
+                try:
+                    self._write(sightings)
+                except Exception as e:
+                    log.exception(f"Failed to persist {len(sightings)} position sightings")
+                    error = e
+
+            with self._condition:
+                if error is not None:
+                    # Put them back in front of whatever was added in the meantime, and start the countdown to the
+                    # retry
+                    self._buffer[:0] = sightings
+                    self._buffer_started = self._clock()
+                elif sightings:
+                    self.written += len(sightings)
+                self._error = error
+                self._flushed_generation = generation
+                self._condition.notify_all()
+            if closed:
+                return
+
+    def _write(self, sightings: list[dict]):
+        position_ids = {}
+        for fen in {s["fen"] for s in sightings}:
+            position_id = self._position_ids.get(fen)
+            if position_id is not None:
+                position_ids[fen] = position_id
+        uncached_fens = list({s["fen"] for s in sightings} - position_ids.keys())
+
+        with metrics.timed('db_write_sightings', items=len(sightings)), Session(_engine) as session:
+            for i in range(0, len(uncached_fens), self._chunk_size):
+                chunk = uncached_fens[i:i + self._chunk_size]
+                session.execute(_insert_ignoring_conflicts(Position, ["fen"]), [{"fen": fen} for fen in chunk])
+                for position_id, fen in session.execute(select(Position.id, Position.fen)
+                                                        .where(Position.fen.in_(chunk))):
+                    position_ids[fen] = position_id
+                    self._position_ids[fen] = position_id
+
+            session.execute(insert(PositionSighting), [{"video_id": s["video_id"],
+                                                        "position_id": position_ids[s["fen"]],
+                                                        "sec_into_video": s["sec_into_video"]} for s in sightings])
+            session.commit()
+        log.debug(f"Persisted {len(sightings)} position sightings ({len(uncached_fens)} uncached positions)")
+
+
+@metrics.timed('db_save_no_board_video', items=1)
+def save_no_board_video(video_id: str, frames_checked: int):
+    """
+    Record that the prescan didn't find a board in a video. The video must already be in the DB
+
+    must be called from the main process
+
+    :param video_id: id of the video
+    :param frames_checked: number of frames the prescan checked
+    """
+    with Session(_engine) as session:
+        session.execute(_insert_ignoring_conflicts(NoBoardVideo, ["video_id"])
+                        .values(video_id=video_id, frames_checked=frames_checked))
+        session.commit()
+
+
+def no_board_video_ids() -> list[str]:
+    """
+    Get the ids of all the videos that the prescan found no board in
+
+    must be called from the main process
+    """
+    with Session(_engine) as session:
+        return list(session.execute(select(NoBoardVideo.video_id)).scalars().all())
+
+
+def video_sightings(video_id: str) -> list[tuple[str, float]]:
+    """
+    Get the (fen, sec into video) of every position sighting in a video, in the order they appear in it
+
+    must be called from the main process
+    """
+    with Session(_engine) as session:
+        return [(fen, sec_into_video) for fen, sec_into_video in
+                session.execute(select(Position.fen, PositionSighting.sec_into_video)
+                                .join(PositionSighting.position)
+                                .where(PositionSighting.video_id == video_id)
+                                .order_by(PositionSighting.sec_into_video))]
+
+
 def all_processed_video_ids() -> list[str]:
     """
     Get a list of all video id's in the database
@@ -182,3 +480,25 @@ def all_processed_video_ids() -> list[str]:
         ret = list(session.execute(select(Video.id)).scalars().all())
         log.debug(f"All {len(ret)} previously processed video id's received")
         return ret
+
+
+def enqueue_video_urls(video_urls: list[str], chunk_size: int = 1000) -> int:
+    """
+    Add videos to the job queue shared by the workers. Urls that have been queued before are ignored, whatever state
+      their job is in
+
+    :return: the number of jobs that were added
+    """
+    video_urls = list(dict.fromkeys(video_urls))
+    added = 0
+    with Session(_engine) as session:
+        for i in range(0, len(video_urls), chunk_size):
+            chunk = video_urls[i:i + chunk_size]
+            # The rowcount of a bulk insert isn't reliable across drivers, so count the urls that are already there
+            already_queued = set(session.execute(select(VideoJob.url).where(VideoJob.url.in_(chunk))).scalars())
+            session.execute(_insert_ignoring_conflicts(VideoJob, ["url"]),
+                            [{"url": url, "status": VideoJob.QUEUED, "attempts": 0} for url in chunk])
+            added += len(chunk) - len(already_queued)
+        session.commit()
+    log.info(f"Queued {added} of {len(video_urls)} videos")
+    return added
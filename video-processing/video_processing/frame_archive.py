@@ -0,0 +1,180 @@
+import json
+import logging
+from functools import cached_property
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+
+from video_processing import metrics
+from video_processing.data_loading import FrameSource
+
+log = logging.getLogger(__name__)
+
+# Bumped whenever the layout of an archive changes, so old ones are refused rather than misread
+ARCHIVE_VERSION = 2
+_FRAMES_FILE = 'frames.u8'
+_INDEX_FILE = 'index.npy'
+_HEADER_FILE = 'header.json'
+# What's known about the video, saved so that an archive can stand in for its frame source
+_METADATA = ['video_id', 'title', 'channel_id', 'channel_name', 'channel_url', 'thumbnail_url', 'views']
+
+
+def record_frame_archive(frame_source: FrameSource, path: Path, stop_after_frames: Optional[int] = None) -> int:
+    """
+    Stream a video from any grayscale frame source into a frame archive directory at `path`, to be replayed by
+      `ArchiveFrameSource`. Only the frames the source outputs are kept, so with `sample_fps` or `seek_ahead` the
+      archive is smaller, but replays can't output anything in between
+
+    :return: the number of frames recorded
+    """
+    if not frame_source.grayscale:
+        raise ValueError("Only grayscale frame sources can be recorded")
+    path.mkdir(parents=True, exist_ok=True)
+    height, width = frame_source.frame_shape
+    frame_nums = []
+    with open(path / _FRAMES_FILE, 'wb') as frames_file:
+        for sec_into_video, img in frame_source.iter_frames(stop_after_frames):
+            if img.shape != (height, width):
+                raise ValueError(f"Frame {len(frame_nums)} of {frame_source.video_id} is {img.shape[1]}x"
+                                 f"{img.shape[0]} rather than {width}x{height}")
+            frames_file.write(np.ascontiguousarray(img).data)
+            frame_nums.append(round(sec_into_video * frame_source.fps))
+            if frame_source.seek_ahead is not None:
+                # Nothing else is looking for the board in the frames
+                frame_source.report_board(sec_into_video, frame_source.seek_ahead.has_board(img))
+
+    np.save(path / _INDEX_FILE, np.array(frame_nums, dtype=np.int64))
+    header = {
+        'version': ARCHIVE_VERSION,
+        'fps': frame_source.fps,
+        'height': height,
+        'width': width,
+        'frames': len(frame_nums),
+        # Not the length, which is in seconds for some frame sources and in frames for others
+        'duration_sec': frame_source.duration_sec,
+        **{name: getattr(frame_source, name) for name in _METADATA},
+    }
+    # Written last, so an archive with a header is always complete
+    (path / _HEADER_FILE).write_text(json.dumps(header, indent=2))
+    log.info(f"Recorded {len(frame_nums)} frames of {frame_source.video_id} to {path}")
+    return len(frame_nums)
+
+
+class ArchiveFrameSource(FrameSource):
+    """
+    Replays the frames recorded by `record_frame_archive`: fixed-size grayscale frames in a memory-mapped file, with
+      an index of the frame number of each of them. Nothing is decoded, so profiling and A/B runs of the board finder
+      and the network see exactly the same frames every time, without the cost of downloading and decoding them
+    """
+    path: Path
+
+    def __init__(self, path: Path, sample_fps: Optional[float] = None):
+        """
+        :param sample_fps: only output the recorded frames that would have been output with this `sample_fps`. Frames
+          that weren't recorded can't be output, so it should be no higher than the one the archive was recorded with
+        """
+        super().__init__(sample_fps, grayscale=True)
+        self.path = Path(path)
+        if self._header.get('version') != ARCHIVE_VERSION:
+            raise ValueError(f"{self.path} is a version {self._header.get('version')} frame archive, only version "
+                             f"{ARCHIVE_VERSION} can be read")
+
+    def __getstate__(self):
+        # Memory maps can't be pickled, each process maps the archive for itself
+        state = super().__getstate__()
+        state.pop('_frames', None)
+        state.pop('_frame_nums', None)
+        return state
+
+    @cached_property
+    def _header(self) -> dict:
+        return json.loads((self.path / _HEADER_FILE).read_text())
+
+    @cached_property
+    def _frames(self) -> np.ndarray:
+        shape = (self._header['frames'], *self.frame_shape)
+        if not shape[0]:
+            # An empty file can't be mapped
+            return np.zeros(shape, dtype=np.uint8)
+        return np.memmap(self.path / _FRAMES_FILE, dtype=np.uint8, mode='r', shape=shape)
+
+    @cached_property
+    def _frame_nums(self) -> np.ndarray:
+        return np.load(self.path / _INDEX_FILE)
+
+    def stream_frames(self, stop_after_frames: Optional[int] = None, start_frame: int = 0) -> None:
+        """
+        Output the recorded frames from `start_frame` on, the same way as `FrameSource.stream_frames`
+        """
+        try:
+            frame_nums = self._frame_nums
+            first = int(np.searchsorted(frame_nums, start_frame))
+            end = len(frame_nums) if stop_after_frames is None else \
+                int(np.searchsorted(frame_nums, stop_after_frames))
+            self.current_frame = start_frame
+            for i in range(first, end):
+                if not self.running:
+                    break
+                if frame_nums[i] % self.frame_stride != 0:
+                    continue
+                self.current_frame = int(frame_nums[i])
+                with metrics.timed('decode', items=1):
+                    img = self._frames[i]
+                self.img_output_queue.put(img, self.current_sec_into_video)
+                self.current_frame += 1
+        finally:
+            self.img_output_queue.put(None, self.current_sec_into_video)
+
+    def sample_frames(self, n_samples: int) -> Iterator[tuple[float, np.ndarray]]:
+        frame_nums = self._frame_nums
+        for i in range(n_samples if len(frame_nums) else 0):
+            idx = int((i + .5) * len(frame_nums) / n_samples)
+            yield frame_nums[idx] / self.fps, np.array(self._frames[idx])
+
+    def __len__(self) -> int:
+        return round(self.duration_sec * self.fps)
+
+    @property
+    def duration_sec(self) -> float:
+        return self._header['duration_sec']
+
+    @property
+    def _source(self) -> str:
+        return str(self.path)
+
+    @property
+    def fps(self) -> float:
+        return self._header['fps']
+
+    @property
+    def frame_shape(self) -> tuple[int, int]:
+        return self._header['height'], self._header['width']
+
+    @property
+    def video_id(self) -> str:
+        return self._header['video_id']
+
+    @property
+    def title(self) -> str:
+        return self._header['title']
+
+    @property
+    def channel_url(self) -> str:
+        return self._header['channel_url']
+
+    @property
+    def thumbnail_url(self) -> str:
+        return self._header['thumbnail_url']
+
+    @property
+    def views(self) -> int:
+        return self._header['views']
+
+    @property
+    def channel_id(self) -> str:
+        return self._header['channel_id']
+
+    @property
+    def channel_name(self) -> str:
+        return self._header['channel_name']
@@ -0,0 +1,253 @@
+import fcntl
+import logging
+import os
+import socket
+import threading as thd
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import Session
+
+from video_processing.db import VideoJob, get_engine
+
+log = logging.getLogger(__name__)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+@dataclass(frozen=True)
+class ClaimedJob:
+    id: int
+    url: str
+    # Including this claim
+    attempts: int
+
+
+class JobQueue(ABC):
+    """
+    Abstract strategy class for handing out the videos in the `video_jobs` table to workers, which may be spread
+      across several nodes.
+
+    Claiming a job leases it to the worker for `lease_sec` seconds, and the worker must keep renewing the lease with
+      `heartbeat` (`holding` does this in the background) until it marks the job complete or failed. If a worker
+      crashes, its lease runs out and the job goes to the next worker that claims one. A job is given out at most
+      `max_attempts` times before it's marked failed
+    """
+    worker_id: str
+    lease_sec: float
+    max_attempts: int
+
+    def __init__(self, worker_id: Optional[str] = None, lease_sec: float = 60.0, max_attempts: int = 3):
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_sec = lease_sec
+        self.max_attempts = max_attempts
+
+    @abstractmethod
+    def claim(self) -> Optional[ClaimedJob]:
+        """
+        Lease the next job that is queued, or whose previous lease ran out
+
+        :return: the claimed job, or None if there's nothing to do right now
+        """
+        pass
+
+    @abstractmethod
+    def heartbeat(self, job: ClaimedJob) -> bool:
+        """
+        Renew the lease on a job
+
+        :return: False if the lease had already run out and the job was claimed by another worker
+        """
+        pass
+
+    def complete(self, job: ClaimedJob):
+        self._finish(job, VideoJob.DONE, None)
+
+    def fail(self, job: ClaimedJob, error: str):
+        """
+        Put a job back on the queue to be retried, or mark it failed if it has run out of attempts
+        """
+        status = VideoJob.FAILED if job.attempts >= self.max_attempts else VideoJob.QUEUED
+        log.warning(f"Job {job.id} ({job.url}) failed on attempt {job.attempts}, marking it {status}: {error}")
+        self._finish(job, status, error)
+
+    @contextmanager
+    def holding(self, job: ClaimedJob):
+        """
+        Keep renewing the lease on a job in a background thread for the duration of the block
+        """
+        stopped = thd.Event()
+
+        def renew():
+            while not stopped.wait(self.lease_sec / 3):
+                try:
+                    if not self.heartbeat(job):
+                        log.warning(f"Lost the lease on job {job.id} ({job.url}), another worker has claimed it")
+                        return
+                except Exception:
+                    log.exception(f"Failed to renew the lease on job {job.id}")
+
+        heartbeat_thread = thd.Thread(target=renew, name=f"heartbeat-{job.id}", daemon=True)
+        heartbeat_thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            heartbeat_thread.join()
+
+    def _finish(self, job: ClaimedJob, status: str, error: Optional[str]):
+        with Session(get_engine()) as session:
+            result = session.execute(update(VideoJob)
+                                     .where(VideoJob.id == job.id, VideoJob.worker_id == self.worker_id)
+                                     .values(status=status, error=error, lease_expires_at=None))
+            session.commit()
+        if result.rowcount == 0:
+            log.warning(f"Job {job.id} ({job.url}) was claimed by another worker before it was marked {status}")
+
+
+class PostgresJobQueue(JobQueue):
+    """
+    Claims jobs with `SELECT ... FOR UPDATE SKIP LOCKED`, so that any number of workers can claim at once without
+      blocking each other or claiming the same job. Leases are tracked in the `lease_expires_at` column
+    """
+
+    def claim(self) -> Optional[ClaimedJob]:
+        now = time.time()
+        claimable = (select(VideoJob)
+                     .where(or_(VideoJob.status == VideoJob.QUEUED,
+                                and_(VideoJob.status == VideoJob.RUNNING, VideoJob.lease_expires_at < now)))
+                     .order_by(VideoJob.id)
+                     .limit(1)
+                     .with_for_update(skip_locked=True))
+        with Session(get_engine()) as session:
+            while (job := session.execute(claimable).scalars().first()) is not None:
+                if job.attempts < self.max_attempts:
+                    break
+                log.warning(f"Job {job.id} ({job.url}) ran out of attempts, marking it failed")
+                job.status = VideoJob.FAILED
+                job.error = "Lease expired too many times"
+                session.flush()
+
+            if job is not None:
+                job.status = VideoJob.RUNNING
+                job.worker_id = self.worker_id
+                job.lease_expires_at = now + self.lease_sec
+                job.attempts += 1
+                job = ClaimedJob(job.id, job.url, job.attempts)
+            session.commit()
+        return job
+
+    def heartbeat(self, job: ClaimedJob) -> bool:
+        with Session(get_engine()) as session:
+            result = session.execute(update(VideoJob)
+                                     .where(VideoJob.id == job.id,
+                                            VideoJob.worker_id == self.worker_id,
+                                            VideoJob.status == VideoJob.RUNNING)
+                                     .values(lease_expires_at=time.time() + self.lease_sec))
+            session.commit()
+        return result.rowcount == 1
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    SQLite has no row locks, so claims are serialized with an exclusive lock on a file in `lease_dir`. Each running
+      job has a lease file in there too, holding the id of the worker that claimed it, and the lease runs out when the
+      file hasn't been touched for `lease_sec` seconds. Only works for workers on the same node (or on a filesystem
+      with working `flock`), which is all a SQLite DB is good for anyway
+    """
+    lease_dir: Path
+
+    def __init__(self, lease_dir: Path = Path("video_job_leases"), **kwargs):
+        super().__init__(**kwargs)
+        self.lease_dir = Path(lease_dir)
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+
+    def _lease_path(self, job_id: int) -> Path:
+        return self.lease_dir / f"{job_id}.lease"
+
+    def _lease_expired(self, job_id: int) -> bool:
+        try:
+            return self._lease_path(job_id).stat().st_mtime + self.lease_sec < time.time()
+        except FileNotFoundError:
+            return True
+
+    @contextmanager
+    def _claim_lock(self):
+        with open(self.lease_dir / ".claim.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def claim(self) -> Optional[ClaimedJob]:
+        with self._claim_lock(), Session(get_engine()) as session:
+            running = session.execute(select(VideoJob)
+                                      .where(VideoJob.status == VideoJob.RUNNING)
+                                      .order_by(VideoJob.id)).scalars().all()
+            candidates = [job for job in running if self._lease_expired(job.id)]
+            for job in candidates:
+                if job.attempts >= self.max_attempts:
+                    log.warning(f"Job {job.id} ({job.url}) ran out of attempts, marking it failed")
+                    job.status = VideoJob.FAILED
+                    job.error = "Lease expired too many times"
+            candidates = [job for job in candidates if job.status == VideoJob.RUNNING]
+            if not candidates:
+                candidates = session.execute(select(VideoJob)
+                                             .where(VideoJob.status == VideoJob.QUEUED)
+                                             .order_by(VideoJob.id)
+                                             .limit(1)).scalars().all()
+
+            claimed = None
+            if candidates:
+                job = candidates[0]
+                self._write_lease(job.id)
+                job.status = VideoJob.RUNNING
+                job.worker_id = self.worker_id
+                job.lease_expires_at = time.time() + self.lease_sec
+                job.attempts += 1
+                claimed = ClaimedJob(job.id, job.url, job.attempts)
+            session.commit()
+        return claimed
+
+    def _write_lease(self, job_id: int):
+        tmp_path = self.lease_dir / f"{job_id}.lease.{self.worker_id}.tmp"
+        tmp_path.write_text(self.worker_id)
+        os.replace(tmp_path, self._lease_path(job_id))
+
+    def heartbeat(self, job: ClaimedJob) -> bool:
+        with self._claim_lock():
+            lease_path = self._lease_path(job.id)
+            try:
+                if lease_path.read_text() != self.worker_id:
+                    return False
+            except FileNotFoundError:
+                return False
+            os.utime(lease_path)
+            return True
+
+    def _finish(self, job: ClaimedJob, status: str, error: Optional[str]):
+        with self._claim_lock():
+            super()._finish(job, status, error)
+            try:
+                if self._lease_path(job.id).read_text() == self.worker_id:
+                    self._lease_path(job.id).unlink()
+            except FileNotFoundError:
+                pass
+
+
+def create_job_queue(**kwargs) -> JobQueue:
+    """
+    Create the right kind of queue for the DB that has been set up, passing any arguments through to it
+    """
+    if get_engine().dialect.name == "postgresql":
+        kwargs.pop("lease_dir", None)
+        return PostgresJobQueue(**kwargs)
+    return SqliteJobQueue(**kwargs)
@@ -1,16 +1,32 @@
 import logging
 import multiprocessing as mp
+import threading as thd
+import time
+from functools import partial
 from multiprocessing.pool import ThreadPool as Pool
+from typing import TYPE_CHECKING, Optional
 
-import pytube
 import typer
 from tqdm import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 from pathlib import Path
 
-from video_processing.data_loading import YoutubeFrameSource
-from video_processing.db import init_sqlite_db, init_postgres_db, save_video, save_channel, all_processed_video_ids
-from video_processing.video_processing_task import VideoProcessingTask
+from video_processing import metrics
+from video_processing.db import init_sqlite_db, init_postgres_db, save_video, save_channel, all_processed_video_ids, \
+    enqueue_video_urls
+from video_processing.job_queue import JobQueue, create_job_queue, default_worker_id
+from video_processing.metadata_cache import youtube_video_id
+from video_processing.prefetch import Prefetcher, VideoFileCache
+from video_processing.scheduling import BatchProgress, fetch_durations, longest_first_order
+from video_processing.tensorflow.inference_backends import DEFAULT_BACKEND, MIN_QUANTIZED_AGREEMENT, \
+    export_numpy_weights
+from video_processing.warm_workers import WarmWorkerPool
+
+# Everything that decodes video or runs inference (OpenCV, TensorFlow etc.) is imported by the commands that need it,
+# so that the CLI starts quickly for the ones that don't. See tests/test_startup.py
+if TYPE_CHECKING:
+    from video_processing.data_loading import YoutubeFrameSource
+    from video_processing.pipeline import PipelineConfig
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger('video_processing')
@@ -19,37 +35,157 @@ log.setLevel(logging.INFO)
 
 app = typer.Typer()
 in_progress_tasks = set()
+# Processes that stream the tiles of one video after another, rather than one being started for every video
+warm_workers = WarmWorkerPool()
 
+# Imported once by the forkserver, rather than by every process started from it
+FORKSERVER_PRELOAD = ['video_processing.video_processing_task', 'video_processing.pipeline']
 
-def video_processing_task_wrapper(vid_url: str):
-    try:
-        frame_source = YoutubeFrameSource(vid_url)
-        vid = frame_source.yt_video
-        chan = pytube.Channel(vid.channel_url)
-        save_channel(chan.channel_id, chan.channel_name, chan.channel_url)
-        log.info(f"Starting processing {vid.title}")
-        save_video(vid.video_id, vid.channel_id, vid.title, vid.thumbnail_url, vid.views, vid.length)
-
-        with tqdm(total=len(frame_source), smoothing=.2) as bar:
-            bar.set_description(vid_url)
-            task = VideoProcessingTask(frame_source)
-            in_progress_tasks.add(task)
-            task.run(lambda: bar.update(1))
+
+@app.callback()
+def startup(ctx: typer.Context):
+    """
+    Extract the chess positions shown in youtube videos
+    """
+    # forkserver must be used because processes will be forked from other threads. It's set up here rather than under
+    # __main__ so that it's also used when the CLI is run through its entry point, unless whatever is running the CLI
+    # has already chosen how processes are started
+    if mp.get_start_method(allow_none=True) is None:
+        mp.set_start_method('forkserver')
+        mp.set_forkserver_preload(FORKSERVER_PRELOAD)
+    ctx.call_on_close(warm_workers.close)
+
+
+def create_task(frame_source: 'YoutubeFrameSource', segment_sec: Optional[float] = None, segment_workers: int = 4,
+                coarse_scale: Optional[float] = None):
+    """
+    The task to process a video with, which splits it into segments if `segment_sec` is given and the video is at least
+      two segments long
+    """
+    from video_processing.video_processing_task import SegmentedVideoProcessingTask, VideoProcessingTask
+
+    if segment_sec and frame_source.duration_sec >= 2 * segment_sec:
+        return SegmentedVideoProcessingTask(frame_source, segment_sec=segment_sec, workers=segment_workers,
+                                            worker_pool=warm_workers, coarse_scale=coarse_scale)
+    return VideoProcessingTask(frame_source, worker_pool=warm_workers, coarse_scale=coarse_scale)
+
+
+def process_video(vid_url: str, sample_fps: Optional[float] = None, video_cache: Optional[VideoFileCache] = None,
+                  seek_ahead: bool = False, segment_sec: Optional[float] = None, segment_workers: int = 4,
+                  progress: Optional[BatchProgress] = None, coarse_scale: Optional[float] = None):
+    from video_processing.data_loading import PROCESSING_FORMAT_POLICY, SeekAhead, YoutubeFrameSource
+
+    frame_source = YoutubeFrameSource(vid_url, sample_fps=sample_fps, grayscale=True, video_cache=video_cache,
+                                      seek_ahead=SeekAhead() if seek_ahead else None,
+                                      format_policy=PROCESSING_FORMAT_POLICY)
+    save_channel(frame_source.channel_id, frame_source.channel_name, frame_source.channel_url)
+    log.info(f"Starting processing {frame_source.title}")
+    save_video(frame_source.video_id, frame_source.channel_id, frame_source.title, frame_source.thumbnail_url,
+               frame_source.views, len(frame_source))
+
+    # Each frame output stands for `frame_stride` frames of the video
+    sec_per_frame = frame_source.frame_stride / frame_source.fps
+
+    def frame_processed():
+        bar.update(1)
+        if progress is not None:
+            progress.advance(vid_url, sec_per_frame)
+
+    with tqdm(total=len(frame_source), smoothing=.2) as bar:
+        bar.set_description(vid_url)
+        task = create_task(frame_source, segment_sec, segment_workers, coarse_scale)
+        in_progress_tasks.add(task)
+        try:
+            task.run(frame_processed)
+        finally:
             in_progress_tasks.remove(task)
+
+
+def video_processing_task_wrapper(vid_url: str, sample_fps: Optional[float] = None,
+                                  prefetcher: Optional[Prefetcher] = None, seek_ahead: bool = False,
+                                  segment_sec: Optional[float] = None, segment_workers: int = 4,
+                                  progress: Optional[BatchProgress] = None, coarse_scale: Optional[float] = None):
+    if prefetcher is not None:
+        prefetcher.started(vid_url)
+    try:
+        process_video(vid_url, sample_fps, prefetcher.cache if prefetcher is not None else None, seek_ahead,
+                      segment_sec, segment_workers, progress, coarse_scale)
     except Exception:
         log.exception(f"Failed to process video {vid_url}")
+    finally:
+        if progress is not None:
+            progress.finished(vid_url)
+
 
+def drain_job_queue(job_queue: JobQueue, stopping: thd.Event, sample_fps: Optional[float], poll_interval: float,
+                    exit_when_empty: bool, seek_ahead: bool = False, prescan: bool = False,
+                    segment_sec: Optional[float] = None, segment_workers: int = 4,
+                    coarse_scale: Optional[float] = None):
+    """
+    Claim and process videos from the shared queue one at a time, until it's empty (if `exit_when_empty`) or
+      `stopping` is set
+    """
+    from video_processing.prescan import prescan_video
 
-def process_videos(video_urls, threads, bar_description):
+    while not stopping.is_set():
+        job = job_queue.claim()
+        if job is None:
+            if exit_when_empty:
+                return
+            stopping.wait(poll_interval)
+            continue
+
+        log.info(f"Claimed job {job.id} ({job.url}), attempt {job.attempts}")
+        with job_queue.holding(job):
+            if prescan and not prescan_video(job.url):
+                job_queue.complete(job)
+                continue
+            try:
+                process_video(job.url, sample_fps, seek_ahead=seek_ahead, segment_sec=segment_sec,
+                              segment_workers=segment_workers, coarse_scale=coarse_scale)
+            except Exception as e:
+                log.exception(f"Failed to process video {job.url}")
+                job_queue.fail(job, repr(e))
+                continue
+        if stopping.is_set():
+            # The task was stopped part way through, so leave the lease to run out and the job to be retried
+            return
+        job_queue.complete(job)
+
+
+def report_eta(channel_bar: tqdm, progress: Optional[BatchProgress]):
+    if progress is None:
+        return
+    eta_sec = progress.eta_sec()
+    if eta_sec is not None:
+        eta = time.strftime('%H:%M:%S', time.gmtime(eta_sec)) if eta_sec < 24 * 3600 else f"{eta_sec / 3600:0.0f}h"
+        channel_bar.set_postfix(eta=eta)
+        log.info(f"{progress.processed_sec / 3600:0.1f} of {progress.total_sec / 3600:0.1f} hours of video done, "
+                 f"about {eta} to go")
+
+
+def process_videos(video_urls, threads, bar_description, sample_fps: Optional[float] = None,
+                   prefetcher: Optional[Prefetcher] = None, seek_ahead: bool = False,
+                   segment_sec: Optional[float] = None, segment_workers: int = 4,
+                   progress: Optional[BatchProgress] = None, coarse_scale: Optional[float] = None):
+    """
+    Process videos `threads` at a time. Each thread takes the next video in `video_urls` as soon as it's done with its
+      last one, so the order they're listed in decides how evenly the work is spread
+    """
     with logging_redirect_tqdm():
         with tqdm(total=len(video_urls), smoothing=0) as channel_bar:
             channel_bar.set_description(bar_description)
             with Pool(threads) as pool:
-                video_processing_task_completions = pool.imap(video_processing_task_wrapper, video_urls)
+                task_wrapper = partial(video_processing_task_wrapper, sample_fps=sample_fps, prefetcher=prefetcher,
+                                       seek_ahead=seek_ahead, segment_sec=segment_sec,
+                                       segment_workers=segment_workers, progress=progress,
+                                       coarse_scale=coarse_scale)
+                video_processing_task_completions = pool.imap_unordered(task_wrapper, video_urls)
                 try:
                     log.info("All tasks have been queued...")
                     for _ in video_processing_task_completions:
                         channel_bar.update(1)
+                        report_eta(channel_bar, progress)
                 except KeyboardInterrupt:
                     log.info("Closing pool and stopping in-progress tasks")
                     pool.terminate()
@@ -59,6 +195,29 @@ def process_videos(video_urls, threads, bar_description):
                     pool.join()
 
 
+def process_videos_pipeline(video_urls, bar_description, config: 'PipelineConfig',
+                            prefetcher: Optional[Prefetcher] = None, progress: Optional[BatchProgress] = None):
+    from video_processing.pipeline import VideoPipeline, unique_videos
+
+    video_urls = unique_videos(video_urls)
+    with logging_redirect_tqdm():
+        with tqdm(total=len(video_urls), smoothing=0) as channel_bar:
+            channel_bar.set_description(bar_description)
+
+            def video_done(video_url: str):
+                channel_bar.update(1)
+                if progress is not None:
+                    progress.finished(video_url)
+                    report_eta(channel_bar, progress)
+
+            pipeline = VideoPipeline(config)
+            try:
+                pipeline.run(video_urls, video_done, prefetcher.started if prefetcher is not None else None)
+            except KeyboardInterrupt:
+                log.info("Stopping pipeline workers")
+                pipeline.stop()
+
+
 @app.command()
 def video(url: str,
           db_hostname: str = typer.Option("localhost", envvar="DB_HOSTNAME"),
@@ -66,16 +225,48 @@ def video(url: str,
           db_password: str = typer.Option(..., prompt=True, hide_input=True, envvar="DB_PASSWORD"),
           db_port: int = typer.Option(default=5432, envvar="DB_PORT"),
           db_name: str = typer.Option("postgres", envvar="DB_NAME"),
-          sqlite_db: bool = typer.Option(False)):
+          sqlite_db: bool = typer.Option(False),
+          sample_fps: Optional[float] = typer.Option(None, help="Only decode this many frames per second"),
+          seek_ahead: bool = typer.Option(False, help="Seek past stretches of video without a chessboard "
+                                                      "instead of decoding every frame"),
+          prescan: bool = typer.Option(False, help="Skip videos that no chessboard is found in when "
+                                                   "checking a few frames spread through them"),
+          segment_sec: Optional[float] = typer.Option(None, help="Process long videos as segments of about "
+                                                                 "this many seconds at once"),
+          segment_workers: int = typer.Option(4, help="Max number of segments of a video processed at once"),
+          coarse_scale: Optional[float] = typer.Option(None, help="Look for the chessboard in frames downscaled by "
+                                                                  "this factor (eg. 0.5) first, then only refine "
+                                                                  "its corners at full resolution"),
+          inference_backend: str = typer.Option(DEFAULT_BACKEND, envvar="INFERENCE_BACKEND"),
+          metrics_dir: Optional[Path] = typer.Option(None, envvar="METRICS_DIR",
+                                                     help="Periodically export metrics from every process to this "
+                                                          "directory, in the Prometheus text format and as JSON"),
+          metrics_interval: float = typer.Option(10.0, help="Seconds between metrics exports")):
+    """
+    Extract the positions from a youtube video, or replay a frame archive made by `record` if URL is its directory
+    """
+    from video_processing.data_loading import PROCESSING_FORMAT_POLICY, SeekAhead, YoutubeFrameSource
+    from video_processing.frame_archive import ArchiveFrameSource
+    from video_processing.prescan import prescan_video
+    from video_processing.tensorflow import frame_analyzer
+
+    frame_analyzer.set_backend(inference_backend)
+    metrics.configure(metrics_dir, metrics_interval)
     if sqlite_db:
         init_sqlite_db()
     else:
         init_postgres_db(db_hostname, db_port, db_username, db_password, db_name)
 
-    frame_source = YoutubeFrameSource(url)
+    if Path(url).is_dir():
+        frame_source = ArchiveFrameSource(Path(url), sample_fps=sample_fps)
+    else:
+        if prescan and not prescan_video(url):
+            return
+        frame_source = YoutubeFrameSource(url, sample_fps=sample_fps, grayscale=True,
+                                          seek_ahead=SeekAhead() if seek_ahead else None,
+                                          format_policy=PROCESSING_FORMAT_POLICY)
     log.info(f"Processing video: {frame_source.title}")
-    channel = pytube.Channel(frame_source.channel_url)
-    save_channel(channel.channel_id, channel.channel_name, channel.channel_url)
+    save_channel(frame_source.channel_id, frame_source.channel_name, frame_source.channel_url)
     save_video(frame_source.video_id,
                frame_source.channel_id,
                frame_source.title,
@@ -83,9 +274,9 @@ def video(url: str,
                frame_source.views,
                int(len(frame_source) / frame_source.fps))
 
-    with logging_redirect_tqdm():
+    with logging_redirect_tqdm(), metrics.exporting("main"):
         with tqdm(total=len(frame_source), smoothing=.1) as bar:
-            task = VideoProcessingTask(frame_source)
+            task = create_task(frame_source, segment_sec, segment_workers, coarse_scale)
             task.run(lambda: bar.update(1))
 
 
@@ -121,19 +312,271 @@ def urls_file(path: Path,
               db_password: str = typer.Option(..., prompt=True, hide_input=True, envvar="DB_PASSWORD"),
               db_port: int = typer.Option(default=5432, envvar="DB_PORT"),
               db_name: str = typer.Option("postgres", envvar="DB_NAME"),
-              sqlite_db: bool = typer.Option(False)):
+              sqlite_db: bool = typer.Option(False),
+              sample_fps: Optional[float] = typer.Option(None, help="Only decode this many frames per second"),
+              seek_ahead: bool = typer.Option(False, help="Seek past stretches of video without a chessboard "
+                                                          "instead of decoding every frame"),
+              prescan: bool = typer.Option(False, help="Skip videos that no chessboard is found in when "
+                                                       "checking a few frames spread through them"),
+              segment_sec: Optional[float] = typer.Option(None, help="Process long videos as segments of about "
+                                                                     "this many seconds at once"),
+              segment_workers: int = typer.Option(4, help="Max number of segments of a video processed at once"),
+              coarse_scale: Optional[float] = typer.Option(None, help="Look for the chessboard in frames downscaled "
+                                                                      "by this factor (eg. 0.5) first, then only "
+                                                                      "refine its corners at full resolution"),
+              longest_first: bool = typer.Option(True, "--longest-first/--file-order",
+                                                 help="Process the longest videos first, so that the batch doesn't "
+                                                      "end with a few long videos holding it up"),
+              inference_backend: str = typer.Option(DEFAULT_BACKEND, envvar="INFERENCE_BACKEND"),
+              pipeline: bool = typer.Option(False, help="Use the staged multi-process pipeline, in which case THREADS "
+                                                        "is ignored in favour of the per-stage worker counts"),
+              decode_workers: int = typer.Option(2, help="Pipeline decoder processes"),
+              locate_workers: int = typer.Option(4, help="Pipeline chessboard locator processes"),
+              batch_size: int = typer.Option(32, help="Pipeline inference batch size"),
+              prefetch: int = typer.Option(0, help="Download this many videos ahead of the ones being processed"),
+              video_cache_dir: Path = typer.Option(Path("video_cache"), help="Where prefetched videos are kept"),
+              video_cache_gb: float = typer.Option(20.0, help="Max size of the prefetched videos"),
+              metrics_dir: Optional[Path] = typer.Option(None, envvar="METRICS_DIR",
+                                                         help="Periodically export metrics from every process to this "
+                                                              "directory, in the Prometheus text format and as JSON"),
+              metrics_interval: float = typer.Option(10.0, help="Seconds between metrics exports")):
+    from video_processing.data_loading import youtube_stream_format
+    from video_processing.pipeline import PipelineConfig
+    from video_processing.prescan import prescan_videos
+    from video_processing.tensorflow import frame_analyzer
+
+    metrics.configure(metrics_dir, metrics_interval)
     if sqlite_db:
         init_sqlite_db()
     else:
         init_postgres_db(db_hostname, db_port, db_username, db_password, db_name)
 
     with open(path) as f:
-        video_urls = f.read().split('\n')
-    process_videos(video_urls, threads, str(path))
+        video_urls = [url.strip() for url in f if url.strip()]
+    prefetcher = None
+    try:
+        # The prescan and the duration lookups are exported along with the processing
+        with metrics.exporting("main"):
+            if prescan:
+                # Only the videos that pass get prefetched and scheduled
+                video_urls = prescan_videos(video_urls, threads)
+            durations = fetch_durations(video_urls, threads)
+            if longest_first:
+                # Before prefetching, so the videos are downloaded in the order they're processed in
+                video_urls = longest_first_order(video_urls, durations)
+            if prefetch > 0:
+                video_cache = VideoFileCache(video_cache_dir, int(video_cache_gb * 1024 ** 3))
+                prefetcher = Prefetcher(video_urls, video_cache, youtube_stream_format, lookahead=prefetch).start()
+
+            if pipeline:
+                config = PipelineConfig(decode_workers=decode_workers, locate_workers=locate_workers,
+                                        batch_size=batch_size, sample_fps=sample_fps,
+                                        inference_backend=inference_backend,
+                                        video_cache_dir=str(video_cache_dir) if prefetcher is not None else None,
+                                        seek_ahead=seek_ahead, coarse_scale=coarse_scale)
+                progress = BatchProgress(durations, workers=decode_workers)
+                process_videos_pipeline(video_urls, str(path), config, prefetcher, progress)
+            else:
+                frame_analyzer.set_backend(inference_backend)
+                progress = BatchProgress(durations, workers=threads)
+                process_videos(video_urls, threads, str(path), sample_fps, prefetcher, seek_ahead, segment_sec,
+                               segment_workers, progress, coarse_scale)
+    finally:
+        if prefetcher is not None:
+            prefetcher.stop()
+
+
+@app.command()
+def enqueue(path: Path,
+            db_hostname: str = typer.Option("localhost", envvar="DB_HOSTNAME"),
+            db_username: str = typer.Option("postgres", envvar="DB_USERNAME"),
+            db_password: str = typer.Option(..., prompt=True, hide_input=True, envvar="DB_PASSWORD"),
+            db_port: int = typer.Option(default=5432, envvar="DB_PORT"),
+            db_name: str = typer.Option("postgres", envvar="DB_NAME"),
+            sqlite_db: bool = typer.Option(False)):
+    """
+    Add the videos in a urls file to the queue shared by the workers, skipping any that have already been processed
+    """
+    if sqlite_db:
+        init_sqlite_db(reset=False)
+    else:
+        init_postgres_db(db_hostname, db_port, db_username, db_password, db_name)
+
+    with open(path) as f:
+        video_urls = [url.strip() for url in f if url.strip()]
+    processed_video_ids = set(all_processed_video_ids())
+    new_urls = [url for url in video_urls if youtube_video_id(url) not in processed_video_ids]
+    log.info(f"Skipping {len(video_urls) - len(new_urls)} videos that have already been processed")
+    enqueue_video_urls(new_urls)
+
+
+@app.command()
+def worker(threads: int = typer.Option(1, help="Number of videos to process at once"),
+           db_hostname: str = typer.Option("localhost", envvar="DB_HOSTNAME"),
+           db_username: str = typer.Option("postgres", envvar="DB_USERNAME"),
+           db_password: str = typer.Option(..., prompt=True, hide_input=True, envvar="DB_PASSWORD"),
+           db_port: int = typer.Option(default=5432, envvar="DB_PORT"),
+           db_name: str = typer.Option("postgres", envvar="DB_NAME"),
+           sqlite_db: bool = typer.Option(False),
+           sample_fps: Optional[float] = typer.Option(None, help="Only decode this many frames per second"),
+           seek_ahead: bool = typer.Option(False, help="Seek past stretches of video without a chessboard "
+                                                       "instead of decoding every frame"),
+           prescan: bool = typer.Option(False, help="Skip videos that no chessboard is found in when "
+                                                    "checking a few frames spread through them"),
+           segment_sec: Optional[float] = typer.Option(None, help="Process long videos as segments of about "
+                                                                  "this many seconds at once"),
+           segment_workers: int = typer.Option(4, help="Max number of segments of a video processed at once"),
+           coarse_scale: Optional[float] = typer.Option(None, help="Look for the chessboard in frames downscaled by "
+                                                                   "this factor (eg. 0.5) first, then only refine its "
+                                                                   "corners at full resolution"),
+           inference_backend: str = typer.Option(DEFAULT_BACKEND, envvar="INFERENCE_BACKEND"),
+           lease_sec: float = typer.Option(60.0, help="Seconds a claimed video is held for without a heartbeat"),
+           max_attempts: int = typer.Option(3, help="Times a video is claimed before it's marked failed"),
+           lease_dir: Path = typer.Option(Path("video_job_leases"), help="Where SQLite leases are kept"),
+           poll_interval: float = typer.Option(10.0, help="Seconds to wait before checking an empty queue again"),
+           exit_when_empty: bool = typer.Option(False, help="Exit once the queue is empty, rather than waiting for "
+                                                            "more videos"),
+           metrics_dir: Optional[Path] = typer.Option(None, envvar="METRICS_DIR",
+                                                      help="Periodically export metrics from every process to this "
+                                                           "directory, in the Prometheus text format and as JSON"),
+           metrics_interval: float = typer.Option(10.0, help="Seconds between metrics exports")):
+    """
+    Process videos from the queue shared with the workers on other nodes
+    """
+    from video_processing.tensorflow import frame_analyzer
+
+    frame_analyzer.set_backend(inference_backend)
+    metrics.configure(metrics_dir, metrics_interval)
+    if sqlite_db:
+        init_sqlite_db(reset=False)
+    else:
+        init_postgres_db(db_hostname, db_port, db_username, db_password, db_name)
+
+    # Each thread claims jobs as a worker of its own, so that none of them can renew or finish another one's job
+    job_queues = [create_job_queue(worker_id=f"{default_worker_id()}-{i}", lease_sec=lease_sec,
+                                   max_attempts=max_attempts, lease_dir=lease_dir)
+                  for i in range(threads)]
+    log.info(f"Starting workers {', '.join(job_queue.worker_id for job_queue in job_queues)}")
+    stopping = thd.Event()
+    drainers = [thd.Thread(target=drain_job_queue,
+                           args=(job_queue, stopping, sample_fps, poll_interval, exit_when_empty, seek_ahead,
+                                 prescan, segment_sec, segment_workers, coarse_scale),
+                           name=f"worker-{i}")
+                for i, job_queue in enumerate(job_queues)]
+    with logging_redirect_tqdm(), metrics.exporting("main"):
+        for drainer in drainers:
+            drainer.start()
+        try:
+            while any(drainer.is_alive() for drainer in drainers):
+                time.sleep(.5)
+        except KeyboardInterrupt:
+            log.info("Stopping in-progress tasks")
+            stopping.set()
+            for task in list(in_progress_tasks):
+                task.stop()
+            log.info("Waiting for remaining tasks to exit")
+            for drainer in drainers:
+                drainer.join()
+
+
+@app.command()
+def record(url: str,
+           out: Path = typer.Argument(..., help="Directory to write the frame archive to"),
+           sample_fps: Optional[float] = typer.Option(None, help="Only record this many frames per second"),
+           seek_ahead: bool = typer.Option(False, help="Leave out stretches of video without a chessboard"),
+           stop_after_sec: Optional[float] = typer.Option(None, help="Only record this many seconds of the video")):
+    """
+    Record the decoded frames of a youtube video into a frame archive, to replay them without downloading or decoding
+      them again (pass the archive's directory to `video`)
+    """
+    from video_processing.data_loading import PROCESSING_FORMAT_POLICY, SeekAhead, YoutubeFrameSource
+    from video_processing.frame_archive import record_frame_archive
+
+    frame_source = YoutubeFrameSource(url, sample_fps=sample_fps, grayscale=True,
+                                      seek_ahead=SeekAhead() if seek_ahead else None,
+                                      format_policy=PROCESSING_FORMAT_POLICY)
+    log.info(f"Recording video: {frame_source.title}")
+    stop_after_frames = round(stop_after_sec * frame_source.fps) if stop_after_sec is not None else None
+    record_frame_archive(frame_source, out, stop_after_frames)
+
+
+@app.command("export-numpy-weights")
+def export_numpy_weights_cmd(out_path: Optional[Path] = typer.Argument(None)):
+    """
+    Convert the frozen graph's weights into the format used by the numpy inference backend (needs tensorflow)
+    """
+    export_numpy_weights(weights_path=out_path)
+
+
+@app.command("quantize-model")
+def quantize_model_cmd(images: Path = typer.Option(Path("tests/test_images"), help="Directory of frames with "
+                                                                                   "boards in them to calibrate "
+                                                                                   "the quantized model with"),
+                       min_agreement: float = typer.Option(MIN_QUANTIZED_AGREEMENT, envvar="MIN_QUANTIZED_AGREEMENT",
+                                                           help="Fraction of squares the quantized model must label "
+                                                                "the same as the float model to be used")):
+    """
+    Make the int8 quantized model used by the int8 inference backend from the numpy weights, and check it against
+      the float model (needs tensorflow)
+    """
+    import numpy as np
+
+    from video_processing.synthetic_video import RUY_LOPEZ, fens_from_moves
+    from video_processing.tensorflow.quantization import save_quantized_model, tile_rows_from_fens, \
+        tile_rows_from_images
+
+    calibration_rows = tile_rows_from_images(sorted(images.glob("*.png")))
+    # Validated on boards it wasn't calibrated on as well
+    validation_rows = np.concatenate([calibration_rows, tile_rows_from_fens(fens_from_moves(RUY_LOPEZ))])
+    report = save_quantized_model(calibration_rows, validation_rows)
+    log.info(f"The quantized model labels {report.square_agreement:.2%} of {report.squares} squares and "
+             f"{report.board_agreement:.2%} of boards the same as the float model")
+    for label, agreement in report.label_agreement.items():
+        log.info(f"  {label}: {agreement:.2%}")
+    if report.square_agreement < min_agreement:
+        log.error(f"That's below the minimum of {min_agreement:.2%}, so the int8 backend won't use it")
+        raise typer.Exit(1)
+
+
+@app.command("benchmark")
+def benchmark_cmd(out: Path = typer.Option(Path("benchmark_results.json"), help="Where to save the results"),
+                  baseline: Optional[Path] = typer.Option(None, help="Results to compare with, the command fails if "
+                                                                     "any stage is slower or anything less accurate. "
+                                                                     "The baseline kept in the repo if not given"),
+                  save_baseline: bool = typer.Option(False, help="Save the results as the baseline rather than "
+                                                                 "comparing them with it"),
+                  tolerance: float = typer.Option(.2, help="Fraction by which a stage may be slower than the "
+                                                           "baseline without failing"),
+                  batch_size: int = typer.Option(8, help="Inference batch size"),
+                  coarse_scale: Optional[float] = typer.Option(None, help="Look for the chessboard coarse to fine, "
+                                                                          "see the video command"),
+                  work_dir: Optional[Path] = typer.Option(None, help="Keep the synthetic videos here, rather than "
+                                                                     "in a temporary directory"),
+                  inference_backend: str = typer.Option(DEFAULT_BACKEND, envvar="INFERENCE_BACKEND")):
+    """
+    Benchmark each stage of processing, and the whole of it, on synthetic videos with known positions (offline)
+    """
+    from video_processing.benchmark import BASELINE_PATH, compare_to_baseline, load_results, run_benchmarks, \
+        save_results, summary
+    from video_processing.tensorflow import frame_analyzer
+
+    frame_analyzer.set_backend(inference_backend)
+    results = run_benchmarks(work_dir=work_dir, batch_size=batch_size, coarse_scale=coarse_scale)
+    log.info(f"Benchmark results:\n{summary(results)}")
+    save_results(results, out)
+    baseline = baseline or BASELINE_PATH
+    if save_baseline:
+        save_results(results, baseline)
+        log.info(f"Saved the results as the baseline at {baseline}")
+        return
 
+    regressions = compare_to_baseline(results, load_results(baseline), tolerance)
+    for regression in regressions:
+        log.error(f"Regression: {regression}")
+    if regressions:
+        raise typer.Exit(1)
+    log.info(f"No regressions from the baseline at {baseline}")
 
 
 if __name__ == "__main__":
-    # forkserver must be used because processes will be forked from other threads
-    mp.set_start_method('forkserver')
     app()
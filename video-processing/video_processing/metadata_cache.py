@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import threading as thd
+import time
+from pathlib import Path
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+log = logging.getLogger(__name__)
+
+# Where the default cache lives, an empty value disables it
+CACHE_DIR_ENV = 'VIDEO_PROCESSING_CACHE_DIR'
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'video_processing'
+
+# The parts of an info dict that are used anywhere. The rest (captions, chapters, thumbnails in every size etc.) can
+#   be several MB per video
+_INFO_KEYS = ['id', 'title', 'channel', 'channel_id', 'channel_url', 'uploader', 'thumbnail', 'view_count',
+              'duration', 'fps', 'width', 'height', 'formats']
+# Formats are kept whole apart from these, which are large and unused
+_DROPPED_FORMAT_KEYS = ['fragments']
+
+
+def youtube_video_id(video_url: str) -> Optional[str]:
+    """
+    Pull the video id out of a youtube url without any network requests. Handles watch, short link, shorts and embed
+      urls
+
+    :return: the video id, or None if the url isn't recognized
+    """
+    parsed = urlparse(video_url.strip())
+    host = parsed.netloc.lower().removeprefix("www.").removeprefix("m.")
+    if host == "youtu.be":
+        return parsed.path.strip("/") or None
+    if host.endswith("youtube.com"):
+        if parsed.path == "/watch":
+            return parse_qs(parsed.query).get("v", [None])[0]
+        parts = parsed.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] in ("shorts", "embed", "live", "v"):
+            return parts[1]
+    return None
+
+
+def fetch_video_info(video_url: str) -> dict:
+    """
+    Fetch a video's info dict from youtube with yt-dlp
+    """
+    from yt_dlp import YoutubeDL
+
+    ytdl_opts = {"quiet": True}
+    with YoutubeDL(ytdl_opts) as ydl:
+        info = ydl.extract_info(video_url, download=False)
+        return ydl.sanitize_info(info)
+
+
+def _trim_info(info: dict) -> dict:
+    trimmed = {key: info[key] for key in _INFO_KEYS if key in info}
+    trimmed['formats'] = [{key: value for key, value in fmt.items() if key not in _DROPPED_FORMAT_KEYS}
+                          for fmt in info.get('formats', [])]
+    return trimmed
+
+
+class MetadataCache:
+    """
+    On-disk cache of video info dicts, keyed by video id, so that processing a video again, or looking at it in more
+      than one place, doesn't mean another round of requests to youtube. The details of a video's channel are in its
+      info dict, so they never need fetching separately. Safe to share between processes.
+
+    Video metadata is good for `ttl_sec`, but the stream urls in the formats expire after a few hours, so an entry is
+      only used for streaming within `stream_ttl_sec` of being fetched. The cache holds at most `max_entries` videos,
+      evicting the least recently used ones first whenever it's opened, and every so often as entries are written
+    """
+    directory: Path
+    ttl_sec: float
+    stream_ttl_sec: float
+    max_entries: int
+
+    # Evict entries after this many writes, rather than listing the directory on every write
+    _evict_every = 32
+
+    def __init__(self, directory: Path = DEFAULT_CACHE_DIR, ttl_sec: float = 7 * 24 * 3600,
+                 stream_ttl_sec: float = 3600, max_entries: int = 10_000,
+                 fetcher: Callable[[str], dict] = fetch_video_info):
+        """
+        :param fetcher: fetches the info dict of a video url on a cache miss, eg. to serve recorded info dicts in tests
+        """
+        self.directory = Path(directory)
+        self.ttl_sec = ttl_sec
+        self.stream_ttl_sec = stream_ttl_sec
+        self.max_entries = max_entries
+        self._fetcher = fetcher
+        self._writes = 0
+        (self.directory / 'videos').mkdir(parents=True, exist_ok=True)
+        # Most processes only write a few entries, so counting writes alone would let the cache grow without bound
+        self.evict()
+
+    def _video_path(self, video_id: str) -> Path:
+        return self.directory / 'videos' / f'{video_id}.json'
+
+    def video_info(self, video_url: str, need_streams: bool = True) -> dict:
+        """
+        Get the (trimmed) info dict of a video, fetching it if it isn't cached or is too old
+
+        :param need_streams: whether the stream urls in the formats are going to be used, in which case an entry is
+          only good for `stream_ttl_sec`
+        """
+        video_id = youtube_video_id(video_url)
+        if video_id is not None:
+            entry = self._read(self._video_path(video_id))
+            max_age = self.stream_ttl_sec if need_streams else self.ttl_sec
+            if entry is not None and time.time() - entry['fetched_at'] < max_age:
+                log.debug(f"Metadata cache hit for {video_id}")
+                return entry['info']
+
+        info = _trim_info(self._fetcher(video_url))
+        self._write(self._video_path(info['id']), {'fetched_at': time.time(), 'info': info})
+        self._writes += 1
+        if self._writes % self._evict_every == 0:
+            self.evict()
+        return info
+
+    def evict(self):
+        """
+        Delete the least recently used videos beyond `max_entries`
+        """
+        entries = []
+        for path in (self.directory / 'videos').glob('*.json'):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                # Evicted by another process in the meantime
+                pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            path.unlink(missing_ok=True)
+        log.debug(f"Evicted {len(entries) - self.max_entries} entries from the metadata cache")
+
+    def _read(self, path: Path) -> Optional[dict]:
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            # Reads count as a use for the LRU eviction
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, OSError):
+            log.warning(f"Ignoring unreadable metadata cache entry {path}")
+            return None
+
+    def _write(self, path: Path, entry: dict):
+        # Written to a temporary file and moved into place, so that other processes never see half an entry
+        tmp_path = path.with_suffix(f'.{os.getpid()}-{thd.get_ident()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+
+_default_cache: Optional[MetadataCache] = None
+
+
+def get_default_cache() -> Optional[MetadataCache]:
+    """
+    The cache used by `YoutubeFrameSource` unless it's given one, in the directory named by the
+      VIDEO_PROCESSING_CACHE_DIR environment variable (or ~/.cache/video_processing). None if caching is disabled
+    """
+    global _default_cache
+    directory = os.environ.get(CACHE_DIR_ENV, str(DEFAULT_CACHE_DIR))
+    if not directory:
+        return None
+    if _default_cache is None or _default_cache.directory != Path(directory):
+        _default_cache = MetadataCache(Path(directory))
+    return _default_cache
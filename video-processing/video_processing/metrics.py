@@ -0,0 +1,351 @@
+import bisect
+import json
+import logging
+import math
+import os
+import threading as thd
+import time
+from contextlib import ContextDecorator, contextmanager
+from multiprocessing import current_process
+from pathlib import Path
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# When set, every process that runs part of the pipeline periodically exports its metrics into this directory, as
+#   `<name>-<pid>.prom` (for the node_exporter textfile collector, removed when the process stops exporting) and
+#   `<name>.jsonl` (one JSON snapshot per line, shared by every process with the same name). Environment variables are
+#   inherited by worker processes however they're started
+METRICS_DIR_ENV = 'VIDEO_PROCESSING_METRICS_DIR'
+METRICS_INTERVAL_ENV = 'VIDEO_PROCESSING_METRICS_INTERVAL'
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+_PREFIX = 'video_processing_'
+_HELP = {
+    'stage_seconds': "Time spent in each stage of processing a frame (or a batch of frames)",
+    'items_total': "Number of items (frames, tiles, rows) that have gone through each stage",
+    'queue_occupancy': "Number of items waiting in each queue, sampled whenever an item is taken off it",
+    'queue_capacity': "Max number of items each queue can hold",
+}
+
+
+class Histogram:
+    """
+    Cumulative bucketed histogram, in the same shape Prometheus exposes it
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating within the bucket it falls in, like Prometheus' `histogram_quantile`
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else math.nan,
+            'p50': self.quantile(.5),
+            'p90': self.quantile(.9),
+            'p99': self.quantile(.99),
+        }
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, **extra) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms for the current process, keyed by metric name and labels. Thread safe
+    """
+
+    def __init__(self):
+        self._lock = thd.Lock()
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._gauges: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Current value of every metric, with histograms summarized as count, sum, mean and estimated quantiles
+        """
+        def series_dict(series, value_fn):
+            return [{'labels': dict(key), **value_fn(value)} for key, value in series.items()]
+
+        with self._lock:
+            return {
+                'counters': {name: series_dict(series, lambda v: {'value': v})
+                             for name, series in self._counters.items()},
+                'gauges': {name: series_dict(series, lambda v: {'value': v})
+                           for name, series in self._gauges.items()},
+                'histograms': {name: series_dict(series, Histogram.to_dict)
+                               for name, series in self._histograms.items()},
+            }
+
+    def prometheus_text(self, **const_labels) -> str:
+        """
+        Every metric in the Prometheus text exposition format
+
+        :param const_labels: labels to add to every series, eg. which process it's from
+        """
+        lines = []
+        const_key = tuple(const_labels.items())
+
+        def header(name, kind):
+            if name in _HELP:
+                lines.append(f'# HELP {_PREFIX}{name} {_HELP[name]}')
+            lines.append(f'# TYPE {_PREFIX}{name} {kind}')
+
+        with self._lock:
+            for name, series in self._counters.items():
+                header(name, 'counter')
+                lines += [f'{_PREFIX}{name}{_format_labels(key + const_key)} {value}' for key, value in series.items()]
+            for name, series in self._gauges.items():
+                header(name, 'gauge')
+                lines += [f'{_PREFIX}{name}{_format_labels(key + const_key)} {value}' for key, value in series.items()]
+            for name, series in self._histograms.items():
+                header(name, 'histogram')
+                for key, hist in series.items():
+                    key += const_key
+                    cumulative = 0
+                    for bound, n in zip(hist.buckets, hist.counts):
+                        cumulative += n
+                        lines.append(f'{_PREFIX}{name}_bucket{_format_labels(key, le=bound)} {cumulative}')
+                    lines.append(f'{_PREFIX}{name}_bucket{_format_labels(key, le="+Inf")} {hist.count}')
+                    lines.append(f'{_PREFIX}{name}_sum{_format_labels(key)} {hist.sum}')
+                    lines.append(f'{_PREFIX}{name}_count{_format_labels(key)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+# The process the registry's metrics were recorded in. A forked process inherits a copy of them from its parent
+_registry_pid = os.getpid()
+
+
+class timed(ContextDecorator):
+    """
+    Record the time spent in a block or function as a `stage_seconds` observation, and optionally count the items it
+      handled. Usable as a decorator or a context manager:
+
+        with metrics.timed('decode'):
+            ...
+    """
+
+    def __init__(self, stage: str, items: int = 0):
+        self.stage = stage
+        self.items = items
+
+    def _recreate_cm(self):
+        # A fresh instance per call, so a decorated function is safe to call from several threads at once
+        return timed(self.stage, self.items)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe('stage_seconds', time.perf_counter() - self._start, stage=self.stage)
+        if self.items:
+            registry.inc('items_total', self.items, stage=self.stage)
+        return False
+
+
+def count(stage: str, items: int = 1):
+    registry.inc('items_total', items, stage=stage)
+
+
+def record_queue(queue_name: str, occupancy: int, capacity: Optional[int] = None):
+    registry.set_gauge('queue_occupancy', occupancy, queue=queue_name)
+    if capacity is not None:
+        registry.set_gauge('queue_capacity', capacity, queue=queue_name)
+
+
+def _write_atomically(path: Path, text: str):
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+def _pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove_stale_prom_files(directory: Path):
+    """
+    Remove the `.prom` files of processes that died without removing their own
+    """
+    for path in directory.glob('*-*.prom'):
+        pid = path.stem.rsplit('-', 1)[1]
+        if pid.isdigit() and not _pid_exists(int(pid)):
+            path.unlink(missing_ok=True)
+
+
+class MetricsExporter:
+    """
+    Periodically writes the registry of the current process to `<name>-<pid>.prom`, with every series labelled with
+      the process it's from so that the files of several processes can be collected together, and appends a JSON
+      snapshot to `<name>.jsonl`. Snapshots include the per-second rate of every counter since the previous snapshot.
+      The `.prom` file is removed on `stop`, so that the metrics of processes that are gone aren't scraped
+    """
+
+    def __init__(self, directory: Path, name: str, interval: float = 10.0):
+        self.directory = Path(directory)
+        self.name = name
+        self.process = f'{name}-{os.getpid()}'
+        self.interval = interval
+        self._stop = thd.Event()
+        self._thread = thd.Thread(target=self._run, name=f"metrics-exporter-{name}", daemon=True)
+        self._last_counters: dict[tuple, float] = {}
+        self._last_time = time.time()
+
+    @property
+    def prom_path(self) -> Path:
+        return self.directory / f'{self.process}.prom'
+
+    def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        _remove_stale_prom_files(self.directory)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop exporting, after appending one final snapshot
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.prom_path.unlink(missing_ok=True)
+
+    def export(self):
+        now = time.time()
+        snapshot = registry.snapshot()
+        elapsed = max(now - self._last_time, 1e-9)
+        rates = {}
+        for name, series in snapshot['counters'].items():
+            rates[name] = []
+            for entry in series:
+                key = (name, _label_key(entry['labels']))
+                rates[name].append({'labels': entry['labels'],
+                                    'per_sec': (entry['value'] - self._last_counters.get(key, 0)) / elapsed})
+                self._last_counters[key] = entry['value']
+        self._last_time = now
+
+        _write_atomically(self.prom_path, registry.prometheus_text(process=self.process))
+        line = json.dumps({'time': now, 'process': self.name, 'pid': os.getpid(), 'rates': rates, **snapshot}) + '\n'
+        # Other processes append to the same file, so the line is written in a single call
+        fd = os.open(self.directory / f'{self.name}.jsonl', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._export_logging_errors()
+        self._export_logging_errors()
+
+    def _export_logging_errors(self):
+        try:
+            self.export()
+        except Exception:
+            log.exception(f"Failed to export metrics to {self.directory}")
+
+
+@contextmanager
+def exporting(name: Optional[str] = None):
+    """
+    Export this process' metrics for the duration of the block, if a metrics directory is configured in the
+      environment. Every process that does some of the work should run inside one of these, since metrics are only
+      ever recorded in the process they happen in
+    """
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        # A forked process starts with a copy of its parent's metrics, which aren't its own. Anything recorded in this
+        # process before now, or in earlier blocks, is kept
+        registry.clear()
+        _registry_pid = os.getpid()
+    directory = os.environ.get(METRICS_DIR_ENV)
+    if not directory:
+        yield
+        return
+
+    name = name or current_process().name
+    exporter = MetricsExporter(Path(directory), name, float(os.environ.get(METRICS_INTERVAL_ENV, 10.0)))
+    exporter.start()
+    try:
+        yield
+    finally:
+        exporter.stop()
+
+
+def configure(directory: Optional[Path], interval: float = 10.0):
+    """
+    Set the metrics directory (and export interval) for this process and every worker process started after this
+    """
+    if directory is None:
+        os.environ.pop(METRICS_DIR_ENV, None)
+    else:
+        os.environ[METRICS_DIR_ENV] = str(directory)
+        os.environ[METRICS_INTERVAL_ENV] = str(interval)
@@ -0,0 +1,451 @@
+import logging
+import multiprocessing as mp
+import queue
+import threading as thd
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Optional
+
+from video_processing import metrics
+from video_processing.data_loading import PROCESSING_FORMAT_POLICY, FrameSource, SeekAhead, YoutubeFrameSource
+from video_processing.db import PositionSightingWriter, save_channel, save_video
+from video_processing.metadata_cache import youtube_video_id
+from video_processing.prefetch import VideoFileCache
+from video_processing.tensorflow.chessboard_finder import ChessboardTracker, find_grayscale_tiles_in_image
+from video_processing.tensorflow.inference_backends import InferenceBackend
+from video_processing.video_processing_task import FenStabilizer
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class PipelineConfig:
+    decode_workers: int = 2
+    locate_workers: int = 4
+    batch_size: int = 32
+    batch_max_wait: float = 0.05
+    # Max number of items waiting between two stages
+    queue_depth: int = 64
+    sample_fps: Optional[float] = None
+    stability_sec: float = 0.3
+    # The name of a backend, or a backend (which is sent to the inference worker)
+    inference_backend: Optional[str | InferenceBackend] = None
+    # Where a `Prefetcher` downloads videos to, if one is running
+    video_cache_dir: Optional[str] = None
+    # Skip over stretches of video without a chessboard, see `SeekAhead`
+    seek_ahead: bool = False
+    # Search for the board coarse to fine, see `findChessboardCorners`
+    coarse_scale: Optional[float] = None
+
+
+# Messages on the results queue, about the video with the url they carry. Every frame of a video gets exactly one
+# FRAME message, and every video gets exactly one START (or FAILED) message and, if it started, one END message
+# carrying the number of frames in the video
+_START = "start"
+_FAILED = "failed"
+_FRAME = "frame"
+_END = "end"
+# How often the results stage checks on the workers when no results are coming in
+_POLL_SEC = 1.0
+
+# Makes the frame source of a video from its url, `sample_fps` and `seek_ahead`. It's called in the decode workers, so
+# must be picklable
+FrameSourceFactory = Callable[..., FrameSource]
+
+
+def _queue_size(q: mp.Queue) -> int:
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        # Not available on macOS
+        return -1
+
+
+def _youtube_frame_source(url: str, sample_fps: Optional[float], seek_ahead: Optional[SeekAhead],
+                          video_cache: Optional[VideoFileCache]) -> FrameSource:
+    return YoutubeFrameSource(url, sample_fps=sample_fps, grayscale=True, video_cache=video_cache,
+                              seek_ahead=seek_ahead, format_policy=PROCESSING_FORMAT_POLICY)
+
+
+def _report_boards(board_reports: mp.Queue, url: str, frame_source: FrameSource):
+    """
+    Pass on what the locators have found in the frames of the video being streamed so far, for its `seek_ahead`
+    """
+    while True:
+        try:
+            report_url, sec_into_video, found = board_reports.get_nowait()
+        except queue.Empty:
+            return
+        # Reports about an earlier video are left over from after it finished streaming
+        if report_url == url:
+            frame_source.report_board(sec_into_video, found)
+
+
+def _decode_worker(decoder: int, url_queue: mp.Queue, frame_queue: mp.Queue, results_queue: mp.Queue,
+                   board_reports: Optional[mp.Queue], sample_fps: Optional[float], video_cache_dir: Optional[str],
+                   seek_ahead: Optional[SeekAhead], frame_source_factory: Optional[FrameSourceFactory]):
+    with metrics.exporting():
+        _decode_videos(decoder, url_queue, frame_queue, results_queue, board_reports, sample_fps, video_cache_dir,
+                       seek_ahead, frame_source_factory)
+
+
+def _decode_videos(decoder: int, url_queue: mp.Queue, frame_queue: mp.Queue, results_queue: mp.Queue,
+                   board_reports: Optional[mp.Queue], sample_fps: Optional[float], video_cache_dir: Optional[str],
+                   seek_ahead: Optional[SeekAhead], frame_source_factory: Optional[FrameSourceFactory]):
+    """
+    :param decoder: the index of this decoder, which the locators send the `board_reports` of its frames by
+    :param board_reports: whether the locators found a board in each frame, as `(url, sec_into_video, found)`. Only
+      needed with `seek_ahead`
+    """
+    if frame_source_factory is None:
+        video_cache = VideoFileCache(video_cache_dir) if video_cache_dir is not None else None
+        frame_source_factory = partial(_youtube_frame_source, video_cache=video_cache)
+    while (url := url_queue.get()) is not None:
+        try:
+            frame_source = frame_source_factory(url, sample_fps=sample_fps, seek_ahead=seek_ahead)
+        except Exception as e:
+            log.exception(f"Failed to load video {url}")
+            results_queue.put((_FAILED, url, repr(e)))
+            continue
+
+        video_id = frame_source.video_id
+        results_queue.put((_START, url, mp.current_process().name, {
+            "video_id": video_id,
+            "channel_id": frame_source.channel_id,
+            "channel_name": frame_source.channel_name,
+            "channel_url": frame_source.channel_url,
+            "title": frame_source.title,
+            "thumbnail_url": frame_source.thumbnail_url,
+            "views": frame_source.views,
+            "length": len(frame_source),
+        }))
+
+        # The queue is created lazily, so it must exist before the streaming thread starts or both threads could
+        # create their own
+        img_queue = frame_source.img_output_queue
+        streaming_thread = thd.Thread(target=frame_source.stream_frames)
+        streaming_thread.start()
+        seq = 0
+        while True:
+            sec_into_video, img = img_queue.get()
+            metrics.record_queue('img_output_queue', _queue_size(img_queue), img_queue.slots)
+            if img is None:
+                break
+            elif isinstance(img, Exception):
+                log.error(f"Failed to stream video {video_id}: {img}")
+                break
+            # img is a view of the frame buffer, and the queue only pickles it later on in a background thread, so it
+            # must be copied out before its slot is released
+            frame_queue.put((url, seq, sec_into_video, img.copy(), decoder))
+            img_queue.release()
+            seq += 1
+            if board_reports is not None:
+                _report_boards(board_reports, url, frame_source)
+        streaming_thread.join()
+        img_queue.close()
+        results_queue.put((_END, url, seq))
+
+
+def _locate_worker(frame_queue: mp.Queue, tile_queue: mp.Queue, results_queue: mp.Queue,
+                   board_reports: Optional[list[mp.Queue]], queue_depth: int, coarse_scale: Optional[float]):
+    with metrics.exporting():
+        _locate_frames(frame_queue, tile_queue, results_queue, board_reports, queue_depth, coarse_scale)
+
+
+def _locate_frames(frame_queue: mp.Queue, tile_queue: mp.Queue, results_queue: mp.Queue,
+                   board_reports: Optional[list[mp.Queue]], queue_depth: int, coarse_scale: Optional[float]):
+    """
+    :param board_reports: the queues to tell each decoder whether there was a board in its frames on, by decoder index.
+      Only needed with `seek_ahead`
+    """
+    for reports in board_reports or []:
+        # The reports are only hints, and a decoder that has finished doesn't read them, so they mustn't hold up
+        # this process exiting
+        reports.cancel_join_thread()
+    # Frames of the same video usually land on the same few workers, so each keeps a tracker per video it has seen
+    # recently
+    trackers: dict[str, ChessboardTracker] = {}
+    while (item := frame_queue.get()) is not None:
+        url, seq, sec_into_video, frame, decoder = item
+        metrics.record_queue('frame_queue', _queue_size(frame_queue), queue_depth)
+        tracker = trackers.pop(url, None) or ChessboardTracker(coarse_scale=coarse_scale)
+        trackers[url] = tracker
+        if len(trackers) > 16:
+            trackers.pop(next(iter(trackers)))
+
+        try:
+            tiles, _ = find_grayscale_tiles_in_image(frame, tracker)
+        except Exception:
+            log.exception(f"Failed to locate the board in frame {seq} ({sec_into_video:0.3f}s) of video {url}")
+            tiles = None
+        if board_reports is not None:
+            board_reports[decoder].put((url, sec_into_video, tiles is not None))
+
+        if tiles is None:
+            # Nothing to infer, so skip the inference worker entirely
+            results_queue.put((_FRAME, url, seq, sec_into_video, None))
+        else:
+            tile_queue.put((url, seq, sec_into_video, tiles))
+
+
+def _inference_worker(tile_queue: mp.Queue, results_queue: mp.Queue, batch_size: int, batch_max_wait: float,
+                      inference_backend: Optional[str | InferenceBackend], queue_depth: int):
+    with metrics.exporting():
+        _infer_tiles(tile_queue, results_queue, batch_size, batch_max_wait, inference_backend, queue_depth)
+
+
+def _infer_tiles(tile_queue: mp.Queue, results_queue: mp.Queue, batch_size: int, batch_max_wait: float,
+                 inference_backend: Optional[str | InferenceBackend], queue_depth: int):
+    from video_processing.tensorflow import frame_analyzer
+    if inference_backend is not None:
+        frame_analyzer.set_backend(inference_backend)
+
+    done = False
+    while not done:
+        batch = []
+        deadline = None
+        while len(batch) < batch_size:
+            try:
+                if deadline is None:
+                    item = tile_queue.get()
+                    deadline = time.monotonic() + batch_max_wait
+                else:
+                    item = tile_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                done = True
+                break
+            batch.append(item)
+        metrics.record_queue('tile_queue', _queue_size(tile_queue), queue_depth)
+
+        fens = frame_analyzer.process_tiles_batch([tiles for _, _, _, tiles in batch])
+        for (url, seq, sec_into_video, _), fen in zip(batch, fens):
+            results_queue.put((_FRAME, url, seq, sec_into_video, fen))
+
+
+@dataclass
+class _VideoState:
+    """Results stage bookkeeping for a single video"""
+    stabilizer: FenStabilizer
+    # Set by the START message, which may arrive after some of the video's frames
+    video_id: Optional[str] = None
+    decoder: Optional[str] = None
+    next_seq: int = 0
+    n_frames: Optional[int] = None
+    pending: dict = field(default_factory=dict)
+
+
+def unique_videos(video_urls: list[str]) -> list[str]:
+    """
+    :return: the urls, without any that are for the same video as an earlier one (as far as can be told from the url)
+    """
+    by_video = {}
+    for url in video_urls:
+        by_video.setdefault(youtube_video_id(url) or url, url)
+    return list(by_video.values())
+
+
+class VideoPipeline:
+    """
+    Processes many videos at once with a pool of processes per stage:
+
+        decode workers -> locator workers -> inference worker -> results stage (in the calling process)
+
+    Decode workers stream whole videos, locator workers find the board in individual frames (from any video), and the
+      single inference worker batches tiles from every video in flight. Frames without a board skip the inference
+      worker. With `seek_ahead`, the locators tell each decoder whether they found a board in its frames, so the
+      decoders can skip ahead without looking for the board themselves. The results stage puts the frames of each
+      video back in order, applies the stability rule, and does all the DB writes, so the DB must already be
+      initialized. Every queue between stages is bounded, so a slow stage applies backpressure to the stages feeding
+      it
+
+    If a worker dies, the videos it leaves unfinished are failed: the ones a decode worker was streaming, or every
+      video left if it was a locator or the inference worker, since frames of any of them could have been lost
+    """
+    config: PipelineConfig
+    frame_source_factory: Optional[FrameSourceFactory]
+
+    def __init__(self, config: PipelineConfig, frame_source_factory: Optional[FrameSourceFactory] = None):
+        """
+        :param frame_source_factory: makes the frame source of each video, youtube videos are streamed if not given
+        """
+        self.config = config
+        self.frame_source_factory = frame_source_factory
+        self._url_queue = mp.Queue()
+        self._frame_queue = mp.Queue(config.queue_depth)
+        self._tile_queue = mp.Queue(config.queue_depth)
+        self._results_queue = mp.Queue(config.queue_depth)
+        # The videos in flight, by url
+        self._videos: dict[str, _VideoState] = {}
+        self._workers: list[mp.Process] = []
+
+    def run(self, video_urls: list[str], video_done_callback: Callable[[str], None] = None,
+            video_started_callback: Callable[[str], None] = None):
+        """
+        Process all the videos, blocking until they're done
+
+        :param video_urls: urls of the videos to process. Only the first url of each video is processed
+        :param video_done_callback: called with the url of each video when it's done (or failed)
+        :param video_started_callback: called with the url of each video when a decoder starts on it (or fails to)
+        """
+        config = self.config
+        video_urls = unique_videos(video_urls)
+        seek_ahead = SeekAhead(resolution_sec=config.stability_sec) if config.seek_ahead else None
+        board_reports = [mp.Queue() for _ in range(config.decode_workers)] if config.seek_ahead else None
+        decoders = [mp.Process(target=_decode_worker,
+                               args=(i, self._url_queue, self._frame_queue, self._results_queue,
+                                     board_reports[i] if board_reports is not None else None, config.sample_fps,
+                                     config.video_cache_dir, seek_ahead, self.frame_source_factory),
+                               name=f"decoder-{i}")
+                    for i in range(config.decode_workers)]
+        locators = [mp.Process(target=_locate_worker,
+                               args=(self._frame_queue, self._tile_queue, self._results_queue, board_reports,
+                                     config.queue_depth, config.coarse_scale),
+                               name=f"locator-{i}")
+                    for i in range(config.locate_workers)]
+        inference = mp.Process(target=_inference_worker,
+                               args=(self._tile_queue, self._results_queue, config.batch_size, config.batch_max_wait,
+                                     config.inference_backend, config.queue_depth),
+                               name="inference")
+        self._workers = decoders + locators + [inference]
+        for worker in self._workers:
+            worker.start()
+
+        for url in video_urls:
+            self._url_queue.put(url)
+        for _ in decoders:
+            self._url_queue.put(None)
+
+        writer = PositionSightingWriter()
+        # The videos that aren't done (or failed) yet
+        remaining = set(video_urls)
+        # Whether the workers can be shut down gracefully
+        healthy = False
+        next_check = time.monotonic() + _POLL_SEC
+        try:
+            while remaining:
+                try:
+                    message = self._results_queue.get(timeout=_POLL_SEC)
+                except queue.Empty:
+                    message = None
+                if message is None or time.monotonic() >= next_check:
+                    next_check = time.monotonic() + _POLL_SEC
+                    lost_urls, workers_ok = self._lost_videos(decoders, remaining, idle=message is None)
+                    for url in lost_urls:
+                        log.error(f"Failed to process video {url}: a worker died")
+                        remaining.discard(url)
+                        self._videos.pop(url, None)
+                        if video_done_callback is not None:
+                            video_done_callback(url)
+                    if not workers_ok:
+                        return
+                if message is None:
+                    continue
+                metrics.record_queue('results_queue', _queue_size(self._results_queue), config.queue_depth)
+
+                kind, url = message[:2]
+                if url not in remaining:
+                    # What's left of a video that was failed when a worker died
+                    continue
+                if kind == _FAILED:
+                    log.error(f"Failed to process video {url}: {message[2]}")
+                    remaining.discard(url)
+                    if video_started_callback is not None:
+                        video_started_callback(url)
+                    if video_done_callback is not None:
+                        video_done_callback(url)
+                    continue
+
+                state = self._state(url)
+                if kind == _START:
+                    _, _, state.decoder, video = message
+                    state.video_id = video["video_id"]
+                    self._start_video(video)
+                    if video_started_callback is not None:
+                        video_started_callback(url)
+                elif kind == _FRAME:
+                    _, _, seq, sec_into_video, fen = message
+                    state.pending[seq] = (sec_into_video, fen)
+                else:
+                    state.n_frames = message[2]
+
+                # The messages of a video come from several processes, so the START message may arrive last
+                if state.video_id is not None and self._drain(state, writer):
+                    log.info(f"Finished processing video {state.video_id}")
+                    del self._videos[url]
+                    remaining.discard(url)
+                    if video_done_callback is not None:
+                        video_done_callback(url)
+            healthy = True
+        finally:
+            self._videos.clear()
+            writer.close()
+            if healthy:
+                for worker in decoders:
+                    worker.join()
+                for _ in locators:
+                    self._frame_queue.put(None)
+                for worker in locators:
+                    worker.join()
+                self._tile_queue.put(None)
+                inference.join()
+            else:
+                # Whatever is left may be blocked on a queue that nothing reads from any more
+                self.stop()
+
+    def _lost_videos(self, decoders: list[mp.Process], remaining: set[str], idle: bool) -> tuple[list[str], bool]:
+        """
+        Check for workers that have died
+
+        :param idle: whether nothing has arrived on the results queue for a while, so that everything the workers that
+          have exited sent has been received
+        :return: the urls of the videos that can't be finished because of them, and whether the rest of the workers
+          can still finish the other videos
+        """
+        # Locators and the inference worker only stop when they're told to, and any frame could have been lost with them
+        dead = [worker.name for worker in self._workers if worker not in decoders and worker.exitcode is not None]
+        if dead:
+            log.error(f"{', '.join(dead)} died, failing every video that isn't done")
+            return list(remaining), False
+
+        crashed = {worker.name for worker in decoders if worker.exitcode not in (None, 0)}
+        lost = [url for url, state in self._videos.items() if state.decoder in crashed and state.n_frames is None]
+        if idle and all(worker.exitcode is not None for worker in decoders):
+            # A decoder that died may have taken a url off the queue without starting on it
+            lost += [url for url in remaining if url not in self._videos or self._videos[url].video_id is None]
+        return lost, True
+
+    def stop(self):
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    def _state(self, url: str) -> _VideoState:
+        if url not in self._videos:
+            self._videos[url] = _VideoState(FenStabilizer(self.config.stability_sec))
+        return self._videos[url]
+
+    def _start_video(self, video: dict):
+        save_channel(video["channel_id"], video["channel_name"], video["channel_url"])
+        save_video(video["video_id"], video["channel_id"], video["title"], video["thumbnail_url"], video["views"],
+                   video["length"])
+        log.info(f"Starting processing {video['title']}")
+
+    def _drain(self, state: _VideoState, writer: PositionSightingWriter) -> bool:
+        """
+        Feed the frames of a video that are now in order through the stability rule
+
+        :return: whether the video is done
+        """
+        while state.next_seq in state.pending:
+            sec_into_video, fen = state.pending.pop(state.next_seq)
+            state.next_seq += 1
+            if fen is None:
+                continue
+            sighting_sec = state.stabilizer.update(sec_into_video, fen)
+            if sighting_sec is not None:
+                writer.add(state.video_id, fen, sighting_sec)
+
+        return state.n_frames is not None and state.next_seq == state.n_frames
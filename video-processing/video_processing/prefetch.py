@@ -0,0 +1,232 @@
+import logging
+import os
+import threading as thd
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+from urllib.request import Request, urlopen
+
+log = logging.getLogger(__name__)
+
+_BLOCK_BYTES = 1 << 20
+# Protocols whose url is the video file itself. An HLS (m3u8) url is a playlist of segments
+_DOWNLOADABLE_PROTOCOLS = {None, 'http', 'https'}
+
+
+class VideoFileCache:
+    """
+    A directory of downloaded video streams, kept under `max_bytes` by evicting the least recently used files first.
+      Files are keyed by video id and format id, and only appear under their final name once they're complete, so
+      any process can safely look them up
+    """
+    directory: Path
+    max_bytes: int
+
+    def __init__(self, directory: Path, max_bytes: int = 20 * 1024 ** 3):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = thd.Lock()
+
+    def __getstate__(self):
+        # Frame sources take the cache with them to other processes. The lock only keeps evictions within one process
+        # from racing each other, so each process gets its own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = thd.Lock()
+
+    def path(self, video_id: str, fmt: dict) -> Path:
+        return self.directory / f"{video_id}-{fmt['format_id']}.{fmt.get('ext', 'mp4')}"
+
+    def get(self, video_id: str, fmt: dict) -> Optional[Path]:
+        """
+        :return: the local copy of a video stream, or None if it hasn't been (completely) downloaded
+        """
+        path = self.path(video_id, fmt)
+        try:
+            # Using a file counts towards keeping it for the LRU eviction
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def usage(self) -> int:
+        return sum(path.stat().st_size for path in self.directory.iterdir() if path.is_file())
+
+    def reserve(self, nbytes: int) -> bool:
+        """
+        Evict complete files, least recently used first, until `nbytes` more will fit in the budget
+
+        :return: whether there's room, which there never is for a file bigger than the whole budget
+        """
+        if nbytes > self.max_bytes:
+            return False
+        with self._lock:
+            files = []
+            used = 0
+            for path in self.directory.iterdir():
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                used += stat.st_size
+                # Partial downloads are counted, but belong to whoever is downloading them
+                if not path.name.endswith('.part'):
+                    files.append((stat.st_mtime, stat.st_size, path))
+            files.sort()
+            while used + nbytes > self.max_bytes and files:
+                _, size, path = files.pop(0)
+                log.debug(f"Evicting {path.name} from the video cache")
+                # Decoders that already have the file open keep reading it after it's unlinked
+                path.unlink(missing_ok=True)
+                used -= size
+            return used + nbytes <= self.max_bytes
+
+
+def _probe(url: str, headers: dict, timeout: float) -> tuple[Optional[int], bool]:
+    """
+    :return: the size of the resource (if known), and whether the server honours range requests
+    """
+    with urlopen(Request(url, headers={**headers, 'Range': 'bytes=0-0'}), timeout=timeout) as response:
+        if response.status == 206:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                return int(total), True
+        length = response.headers.get('Content-Length')
+        return (int(length) if length else None), False
+
+
+def _copy_response(response, f, expected_bytes: Optional[int] = None):
+    copied = 0
+    while block := response.read(_BLOCK_BYTES):
+        f.write(block)
+        copied += len(block)
+    if expected_bytes is not None and copied != expected_bytes:
+        raise IOError(f"Expected {expected_bytes} bytes, got {copied}")
+
+
+def _download_range(url: str, headers: dict, path: Path, start: int, end: int, timeout: float):
+    request = Request(url, headers={**headers, 'Range': f'bytes={start}-{end}'})
+    with urlopen(request, timeout=timeout) as response, open(path, 'r+b') as f:
+        if response.status != 206:
+            raise IOError(f"Range request for bytes {start}-{end} of {url} got status {response.status}")
+        f.seek(start)
+        _copy_response(response, f, end - start + 1)
+
+
+def download_file(url: str, dest: Path, headers: Optional[dict] = None, connections: int = 4,
+                  range_bytes: int = 8 * 1024 ** 2, timeout: float = 30.0,
+                  reserve: Optional[Callable[[int], bool]] = None) -> bool:
+    """
+    Download a url to `dest`, with `connections` parallel range requests of `range_bytes` each if the server supports
+      them. The file only appears at `dest` once it's complete
+
+    :param reserve: called with the size of the file before it's downloaded, the download is skipped if it returns
+      False
+    :return: whether the file was downloaded
+    """
+    headers = headers or {}
+    part_path = dest.with_name(dest.name + '.part')
+    total, ranges_supported = _probe(url, headers, timeout)
+    if reserve is not None and total is not None and not reserve(total):
+        log.info(f"Not downloading {dest.name}, {total} bytes won't fit in the cache")
+        return False
+
+    try:
+        if ranges_supported and total:
+            with open(part_path, 'wb') as f:
+                f.truncate(total)
+            ranges = [(start, min(start + range_bytes, total) - 1) for start in range(0, total, range_bytes)]
+            with ThreadPoolExecutor(connections) as executor:
+                futures = [executor.submit(_download_range, url, headers, part_path, start, end, timeout)
+                           for start, end in ranges]
+                for future in futures:
+                    future.result()
+        else:
+            with urlopen(Request(url, headers=headers), timeout=timeout) as response, open(part_path, 'wb') as f:
+                _copy_response(response, f, total)
+        os.replace(part_path, dest)
+    finally:
+        part_path.unlink(missing_ok=True)
+    return True
+
+
+class Prefetcher:
+    """
+    Downloads the videos in a list ahead of them being processed, so that decoders read local files rather than
+      stalling on the network. At most `lookahead` videos past the ones that have been started are downloaded, the
+      consumer calls `started` as it begins each video (in any order) to move the window along
+    """
+    video_urls: list[str]
+    cache: VideoFileCache
+    lookahead: int
+
+    def __init__(self, video_urls: list[str], cache: VideoFileCache, resolve: Callable[[str], tuple[str, dict]],
+                 lookahead: int = 2, parallel_downloads: int = 1, connections: int = 4):
+        """
+        :param resolve: finds the video id, and the format (as in a yt-dlp info dict) that will be streamed, of a url
+        :param parallel_downloads: number of videos downloaded at once
+        :param connections: number of range requests per video in flight at once
+        """
+        self.video_urls = list(video_urls)
+        self.cache = cache
+        self.lookahead = lookahead
+        self.connections = connections
+        self._resolve = resolve
+        self._condition = thd.Condition()
+        self._next = 0
+        self._started = 0
+        self._stopped = False
+        self._threads = [thd.Thread(target=self._run, name=f"prefetch-{i}", daemon=True)
+                         for i in range(parallel_downloads)]
+
+    def start(self) -> "Prefetcher":
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def started(self, video_url: str):
+        """
+        Note that a video is being processed, which lets another one be downloaded
+        """
+        with self._condition:
+            self._started += 1
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and self._next < len(self.video_urls) and \
+                        self._next >= self._started + self.lookahead:
+                    self._condition.wait()
+                if self._stopped or self._next >= len(self.video_urls):
+                    return
+                video_url = self.video_urls[self._next]
+                self._next += 1
+            self._prefetch(video_url)
+
+    def _prefetch(self, video_url: str):
+        try:
+            video_id, fmt = self._resolve(video_url)
+            if self.cache.get(video_id, fmt) is not None:
+                return
+            if fmt.get('protocol') not in _DOWNLOADABLE_PROTOCOLS:
+                log.info(f"Not prefetching {video_id}, format {fmt['format_id']} is streamed over {fmt['protocol']}")
+                return
+            log.info(f"Prefetching {video_id} ({fmt['format_id']})")
+            download_file(fmt['url'], self.cache.path(video_id, fmt), fmt.get('http_headers'),
+                          connections=self.connections, reserve=self.cache.reserve)
+        except Exception:
+            # The video is just streamed from youtube instead
+            log.exception(f"Failed to prefetch {video_url}")
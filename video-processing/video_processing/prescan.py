@@ -0,0 +1,85 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from functools import partial
+from typing import Optional
+
+from video_processing import metrics
+from video_processing.data_loading import PROCESSING_FORMAT_POLICY, FrameSource, YoutubeFrameSource
+from video_processing.db import no_board_video_ids, save_channel, save_no_board_video, save_video
+from video_processing.metadata_cache import youtube_video_id
+from video_processing.tensorflow.chessboard_finder import findChessboardCorners
+
+log = logging.getLogger(__name__)
+
+# The format a video would be processed in, without looking for the board in it first. The prescan's own samples
+# are what checks for the board, so verifying the format would only add seeks
+_FORMAT_POLICY = replace(PROCESSING_FORMAT_POLICY, verify_samples=0)
+
+
+def find_board(frame_source: FrameSource, n_samples: int = 8) -> tuple[Optional[float], int]:
+    """
+    Look for a chessboard in `n_samples` frames spread through a video, stopping at the first one found
+
+    :return: the number of seconds into the video of the first frame found with a board (or None if there wasn't one),
+      and the number of frames that were checked
+    """
+    frames_checked = 0
+    for sec_into_video, img in frame_source.sample_frames(n_samples):
+        frames_checked += 1
+        with metrics.timed('prescan_locate', items=1):
+            corners = findChessboardCorners(img)
+        if corners is not None:
+            return sec_into_video, frames_checked
+    return None, frames_checked
+
+
+def prescan_video(video_url: str, n_samples: int = 8) -> bool:
+    """
+    Decide whether a video is worth processing by looking for a board in a few of its frames. A video without one gets
+      a metadata-only row in the DB and is marked as having no board, so it's never fetched again
+
+    must be called from the main process
+
+    :return: whether the video should be processed. Videos that can't be checked (eg. because they fail to load) are
+      left for the processing to deal with
+    """
+    try:
+        frame_source = YoutubeFrameSource(video_url, grayscale=True, format_policy=_FORMAT_POLICY)
+        board_sec, frames_checked = find_board(frame_source, n_samples)
+    except Exception:
+        log.exception(f"Failed to prescan {video_url}, leaving it to be processed")
+        return True
+
+    if board_sec is not None:
+        log.debug(f"Prescan found a board {board_sec:0.3f}s into {frame_source.video_id}")
+        return True
+    if frames_checked == 0:
+        log.warning(f"Prescan couldn't decode any frames of {frame_source.video_id}, leaving it to be processed")
+        return True
+
+    log.info(f"No board in {frames_checked} frames of {frame_source.video_id} ({frame_source.title}), skipping it")
+    save_channel(frame_source.channel_id, frame_source.channel_name, frame_source.channel_url)
+    save_video(frame_source.video_id, frame_source.channel_id, frame_source.title, frame_source.thumbnail_url,
+               frame_source.views, len(frame_source))
+    save_no_board_video(frame_source.video_id, frames_checked)
+    return False
+
+
+def prescan_videos(video_urls: list[str], threads: int = 8, n_samples: int = 8) -> list[str]:
+    """
+    Prescan a list of videos in parallel. Videos that an earlier prescan found no board in are dropped without being
+      fetched again
+
+    must be called from the main process
+
+    :return: the urls of the videos that should be processed, in their original order
+    """
+    known_no_board = set(no_board_video_ids())
+    candidates = [url for url in video_urls if youtube_video_id(url) not in known_no_board]
+    with ThreadPoolExecutor(threads) as executor:
+        keep = list(executor.map(partial(prescan_video, n_samples=n_samples), candidates))
+    kept = [url for url, keep_url in zip(candidates, keep) if keep_url]
+    log.info(f"Prescan kept {len(kept)} of {len(video_urls)} videos ({len(video_urls) - len(candidates)} were "
+             f"already known to have no board)")
+    return kept
@@ -0,0 +1,109 @@
+import logging
+import threading as thd
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from statistics import mean
+from typing import Callable, Optional
+
+from video_processing.metadata_cache import fetch_video_info, get_default_cache
+
+log = logging.getLogger(__name__)
+
+
+def fetch_durations(video_urls: list[str], threads: int = 8) -> dict[str, Optional[float]]:
+    """
+    Look up the length of each video in seconds, from the metadata cache where possible
+
+    :return: the length of each video, or None for the ones that couldn't be looked up
+    """
+    metadata_cache = get_default_cache()
+
+    def duration(video_url: str) -> Optional[float]:
+        try:
+            if metadata_cache is not None:
+                info = metadata_cache.video_info(video_url, need_streams=False)
+            else:
+                info = fetch_video_info(video_url)
+            return info.get('duration')
+        except Exception as e:
+            log.warning(f"Couldn't look up the length of {video_url}: {e}")
+            return None
+
+    with ThreadPoolExecutor(threads) as executor:
+        return dict(zip(video_urls, executor.map(duration, video_urls)))
+
+
+def _fill_unknown(durations: dict[str, Optional[float]]) -> dict[str, float]:
+    # Videos of unknown length are assumed to be of average length
+    known = [duration for duration in durations.values() if duration is not None]
+    default = mean(known) if known else 0.0
+    return {url: duration if duration is not None else default for url, duration in durations.items()}
+
+
+def longest_first_order(video_urls: list[str], durations: dict[str, Optional[float]]) -> list[str]:
+    """
+    Order videos longest first. Handed out to whichever worker frees up next, this keeps a batch from ending with a few
+      workers grinding through long videos while the rest sit idle (the LPT rule, which finishes within 4/3 of the
+      shortest possible time). Videos of the same length stay in their original order
+    """
+    lengths = _fill_unknown({url: durations.get(url) for url in video_urls})
+    return sorted(video_urls, key=lambda url: lengths[url], reverse=True)
+
+
+class BatchProgress:
+    """
+    Tracks how much of a batch of videos has been processed, in seconds of video, to estimate when the batch will be
+      done from the rate it has been processed at so far. Thread safe
+    """
+    total_sec: float
+    workers: int
+
+    def __init__(self, durations: dict[str, Optional[float]], workers: int,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param durations: the length of each video in the batch, in seconds (None if unknown)
+        :param workers: number of videos processed at once
+        :param clock: where the time comes from, eg. to control it in tests
+        """
+        self._durations = _fill_unknown(durations)
+        self.total_sec = sum(self._durations.values())
+        self.workers = workers
+        self._clock = clock
+        self._started = clock()
+        self._processed: dict[str, float] = defaultdict(float)
+        self._lock = thd.Lock()
+
+    def advance(self, video_url: str, video_sec: float):
+        """
+        Record that another `video_sec` seconds of a video have been processed
+        """
+        with self._lock:
+            self._processed[video_url] = min(self._processed[video_url] + video_sec, self._durations[video_url])
+
+    def finished(self, video_url: str):
+        """
+        Record that a video is done (or failed), however much of it was actually decoded
+        """
+        with self._lock:
+            self._processed[video_url] = self._durations[video_url]
+
+    @property
+    def processed_sec(self) -> float:
+        with self._lock:
+            return sum(self._processed.values())
+
+    def eta_sec(self) -> Optional[float]:
+        """
+        :return: the estimated number of seconds until the batch is done, or None before there's anything to go on
+        """
+        elapsed = self._clock() - self._started
+        with self._lock:
+            processed = sum(self._processed.values())
+            longest_remaining = max((duration - self._processed[url] for url, duration in self._durations.items()),
+                                    default=0.0)
+        if processed <= 0 or elapsed <= 0:
+            return None
+        rate = processed / elapsed
+        # The batch can't finish before its longest remaining video, which only one worker can work on
+        return max((self.total_sec - processed) / rate, longest_remaining / (rate / self.workers))
@@ -0,0 +1,165 @@
+import logging
+import math
+import multiprocessing as mp
+import pickle
+import queue
+import struct
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Optional
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Every slot starts with a header describing what's in it:
+#   kind (uint8), ndim (uint8), dtype string (4 bytes, eg. b'<f4'), payload size in bytes (uint32),
+#   timestamp (float64), shape (4x int64)
+_HEADER = struct.Struct('<BB4sId4q')
+_HEADER_BYTES = 64
+_MAX_DIMS = 4
+
+_KIND_ARRAY = 0
+_KIND_OBJECT = 1
+_KIND_SPILLED = 2
+
+
+def _round_up(n: int, multiple: int = 64) -> int:
+    return (n + multiple - 1) // multiple * multiple
+
+
+class SharedRingBuffer:
+    """
+    A bounded single-producer, single-consumer queue backed by a fixed number of slots in shared memory.
+
+    NumPy arrays are written directly into a slot by the producer, and handed to the consumer as a view of that slot,
+      so they are never pickled or copied on the way through. Anything else (sentinels, exceptions etc.) is pickled
+      into the slot, or if it doesn't fit, sent through a side queue in the same order.
+
+    Items are `(timestamp, value)` pairs. A slot stays reserved after `get` returns until the consumer calls
+      `release`, since the returned array is a view of it. Slots are released in the order they were received. The
+      producer blocks on `put` while all the slots are reserved.
+
+    Instances can be passed to a child process when it is started, but not sent over a queue.
+    """
+    slots: int
+    slot_bytes: int
+
+    def __init__(self, slots: int, slot_bytes: int):
+        """
+        :param slots: max number of items in the buffer at once
+        :param slot_bytes: max size of an array that can be stored in a slot without pickling
+        """
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self._slot_stride = _HEADER_BYTES + _round_up(slot_bytes)
+        self._shm = SharedMemory(create=True, size=self._slot_stride * slots)
+        self._owner = True
+        self._free_slots = mp.Semaphore(slots)
+        self._filled_slots = mp.Semaphore(0)
+        self._spill_queue = mp.Queue()
+        self._write_idx = 0
+        self._read_idx = 0
+        self._reserved = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = self._shm.name
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        state['_shm'] = SharedMemory(name=state['_shm'])
+        self.__dict__.update(state)
+
+    def _slot_offset(self, idx: int) -> int:
+        return (idx % self.slots) * self._slot_stride
+
+    def put(self, value: Any, timestamp: float = math.nan, timeout: Optional[float] = None) -> None:
+        """
+        Write an item into the next free slot, blocking until one is available
+
+        :raises queue.Full: if no slot became available within `timeout` seconds
+        """
+        if not self._free_slots.acquire(timeout=timeout):
+            raise queue.Full
+        offset = self._slot_offset(self._write_idx)
+        ndim = 0
+        shape = (0,) * _MAX_DIMS
+        dtype = b''
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject and len(value.dtype.str) <= 4 and \
+                value.nbytes <= self.slot_bytes and value.ndim <= _MAX_DIMS:
+            kind = _KIND_ARRAY
+            ndim = value.ndim
+            shape = value.shape + (0,) * (_MAX_DIMS - value.ndim)
+            dtype = value.dtype.str.encode()
+            nbytes = value.nbytes
+            slot_array = np.ndarray(value.shape, value.dtype, buffer=self._shm.buf, offset=offset + _HEADER_BYTES)
+            slot_array[...] = value
+        else:
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            nbytes = len(payload)
+            if nbytes <= self.slot_bytes:
+                kind = _KIND_OBJECT
+                self._shm.buf[offset + _HEADER_BYTES:offset + _HEADER_BYTES + nbytes] = payload
+            else:
+                kind = _KIND_SPILLED
+                self._spill_queue.put(value)
+        _HEADER.pack_into(self._shm.buf, offset, kind, ndim, dtype, nbytes, timestamp, *shape)
+        self._write_idx += 1
+        self._filled_slots.release()
+
+    def get(self, timeout: Optional[float] = None) -> tuple[float, Any]:
+        """
+        Read the next item. Arrays are returned as read-only views of the slot, which are only valid until the slot
+          is released
+
+        :raises queue.Empty: if nothing arrived within `timeout` seconds
+        :return: the `(timestamp, value)` of the next item
+        """
+        if not self._filled_slots.acquire(timeout=timeout):
+            raise queue.Empty
+        offset = self._slot_offset(self._read_idx)
+        kind, ndim, dtype, nbytes, timestamp, *shape = _HEADER.unpack_from(self._shm.buf, offset)
+        if kind == _KIND_ARRAY:
+            value = np.ndarray(tuple(shape[:ndim]), np.dtype(dtype.rstrip(b'\0').decode()),
+                               buffer=self._shm.buf, offset=offset + _HEADER_BYTES)
+            value.flags.writeable = False
+        elif kind == _KIND_OBJECT:
+            value = pickle.loads(self._shm.buf[offset + _HEADER_BYTES:offset + _HEADER_BYTES + nbytes])
+        else:
+            value = self._spill_queue.get()
+        self._read_idx += 1
+        self._reserved += 1
+        return timestamp, value
+
+    def release(self, n: int = 1) -> None:
+        """
+        Hand the `n` oldest received slots back to the producer. Any views of them must no longer be used
+        """
+        if n > self._reserved:
+            raise ValueError(f"Can't release {n} slots, only {self._reserved} are reserved")
+        self._reserved -= n
+        for _ in range(n):
+            self._free_slots.release()
+
+    def qsize(self) -> int:
+        """
+        Approximate number of items that have been put but not received yet, or -1 where that isn't available
+        """
+        try:
+            return self._filled_slots.get_value()
+        except NotImplementedError:
+            # Not available on macOS
+            return -1
+
+    def close(self) -> None:
+        """
+        Detach from the shared memory, and free it if this is the process that created it
+        """
+        try:
+            self._shm.close()
+        except BufferError:
+            # Views of a slot are still alive somewhere, the mapping will go away along with them
+            log.debug(f"Views of ring buffer {self._shm.name} still exist, not unmapping it")
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,213 @@
+import logging
+from dataclasses import dataclass, field
+from importlib import resources
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+_assets = 'video_processing.benchmark_assets'
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR'
+
+# The opening moves of a Ruy Lopez, as (from, to) squares
+RUY_LOPEZ = ['e2e4', 'e7e5', 'g1f3', 'b8c6', 'f1b5', 'a7a6', 'b5a4', 'g8f6', 'e1g1', 'f8e7', 'f1e1', 'b7b5',
+             'a4b3', 'd7d6', 'c2c3', 'e8g8']
+
+
+def fen_to_board(fen: str) -> list[list[str]]:
+    """
+    :return: the squares of the board part of a fen, rank 8 first, with '' for an empty square
+    """
+    board = []
+    for rank in fen.split()[0].split('/'):
+        row = []
+        for char in rank:
+            row += [''] * int(char) if char.isdigit() else [char]
+        board.append(row)
+    return board
+
+
+def board_to_fen(board: list[list[str]]) -> str:
+    ranks = []
+    for row in board:
+        rank = ''
+        empty = 0
+        for piece in row:
+            if piece:
+                rank += (str(empty) if empty else '') + piece
+                empty = 0
+            else:
+                empty += 1
+        ranks.append(rank + (str(empty) if empty else ''))
+    return '/'.join(ranks)
+
+
+def _square(name: str) -> tuple[int, int]:
+    return 8 - int(name[1]), ord(name[0]) - ord('a')
+
+
+def fens_from_moves(moves: list[str], start_fen: str = START_FEN) -> list[str]:
+    """
+    Play through moves given as (from, to) squares, eg. 'e2e4'. There's no checking that the moves are legal, the
+      only rule known is that a king moving two squares castles
+
+    :return: the fen of the starting position, and of the position after each move
+    """
+    board = fen_to_board(start_fen)
+    fens = [board_to_fen(board)]
+    for move in moves:
+        (from_row, from_col), (to_row, to_col) = _square(move[:2]), _square(move[2:4])
+        piece = board[from_row][from_col]
+        board[from_row][from_col] = ''
+        board[to_row][to_col] = piece
+        if piece in 'Kk' and abs(to_col - from_col) == 2:
+            rook_from, rook_to = (7, 5) if to_col > from_col else (0, 3)
+            board[to_row][rook_to], board[to_row][rook_from] = board[to_row][rook_from], ''
+        fens.append(board_to_fen(board))
+    return fens
+
+
+class BoardRenderer:
+    """
+    Draws boards in any position, with square images cut out of a screenshot of a board in a known position. Pieces
+      that are only on one colour of square in the screenshot are moved onto the other colour by swapping the
+      background around them
+    """
+    square_px: int
+
+    def __init__(self, board_img: Optional[np.ndarray] = None, fen: str = START_FEN):
+        """
+        :param board_img: a BGR image of just the board (white at the bottom), defaults to a start position from a
+          chess.com theme
+        :param fen: the position in `board_img`
+        """
+        if board_img is None:
+            board_img = cv2.imread(str(resources.files(_assets) / 'start_position.png'))
+        self.square_px = board_img.shape[0] // 8
+        board = fen_to_board(fen)
+        squares = {}
+        for row in range(8):
+            for col in range(8):
+                square_img = board_img[row * self.square_px:(row + 1) * self.square_px,
+                                       col * self.square_px:(col + 1) * self.square_px]
+                # Edge squares have the coordinates drawn on them, so prefer the ones further in
+                squares.setdefault((board[row][col], (row + col) % 2), []).append(
+                    (min(row, 7 - row, col, 7 - col), square_img))
+        self._squares = {key: max(candidates, key=lambda candidate: candidate[0])[1]
+                         for key, candidates in squares.items()}
+        self._backgrounds = [np.median(self._squares[('', colour)].reshape(-1, 3), axis=0) for colour in (0, 1)]
+
+    def _square_img(self, piece: str, colour: int) -> np.ndarray:
+        if (piece, colour) in self._squares:
+            return self._squares[(piece, colour)]
+        other = self._squares.get((piece, 1 - colour))
+        if other is None:
+            raise ValueError(f"There's no {piece} in the board image to draw with")
+        background = np.abs(other.astype(int) - self._backgrounds[1 - colour]).max(axis=2) < 24
+        square_img = other.copy()
+        square_img[background] = self._backgrounds[colour]
+        self._squares[(piece, colour)] = square_img
+        return square_img
+
+    def render(self, fen: str, size_px: int) -> np.ndarray:
+        """
+        :return: a `size_px` square BGR image of the board in the position `fen`
+        """
+        board = fen_to_board(fen)
+        rows = [np.hstack([self._square_img(board[row][col], (row + col) % 2) for col in range(8)])
+                for row in range(8)]
+        return cv2.resize(np.vstack(rows), (size_px, size_px), interpolation=cv2.INTER_AREA)
+
+
+@dataclass
+class Overlay:
+    """
+    A rectangle of changing noise drawn over each frame, like a facecam
+    """
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+@dataclass
+class VideoLayout:
+    """
+    Where everything goes in the frames of a synthetic video
+    """
+    width: int = 640
+    height: int = 360
+    board_x: int = 20
+    board_y: int = 30
+    board_px: int = 300
+    overlays: list[Overlay] = field(default_factory=lambda: [Overlay(400, 30, 200, 150)])
+    # Text drawn under the board
+    caption: Optional[str] = 'Synthetic chess video'
+
+
+@dataclass
+class Scene:
+    """
+    A stretch of video showing a position, or no board at all if `fen` is None
+    """
+    fen: Optional[str]
+    duration_sec: float
+
+
+def scenes_from_fens(fens: list[str], sec_per_position: float = 1.5,
+                     board_free: tuple[tuple[int, float], ...] = ()) -> list[Scene]:
+    """
+    :param board_free: (index, seconds) of stretches without a board, inserted before the position at each index
+    """
+    gaps = dict(board_free)
+    scenes = []
+    for i, fen in enumerate(fens):
+        if i in gaps:
+            scenes.append(Scene(None, gaps[i]))
+        scenes.append(Scene(fen, sec_per_position))
+    return scenes
+
+
+def write_synthetic_video(path: Path, scenes: list[Scene], layout: VideoLayout = VideoLayout(), fps: float = 30,
+                          fourcc: str = 'mp4v', renderer: Optional[BoardRenderer] = None,
+                          seed: int = 0) -> list[tuple[float, float, Optional[str]]]:
+    """
+    Render a video of `scenes`
+
+    :return: the ground truth: the (start sec, end sec, fen) of each scene
+    """
+    renderer = renderer or BoardRenderer()
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*fourcc), fps, (layout.width, layout.height))
+    if not writer.isOpened():
+        raise IOError(f"Can't write {path} with the {fourcc} codec")
+    # A dark gradient, so the background isn't trivially empty
+    background = np.linspace(30, 90, layout.width, dtype=np.uint8)[None, :, None].repeat(layout.height, 0).repeat(3, 2)
+
+    ground_truth = []
+    frame_num = 0
+    try:
+        for scene in scenes:
+            start_sec = frame_num / fps
+            board_img = renderer.render(scene.fen, layout.board_px) if scene.fen is not None else None
+            for _ in range(round(scene.duration_sec * fps)):
+                frame = background.copy()
+                if board_img is not None:
+                    frame[layout.board_y:layout.board_y + layout.board_px,
+                          layout.board_x:layout.board_x + layout.board_px] = board_img
+                for overlay in layout.overlays:
+                    frame[overlay.y:overlay.y + overlay.height, overlay.x:overlay.x + overlay.width] = \
+                        rng.integers(0, 256, (overlay.height, overlay.width, 1), dtype=np.uint8)
+                if layout.caption:
+                    cv2.putText(frame, layout.caption, (layout.board_x, layout.board_y + layout.board_px + 25),
+                                cv2.FONT_HERSHEY_SIMPLEX, .6, (255, 255, 255), 1, cv2.LINE_AA)
+                writer.write(frame)
+                frame_num += 1
+            ground_truth.append((start_sec, frame_num / fps, scene.fen))
+    finally:
+        writer.release()
+    log.debug(f"Wrote {frame_num} frames of synthetic video to {path}")
+    return ground_truth
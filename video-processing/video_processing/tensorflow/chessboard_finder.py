@@ -3,7 +3,8 @@ from functools import cache
 import PIL.Image
 import cv2 as cv
 import numpy as np
-import pandas as pd
+
+from video_processing import metrics
 
 
 def show_img(img):
@@ -20,40 +21,77 @@ def gen_kernel(n):
     return template
 
 
-def center_of_contour(contour):
-    try:
-        M = cv.moments(contour)
-        cX = int(M["m10"] / M["m00"])
-        cY = int(M["m01"] / M["m00"])
-        return np.asarray([cX, cY], dtype=np.float32)
-    except ZeroDivisionError:
-        return np.mean(contour[:, 0, :], axis=0)
-
-
-def find_inner_corners(img):
-    k_size = 12
+def centers_of_contours(contours):
+    """
+    Vectorized equivalent of taking the centroid (from `cv.moments`) of every contour. Contours with no area fall
+      back to the mean of their points
+    """
+    if len(contours) == 0:
+        return np.zeros((0, 2), dtype=np.float64)
+
+    lengths = np.fromiter((len(c) for c in contours), dtype=np.int64, count=len(contours))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.concatenate(contours)[:, 0, :].astype(np.float64)
+
+    # Pair every point with the next point of the same contour (wrapping around to the first one), and compute the
+    # polygon moments of every contour with the shoelace formula
+    next_idx = np.arange(len(points)) + 1
+    next_idx[starts + lengths - 1] = starts
+    x, y = points[:, 0], points[:, 1]
+    x_next, y_next = x[next_idx], y[next_idx]
+    cross = x * y_next - x_next * y
+    m00 = np.add.reduceat(cross, starts) / 2
+    m10 = np.add.reduceat((x + x_next) * cross, starts) / 6
+    m01 = np.add.reduceat((y + y_next) * cross, starts) / 6
+    mean_points = np.add.reduceat(points, starts) / lengths[:, None]
+
+    has_area = np.abs(2 * m00) > np.finfo(np.float32).eps
+    safe_m00 = np.where(has_area, m00, 1)
+    centroids = np.stack([np.trunc(m10 / safe_m00), np.trunc(m01 / safe_m00)], axis=1)
+    return np.where(has_area[:, None], centroids, mean_points)
+
+
+def match_inner_corners(img, k_size=12):
+    """
+    :return: the centers of every spot in `img` that looks like the corner where four squares of a checkerboard
+      meet (as seen by a `k_size` kernel)
+    """
     kernel = gen_kernel(k_size)
     match_result = cv.matchTemplate(img, kernel, cv.TM_CCOEFF_NORMED)
     _, match_result = cv.threshold(match_result, .85, 1, cv.THRESH_BINARY)
     contours, hierarchy = cv.findContours(match_result.astype(np.uint8), cv.RETR_TREE, cv.CHAIN_APPROX_NONE)
-    centers = np.array([center_of_contour(c) for c in contours])
-    if centers.size < 40:
-        return None
+    centers = centers_of_contours(contours)
     centers += np.array([k_size // 2, k_size // 2])
     return centers
 
 
-def inner_corners_to_cb_corners(centers, img_h, img_w):
-    centers_df = pd.DataFrame(centers, columns=['x', 'y']).round().astype(np.int32)
-    value_counts_x = centers_df.x.value_counts()
-    value_counts_y = centers_df.y.value_counts()
+def find_inner_corners(img, k_size=12):
+    centers = match_inner_corners(img, k_size)
+    if len(centers) < 20:
+        return None
+    return centers
+
 
-    columns = value_counts_x[value_counts_x > 2]
-    rows = value_counts_y[value_counts_y > 2]
+def inner_corner_lines(centers):
+    """
+    :return: the x coordinates of the columns and the y coordinates of the rows of inner corners, which are the ones
+      shared by more than 2 corners
+    """
+    centers = np.rint(centers).astype(np.int64)
+    columns = np.flatnonzero(np.bincount(np.maximum(centers[:, 0], 0)) > 2)
+    rows = np.flatnonzero(np.bincount(np.maximum(centers[:, 1], 0)) > 2)
+    return columns, rows
 
-    l_col, r_col = columns.index.to_series().apply(['min', 'max'])
-    t_row, b_row = rows.index.to_series().apply(['min', 'max'])
 
+def inner_corners_to_cb_corners(centers, img_h, img_w):
+    columns, rows = inner_corner_lines(centers)
+    return lines_to_cb_corners(columns.min(), columns.max(), rows.min(), rows.max(), img_h, img_w)
+
+
+def lines_to_cb_corners(l_col, r_col, t_row, b_row, img_h, img_w):
+    """
+    Extend the outermost rows and columns of inner corners by a square in every direction, to the edges of the board
+    """
     inner_width = r_col - l_col
     inner_height = b_row - t_row
     square_width = inner_width / 6
@@ -65,7 +103,17 @@ def inner_corners_to_cb_corners(centers, img_h, img_w):
     return np.array([l_col, t_row], dtype=np.int32), np.array([r_col, b_row], dtype=np.int32)
 
 
-def findChessboardCorners(img):
+def findChessboardCorners(img, coarse_scale=None):
+    """
+    Find the chessboard in a grayscale image
+
+    :param coarse_scale: if set, search coarse to fine: find roughly where the board is in a copy of the image
+      downscaled by this factor first, then only look at full resolution along the edges of the board. Several times
+      faster, and the corners are the same as a full resolution search gives to within a pixel or two
+    :return: the corners of the board ([x0, y0, x1, y1]), or None if there's no board in the image
+    """
+    if coarse_scale is not None:
+        return findChessboardCornersCoarseToFine(img, coarse_scale)
     inner_corners = find_inner_corners(img)
     if inner_corners is None:
         return None
@@ -74,7 +122,57 @@ def findChessboardCorners(img):
     return np.concatenate(corners)
 
 
-def getChessBoardGray(img, corners):
+def _lines_in_window(img, x0, y0, x1, y1, k_size=12):
+    """
+    :return: the rows and columns of inner corners (see `inner_corner_lines`) whose corners are within a window of a
+      full resolution image
+    """
+    img_h, img_w = img.shape
+    # The kernel has to fit around every corner in the window
+    x0, y0 = max(0, x0 - k_size // 2), max(0, y0 - k_size // 2)
+    x1, y1 = min(img_w, x1 + k_size), min(img_h, y1 + k_size)
+    if x1 - x0 <= k_size or y1 - y0 <= k_size:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # Moved into place before they're rounded, so they round the same way as in a search of the whole image
+    return inner_corner_lines(match_inner_corners(img[y0:y1, x0:x1], k_size) + np.array([x0, y0]))
+
+
+def findChessboardCornersCoarseToFine(img, coarse_scale=.5):
+    """
+    Coarse to fine version of `findChessboardCorners`. The inner corners are matched in the downscaled image with a
+      kernel scaled down to match, which gives the rows and columns of inner corners to within a pixel or two of
+      `coarse_scale`. The outermost ones are then matched again at full resolution, in narrow strips along them
+    """
+    small = cv.resize(img, None, fx=coarse_scale, fy=coarse_scale, interpolation=cv.INTER_AREA)
+    inner_corners = find_inner_corners(small, k_size=max(4, 2 * round(6 * coarse_scale)))
+    if inner_corners is None:
+        return None
+    columns, rows = inner_corner_lines(inner_corners)
+    if len(columns) == 0 or len(rows) == 0:
+        return None
+    l_col, r_col = columns.min() / coarse_scale, columns.max() / coarse_scale
+    t_row, b_row = rows.min() / coarse_scale, rows.max() / coarse_scale
+
+    # How far off each coarse line may be at full resolution
+    radius = int(np.ceil(2 / coarse_scale)) + 1
+    left, top = int(l_col) - radius, int(t_row) - radius
+    right, bottom = int(np.ceil(r_col)) + radius, int(np.ceil(b_row)) + radius
+    # A strip along each of the outermost lines, which takes in all of the corners on it
+    left_columns, _ = _lines_in_window(img, left, top, left + 2 * radius, bottom)
+    right_columns, _ = _lines_in_window(img, right - 2 * radius, top, right, bottom)
+    _, top_rows = _lines_in_window(img, left, top, right, top + 2 * radius)
+    _, bottom_rows = _lines_in_window(img, left, bottom - 2 * radius, right, bottom)
+    if not (len(left_columns) and len(right_columns) and len(top_rows) and len(bottom_rows)):
+        # Too few corners along an edge to pin it down without the rest of the board, so search all of it
+        return findChessboardCorners(img)
+
+    img_h, img_w = img.shape
+    corners = lines_to_cb_corners(left_columns.min(), right_columns.max(), top_rows.min(), bottom_rows.max(),
+                                  img_h, img_w)
+    return np.concatenate(corners)
+
+
+def cropChessBoardGray(img, corners):
     # img is a grayscale image
     # outer_corners = (x0, y0, x1, y1) for top-left corner to bot-right corner of board
     height, width = img.shape
@@ -92,43 +190,164 @@ def getChessBoardGray(img, corners):
                      (padl_x + corners[0]):(padl_x + corners[2])]
 
     # 256x256 px image, 32x32px individual tiles
-    # Normalized
-    chessboard_img_resized = np.asarray(
+    return np.asarray(
         PIL.Image.fromarray(chessboard_img)
-        .resize([256, 256], PIL.Image.BILINEAR), dtype=np.uint8) / 255.0
-    return chessboard_img_resized
+        .resize([256, 256], PIL.Image.BILINEAR), dtype=np.uint8)
+
+
+def getChessBoardGray(img, corners):
+    # Normalized
+    return cropChessBoardGray(img, corners) / 255.0
 
 
 def getChessTilesGray(img, corners):
-    chessboard_img_resized = getChessBoardGray(img, corners)
-    return getTiles(chessboard_img_resized)
+    return getTiles(cropChessBoardGray(img, corners))
 
 
-def getTiles(processed_gray_img):
-    # Given 256x256 px normalized grayscale image of a chessboard (32x32px per tile)
-    # NOTE (values must be in range 0-1)
-    # Return a 32x32x64 tile array
+def getTiles(gray_img):
+    # Given 256x256 px uint8 grayscale image of a chessboard (32x32px per tile)
+    # Return a 32x32x64 uint8 tile array. The tiles aren't normalized here, the inference backends do that as they
+    # read them, so the tiles take a quarter of the memory (and queue bandwidth) that float32 ones would
     #
     # stack deep 64 tiles
     # so, first slab is tile A1, then A2 etc.
-    tiles = np.zeros([32, 32, 64], dtype=np.float32)  # grayscale
     # Assume A1 is bottom left of image, need to reverse rank since images start
     # with origin in top left
-    for rank in range(8):  # rows (numbers)
-        for file in range(8):  # columns (letters)
-            tiles[:, :, (rank * 8 + file)] = \
-                processed_gray_img[(7 - rank) * 32:((7 - rank) + 1) * 32, file * 32:(file + 1) * 32]
-
-    return tiles
-
-
-def find_grayscale_tiles_in_image(img):
-    """ Find chessboard and convert into input tiles for CNN """
+    # (rank, y, file, x) -> (y, x, rank, file) -> (y, x, rank * 8 + file)
+    ranks = np.reshape(gray_img, [8, 32, 8, 32])[::-1]
+    return np.ascontiguousarray(np.transpose(ranks, [1, 3, 0, 2]), dtype=np.uint8).reshape([32, 32, 64])
+
+
+# Mask of the squares which are the same color as a1 (in the 8x8 grid of squares of a 256x256 board image)
+_a1_colored_squares = (np.add.outer(np.arange(8), np.arange(8)) % 2 == 0)
+
+
+def checkerboard_signature(board_img):
+    """
+    Cheaply check how much a cropped 256x256 grayscale board image looks like a checkerboard. Only the corners of
+      each square are sampled, since those are rarely covered by pieces
+
+    :return: the contrast between the two square colors, and the number of squares (out of 64) that are on the
+      expected side of the midpoint between the two colors
+    """
+    tiles = board_img.reshape(8, 32, 8, 32).astype(np.float32)
+    square_corners = (tiles[:, 1:4, :, 1:4].mean(axis=(1, 3)) +
+                      tiles[:, 1:4, :, -4:-1].mean(axis=(1, 3)) +
+                      tiles[:, -4:-1, :, 1:4].mean(axis=(1, 3)) +
+                      tiles[:, -4:-1, :, -4:-1].mean(axis=(1, 3))) / 4
+    a1_color = square_corners[_a1_colored_squares].mean()
+    other_color = square_corners[~_a1_colored_squares].mean()
+    midpoint = (a1_color + other_color) / 2
+    expected = _a1_colored_squares if a1_color > other_color else ~_a1_colored_squares
+    agreement = int(np.count_nonzero((square_corners > midpoint) == expected))
+    return abs(a1_color - other_color), agreement
+
+
+class ChessboardTracker:
+    """
+    Remembers where the chessboard was in the previous frame of a video, so that the (relatively expensive) full
+      frame search only needs to run when the board moves or disappears. Each new frame is cropped using the cached
+      corners, and the crop is accepted if it still passes a checkerboard signature test
+    """
+    corners: np.ndarray | None
+    hits: int
+    misses: int
+    min_agreement: int
+    min_contrast_ratio: float
+    coarse_scale: float | None
+    _reference_contrast: float
+
+    def __init__(self, min_agreement: int = 60, min_contrast_ratio: float = .5, coarse_scale: float | None = None):
+        """
+        :param min_agreement: minimum number of squares (out of 64) that must match the checkerboard pattern
+        :param min_contrast_ratio: minimum contrast between light and dark squares, relative to the contrast
+          measured when the board was located
+        :param coarse_scale: search for the board coarse to fine, see `findChessboardCorners`
+        """
+        self.corners = None
+        self.hits = 0
+        self.misses = 0
+        self.min_agreement = min_agreement
+        self.min_contrast_ratio = min_contrast_ratio
+        self.coarse_scale = coarse_scale
+        self._reference_contrast = 0.0
+
+    def _matches(self, board_img, min_contrast):
+        contrast, agreement = checkerboard_signature(board_img)
+        return agreement >= self.min_agreement and contrast >= min_contrast, contrast
+
+    def locate(self, bw_array):
+        """
+        Find the chessboard in a grayscale frame, reusing the corners from the previous frame when possible
+
+        :return: the 256x256 uint8 board image, and the corners of the board ([x0, y0, x1, y1]) (or None, None if
+          there is no board in the frame)
+        """
+        if self.corners is not None:
+            board_img = cropChessBoardGray(bw_array, self.corners)
+            matches, _ = self._matches(board_img, self._reference_contrast * self.min_contrast_ratio)
+            if matches:
+                self.hits += 1
+                return board_img, self.corners
+        self.misses += 1
+
+        corners = findChessboardCorners(bw_array, self.coarse_scale)
+        if corners is None:
+            self.corners = None
+            return None, None
+
+        board_img = cropChessBoardGray(bw_array, corners)
+        matches, contrast = self._matches(board_img, 0)
+        # Only cache boards that would pass the check on the next frame, otherwise every frame would be a miss anyway
+        self.corners = corners if matches else None
+        self._reference_contrast = contrast
+        return board_img, corners
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class BoardDetector:
+    """
+    Checks whether a frame has a chessboard in it, eg. for `SeekAhead`. Keeps its own tracker, so checking a run of
+      frames with the board in the same place is cheap. Picklable, so it can be sent along with a frame source
+    """
+    tracker: ChessboardTracker
+
+    def __init__(self):
+        self.tracker = ChessboardTracker()
+
+    def __call__(self, img: np.ndarray) -> bool:
+        bw_array = img if img.ndim == 2 else cv.cvtColor(img, cv.COLOR_RGB2GRAY)
+        board_img, _ = self.tracker.locate(bw_array)
+        return board_img is not None
+
+
+@metrics.timed('locate', items=1)
+def find_grayscale_tiles_in_image(img, tracker: ChessboardTracker | None = None):
+    """
+    Find chessboard and convert into input tiles for CNN
+
+    :param img: the frame to search, either a PIL image or an RGB or grayscale numpy array
+    :param tracker: optional per-video tracker, used to skip the full search when the board hasn't moved
+    :return: the 32x32x64 uint8 tiles and the corners of the board, or None, None if there's no board
+    """
     if img is None:
         return None, None
 
     # Convert to grayscale numpy array
-    bw_array = np.array(img.convert('L'), dtype=np.uint8)
+    if isinstance(img, np.ndarray):
+        bw_array = img if img.ndim == 2 else cv.cvtColor(img, cv.COLOR_RGB2GRAY)
+    else:
+        bw_array = np.array(img.convert('L'), dtype=np.uint8)
+
+    if tracker is not None:
+        board_img, corners = tracker.locate(bw_array)
+        if board_img is None:
+            return None, None
+        return getTiles(board_img), corners
 
     # Use computer vision to find orthorectified chessboard outer_corners in image
     corners = findChessboardCorners(bw_array)
@@ -1,36 +1,34 @@
-import os
-
-from .helper_functions import predictSideFromFEN, unflipFEN, shortenFEN
-
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'  # Ignore Tensorflow INFO debug messages
-import tensorflow as tf
-import numpy as np
-from importlib import resources
 import logging
-from . import chessboard_finder
 from dataclasses import dataclass
+
+import numpy as np
 from PIL import Image
 
+from video_processing import metrics
+from . import chessboard_finder
+from .helper_functions import predictSideFromFEN, unflipFEN, shortenFEN
+from .inference_backends import DEFAULT_BACKEND, InferenceBackend, create_backend
+
 log = logging.getLogger(__name__)
 
-log.info("Initializing tensorflow session")
-# Load and parse the protobuf file to retrieve the unserialized graph_def.
-with resources.open_binary('video_processing.tensorflow.saved_models', 'frozen_graph.pb') as f:
-    graph_def = tf.compat.v1.GraphDef()
-    graph_def.ParseFromString(f.read())
+_backend: InferenceBackend | None = None
+
 
-# Import graph def and return.
-with tf.Graph().as_default() as graph:
-    # Prefix every op/nodes in the graph.
-    tf.import_graph_def(graph_def, name="tcb")
+def set_backend(backend: str | InferenceBackend):
+    """
+    Choose how the network is run, either by name (see `inference_backends.BACKENDS`) or with a backend instance
+    """
+    global _backend
+    _backend = create_backend(backend) if isinstance(backend, str) else backend
 
-_tf_session = tf.compat.v1.Session(graph=graph)
-x = graph.get_tensor_by_name('tcb/Input:0')
-_keep_prob_layer = graph.get_tensor_by_name('tcb/KeepProb:0')
-_prediction_layer = graph.get_tensor_by_name('tcb/prediction:0')
-probabilities = graph.get_tensor_by_name('tcb/probabilities:0')
 
-log.info("tensorflow initialized")
+def get_backend() -> InferenceBackend:
+    """
+    The backend the network is run with. It's created on first use, so that importing this module is cheap
+    """
+    if _backend is None:
+        set_backend(DEFAULT_BACKEND)
+    return _backend
 
 
 @dataclass
@@ -63,17 +61,109 @@ def extract_fen(img: Image.Image) -> str | None:
     return fen
 
 
-def process_tiles(tiles):
+class TilePredictionCache:
+    """
+    Per-video cache of the predicted label of each square. Between consecutive frames usually only a couple of squares
+      change, so a tile is only run through the network when it differs from the last tile that was run through the
+      network for that square by more than `threshold` (mean absolute difference of the normalized pixels)
+    """
+    threshold: float
+    reused: int
+    inferred: int
+    _reference_rows: np.ndarray | None
+    _labels: np.ndarray | None
+
+    def __init__(self, threshold: float = .02):
+        self.threshold = threshold
+        self.reused = 0
+        self.inferred = 0
+        self._reference_rows = None
+        self._labels = None
+
+    @property
+    def reuse_rate(self) -> float:
+        total = self.reused + self.inferred
+        return self.reused / total if total else 0.0
+
+    def predict(self, frames_rows: list[np.ndarray]) -> np.ndarray:
+        """
+        Predict the labels of the squares of several consecutive frames
+
+        :param frames_rows: the 64x1024 uint8 network input of each frame
+        :return: an Nx64 array of labels
+        """
+        if len(frames_rows) == 0:
+            return np.zeros((0, 64), dtype=np.int64)
+
+        # Every square of every frame gets its label from an index into `cached labels + new predictions`
+        label_sources = np.empty((len(frames_rows), 64), dtype=np.int64)
+        square_sources = np.arange(64)
+        rows_to_infer = []
+        for i, rows in enumerate(frames_rows):
+            if self._reference_rows is None:
+                self._reference_rows = np.array(rows, dtype=np.uint8)
+                changed = np.arange(64)
+            else:
+                diffs = np.mean(np.abs(rows.astype(np.int16) - self._reference_rows), axis=1)
+                changed = np.flatnonzero(diffs > self.threshold * 255)
+                self._reference_rows[changed] = rows[changed]
+            square_sources = square_sources.copy()
+            square_sources[changed] = 64 + len(rows_to_infer) + np.arange(len(changed))
+            rows_to_infer.extend(rows[changed])
+            label_sources[i] = square_sources
+
+        self.inferred += len(rows_to_infer)
+        self.reused += label_sources.size - len(rows_to_infer)
+        predictions = _predict_labels(np.asarray(rows_to_infer, dtype=np.uint8).reshape(-1, 32 * 32))
+        cached_labels = self._labels if self._labels is not None else np.zeros(64, dtype=predictions.dtype)
+        labels = np.concatenate([cached_labels, predictions])[label_sources]
+        self._labels = labels[-1]
+        return labels
+
+
+def _predict_labels(rows: np.ndarray) -> np.ndarray:
+    """Run the network on Nx1024 uint8 rows of tiles, returning the N predicted labels"""
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64)
+    with metrics.timed('model', items=len(rows)):
+        return get_backend().predict(rows)
+
+
+def tiles_to_rows(tiles: np.ndarray) -> np.ndarray:
+    """Reshape the 32x32x64 tiles of a frame into 64x1024 rows of input data, the format used by neural network"""
+    return np.swapaxes(np.reshape(tiles, [32 * 32, 64]), 0, 1)
+
+
+def process_tiles(tiles, cache: TilePredictionCache | None = None):
     """Run trained neural network on tiles generated from image"""
-    # Reshape into Nx1024 rows of input data, format used by neural network
-    validation_set = np.swapaxes(np.reshape(tiles, [32 * 32, 64]), 0, 1)
+    return process_tiles_batch([tiles], cache)[0]
+
+
+def process_tiles_batch(tiles_batch: list, cache: TilePredictionCache | None = None) -> list[str]:
+    """
+    Run trained neural network on the tiles of several frames in a single call to the inference backend
+
+    :param tiles_batch: a list of 32x32x64 uint8 tile tensors, one per frame (in the order they appear in the video)
+    :param cache: optional per-video cache, so that only the squares which changed are run through the network
+    :return: a list of fens, in the same order as `tiles_batch`
+    """
+    if len(tiles_batch) == 0:
+        return []
+
+    with metrics.timed('inference', items=len(tiles_batch)):
+        frames_rows = [tiles_to_rows(tiles) for tiles in tiles_batch]
+
+        if cache is not None:
+            labels = cache.predict(frames_rows)
+        else:
+            # Run neural network on all the frames at once
+            labels = _predict_labels(np.concatenate(frames_rows)).reshape(len(tiles_batch), 64)
+
+        return [labels_to_fen(frame_labels) for frame_labels in labels]
 
-    # Run neural network on data
-    guess_prob, guessed = _tf_session.run(
-        [probabilities, _prediction_layer],
-        feed_dict={x: validation_set, _keep_prob_layer: 1.0})
 
-    # Convert guess into FEN string
+def labels_to_fen(guessed) -> str:
+    """Convert the 64 predicted labels of a single frame (tiles A1-H8, rank-order) into a fen"""
     # guessed is tiles A1-H8 rank-order, so to make a FEN we just need to flip the files from 1-8 to 8-1
     label_index_2_name = lambda label_index: ' KQRBNPkqrbnp'[label_index]
     piece_names = list(map(lambda k: '1' if k == 0 else label_index_2_name(k), guessed))  # exchange ' ' for '1' for FEN
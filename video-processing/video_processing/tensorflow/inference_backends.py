@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import threading as thd
+from abc import ABC, abstractmethod
+from importlib import resources
+from pathlib import Path
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+_saved_models = 'video_processing.tensorflow.saved_models'
+FROZEN_GRAPH = 'frozen_graph.pb'
+NUMPY_WEIGHTS = 'cnn_weights.npz'
+QUANTIZED_MODEL = 'cnn_int8.tflite'
+# Min fraction of squares the quantized model has to label the same as the float model for it to be used, see
+# `quantization.validate_quantized_model`
+MIN_QUANTIZED_AGREEMENT = float(os.environ.get('MIN_QUANTIZED_AGREEMENT', .995))
+
+# Names of the (frozen) variables in the graph, in the order the layers use them:
+# conv1 kernel, conv1 bias, conv2 kernel, conv2 bias, fc kernel, fc bias, output kernel, output bias
+_VARIABLE_NAMES = ['Variable', 'Variable_1', 'Variable_2', 'Variable_3',
+                   'Variable_4', 'Variable_5', 'Variable_6', 'Variable_7']
+
+
+def saved_model_path(name: str) -> Path:
+    return Path(str(resources.files(_saved_models) / name))
+
+
+class InferenceBackend(ABC):
+    """
+    Abstract strategy class for running the tile classification network
+    """
+
+    @abstractmethod
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Classify tiles
+
+        :param rows: Nx1024 uint8 array, each row is a flattened 32x32 grayscale tile. The network was trained on
+          tiles normalized to the range 0-1, which each backend does as part of its first op
+        :return: the N predicted labels (indexes into ' KQRBNPkqrbnp')
+        """
+        pass
+
+
+class TensorflowBackend(InferenceBackend):
+    """
+    Runs the frozen graph in a tensorflow session. This is the reference implementation
+    """
+
+    def __init__(self, graph_path: Path | None = None):
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'  # Ignore Tensorflow INFO debug messages
+        import tensorflow as tf
+
+        log.info("Initializing tensorflow session")
+        graph_path = graph_path or saved_model_path(FROZEN_GRAPH)
+        # Load and parse the protobuf file to retrieve the unserialized graph_def.
+        with open(graph_path, 'rb') as f:
+            graph_def = tf.compat.v1.GraphDef()
+            graph_def.ParseFromString(f.read())
+
+        # Import graph def and return.
+        with tf.Graph().as_default() as graph:
+            # The tiles are fed in as uint8, and normalized in the graph rather than in numpy beforehand
+            self._x = tf.compat.v1.placeholder(tf.uint8, [None, 32 * 32], name='Tiles')
+            normalized = tf.cast(self._x, tf.float32) * (1 / 255)
+            # Prefix every op/nodes in the graph.
+            tf.import_graph_def(graph_def, input_map={'Input:0': normalized}, name="tcb")
+
+        self._session = tf.compat.v1.Session(graph=graph)
+        self._keep_prob_layer = graph.get_tensor_by_name('tcb/KeepProb:0')
+        self._prediction_layer = graph.get_tensor_by_name('tcb/prediction:0')
+        log.info("tensorflow initialized")
+
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        return self._session.run(
+            self._prediction_layer,
+            feed_dict={self._x: rows, self._keep_prob_layer: 1.0})
+
+
+def _conv2d_same(x: np.ndarray, kernel: np.ndarray, bias: np.ndarray) -> np.ndarray:
+    """
+    Stride 1 'SAME' convolution of an NHWC batch, computed as one matmul per kernel offset so that no im2col buffer
+      is needed
+    """
+    k = kernel.shape[0]
+    pad = k // 2
+    n, h, w, _ = x.shape
+    padded = np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)))
+    out = np.zeros((n, h, w, kernel.shape[3]), dtype=np.float32)
+    for i in range(k):
+        for j in range(k):
+            out += padded[:, i:i + h, j:j + w, :] @ kernel[i, j]
+    out += bias
+    return out
+
+
+def _max_pool_2x2(x: np.ndarray) -> np.ndarray:
+    n, h, w, c = x.shape
+    return x.reshape(n, h // 2, 2, w // 2, 2, c).max(axis=(2, 4))
+
+
+class NumpyBackend(InferenceBackend):
+    """
+    Runs the network's forward pass with plain numpy, using weights exported from the frozen graph by
+      `export_numpy_weights`. Doesn't need tensorflow at all, so it's much faster to start and uses far less memory.
+      Normalizing the tiles is folded into the first convolution's kernel, since conv(x / 255) = conv(x) / 255
+    """
+    # Max number of tiles per forward pass, bounds the size of the intermediate activations
+    chunk_size = 512
+
+    def __init__(self, weights_path: Path | None = None):
+        weights_path = weights_path or saved_model_path(NUMPY_WEIGHTS)
+        with np.load(weights_path) as weights:
+            (self._conv1_kernel, self._conv1_bias, self._conv2_kernel, self._conv2_bias,
+             self._fc_kernel, self._fc_bias, self._out_kernel, self._out_bias) = \
+                [weights[name].astype(np.float32) for name in _VARIABLE_NAMES]
+        self._conv1_kernel /= 255
+
+    def logits(self, rows: np.ndarray) -> np.ndarray:
+        x = np.reshape(rows, [-1, 32, 32, 1]).astype(np.float32, copy=False)
+        x = _max_pool_2x2(np.maximum(_conv2d_same(x, self._conv1_kernel, self._conv1_bias), 0))
+        x = _max_pool_2x2(np.maximum(_conv2d_same(x, self._conv2_kernel, self._conv2_bias), 0))
+        x = np.maximum(x.reshape(-1, 8 * 8 * 64) @ self._fc_kernel + self._fc_bias, 0)
+        # Dropout is a no-op at inference time (keep_prob = 1)
+        return x @ self._out_kernel + self._out_bias
+
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.argmax(self.logits(rows[i:i + self.chunk_size]), axis=1)
+                               for i in range(0, len(rows), self.chunk_size)])
+
+
+def quantization_report_path(model_path: Path) -> Path:
+    """
+    Where the results of validating a quantized model against the float model are kept
+    """
+    return model_path.with_suffix('.json')
+
+
+class QuantizedBackend(InferenceBackend):
+    """
+    Runs the int8 quantized version of the network made by `quantization.quantize_model` with the TFLite interpreter,
+      which is several times faster on CPUs than the float network. It's only used if validating it found that it
+      labels at least `min_agreement` of squares the same as the float network
+    """
+    # Tiles are run in batches of a power of two up to this size, padded if need be, so that only a few input shapes
+    # ever need memory allocated for them
+    chunk_size = 512
+
+    def __init__(self, model_path: Path | None = None, min_agreement: float | None = MIN_QUANTIZED_AGREEMENT):
+        """
+        :param min_agreement: None skips checking the model has been validated, which is only for validating it
+        """
+        model_path = model_path or saved_model_path(QUANTIZED_MODEL)
+        if min_agreement is not None:
+            report_path = quantization_report_path(model_path)
+            if not report_path.exists():
+                raise ValueError(f"{model_path} hasn't been validated against the float model, see `quantize-model`")
+            agreement = json.loads(report_path.read_text())['square_agreement']
+            if agreement < min_agreement:
+                raise ValueError(f"Refusing to use {model_path}: it labels {agreement:.2%} of squares the same as "
+                                 f"the float model, below the minimum of {min_agreement:.2%}")
+            log.info(f"Using {model_path}, which labels {agreement:.2%} of squares the same as the float model")
+
+        import tensorflow as tf
+
+        self._model_content = model_path.read_bytes()
+        self._interpreter_class = tf.lite.Interpreter
+        self._interpreters = {}
+        # An interpreter can only run one batch at a time
+        self._lock = thd.Lock()
+
+    def _interpreter(self, batch_size: int):
+        if batch_size not in self._interpreters:
+            interpreter = self._interpreter_class(model_content=self._model_content)
+            interpreter.resize_tensor_input(interpreter.get_input_details()[0]['index'], [batch_size, 32 * 32])
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = interpreter
+        return self._interpreters[batch_size]
+
+    def _predict_chunk(self, rows: np.ndarray) -> np.ndarray:
+        batch_size = 1 << (len(rows) - 1).bit_length()
+        interpreter = self._interpreter(batch_size)
+        input_details = interpreter.get_input_details()[0]
+        scale, zero_point = input_details['quantization']
+        # The model takes raw pixel values, so with the usual calibration the uint8 tiles are already quantized
+        quantized = rows if (scale, zero_point) == (1.0, 0) else \
+            np.clip(np.rint(rows / scale + zero_point), 0, 255).astype(np.uint8)
+        padded = np.zeros((batch_size, 32 * 32), dtype=np.uint8)
+        padded[:len(rows)] = quantized
+        interpreter.set_tensor(input_details['index'], padded)
+        interpreter.invoke()
+        # The logits are quantized with a positive scale, so the biggest int8 one is also the biggest float one
+        logits = interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+        return np.argmax(logits[:len(rows)], axis=1)
+
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        with self._lock:
+            return np.concatenate([self._predict_chunk(rows[i:i + self.chunk_size])
+                                   for i in range(0, len(rows), self.chunk_size)])
+
+
+def export_numpy_weights(graph_path: Path | None = None, weights_path: Path | None = None) -> Path:
+    """
+    Pull the weights out of the frozen graph, and save them in the compact format loaded by `NumpyBackend`. Needs
+      tensorflow, but only has to be done once
+
+    :return: the path the weights were saved to
+    """
+    import tensorflow as tf
+
+    graph_path = graph_path or saved_model_path(FROZEN_GRAPH)
+    weights_path = weights_path or saved_model_path(NUMPY_WEIGHTS)
+    with open(graph_path, 'rb') as f:
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString(f.read())
+    constants = {node.name: tf.make_ndarray(node.attr['value'].tensor)
+                 for node in graph_def.node if node.op == 'Const'}
+    np.savez(weights_path, **{name: constants[name] for name in _VARIABLE_NAMES})
+    log.info(f"Exported numpy weights to {weights_path}")
+    return weights_path
+
+
+# The backend used when none has been chosen explicitly
+DEFAULT_BACKEND = os.environ.get('INFERENCE_BACKEND', 'tensorflow')
+
+BACKENDS: dict[str, type[InferenceBackend]] = {
+    'tensorflow': TensorflowBackend,
+    'numpy': NumpyBackend,
+    'int8': QuantizedBackend,
+}
+
+
+def create_backend(name: str) -> InferenceBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name}, available backends are: {list(BACKENDS)}")
+    return BACKENDS[name]()
@@ -0,0 +1,128 @@
+import json
+import logging
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+from video_processing.synthetic_video import BoardRenderer
+from .chessboard_finder import find_grayscale_tiles_in_image, getTiles
+from .frame_analyzer import tiles_to_rows
+from .inference_backends import (NUMPY_WEIGHTS, QUANTIZED_MODEL, _VARIABLE_NAMES, InferenceBackend, NumpyBackend,
+                                 QuantizedBackend, quantization_report_path, saved_model_path)
+
+log = logging.getLogger(__name__)
+
+_LABEL_NAMES = ['empty', *'KQRBNPkqrbnp']
+
+
+def tile_rows_from_images(paths: list[Path]) -> np.ndarray:
+    """
+    :return: the Nx1024 uint8 network input of the tiles of every image a board is found in
+    """
+    rows = []
+    for path in paths:
+        tiles, _ = find_grayscale_tiles_in_image(Image.open(path))
+        if tiles is None:
+            log.warning(f"No board found in {path}, leaving it out")
+            continue
+        rows.append(tiles_to_rows(tiles))
+    return np.concatenate(rows) if rows else np.zeros((0, 32 * 32), dtype=np.uint8)
+
+
+def tile_rows_from_fens(fens: list[str]) -> np.ndarray:
+    """
+    :return: the Nx1024 uint8 network input of the tiles of boards drawn in each position (see `BoardRenderer`)
+    """
+    renderer = BoardRenderer()
+    rows = [tiles_to_rows(getTiles(cv.cvtColor(renderer.render(fen, 256), cv.COLOR_BGR2GRAY))) for fen in fens]
+    return np.concatenate(rows) if rows else np.zeros((0, 32 * 32), dtype=np.uint8)
+
+
+@dataclass
+class AgreementReport:
+    """
+    How often a model labels squares the same as the reference (float) model
+    """
+    squares: int
+    square_agreement: float
+    # Fraction of boards that every one of the 64 squares is labelled the same on
+    board_agreement: float
+    # Agreement on the squares the reference model gives each label
+    label_agreement: dict[str, float]
+
+
+def compare_backends(reference: InferenceBackend, candidate: InferenceBackend, rows: np.ndarray) -> AgreementReport:
+    """
+    :param rows: the tiles of whole boards, 64 rows per board
+    """
+    expected = reference.predict(rows)
+    same = candidate.predict(rows) == expected
+    return AgreementReport(squares=len(rows),
+                           square_agreement=float(same.mean()) if len(rows) else 0.0,
+                           board_agreement=float(same.reshape(-1, 64).all(axis=1).mean()) if len(rows) else 0.0,
+                           label_agreement={_LABEL_NAMES[label]: float(same[expected == label].mean())
+                                            for label in np.unique(expected)})
+
+
+def quantize_model(calibration_rows: np.ndarray, weights_path: Path | None = None) -> bytes:
+    """
+    Post-training int8 quantization of the network, with the range of every activation calibrated on the tiles in
+      `calibration_rows`. Needs tensorflow
+
+    :return: the TFLite model, which takes Nx1024 uint8 tiles and outputs Nx13 int8 logits
+    """
+    import tensorflow as tf
+
+    with np.load(weights_path or saved_model_path(NUMPY_WEIGHTS)) as weights:
+        conv1_kernel, conv1_bias, conv2_kernel, conv2_bias, fc_kernel, fc_bias, out_kernel, out_bias = \
+            [tf.constant(weights[name].astype(np.float32)) for name in _VARIABLE_NAMES]
+
+    # The forward pass of the frozen graph, without the dropout ops (which are a no-op at inference time anyway)
+    @tf.function(input_signature=[tf.TensorSpec([None, 32 * 32], tf.float32)])
+    def logits(rows):
+        # Takes raw pixel values rather than normalized ones, so that the quantized input is just the uint8 tiles
+        x = tf.reshape(rows * (1 / 255), [-1, 32, 32, 1])
+        x = tf.nn.max_pool2d(tf.nn.relu(tf.nn.conv2d(x, conv1_kernel, 1, 'SAME') + conv1_bias), 2, 2, 'SAME')
+        x = tf.nn.max_pool2d(tf.nn.relu(tf.nn.conv2d(x, conv2_kernel, 1, 'SAME') + conv2_bias), 2, 2, 'SAME')
+        x = tf.nn.relu(tf.matmul(tf.reshape(x, [-1, 8 * 8 * 64]), fc_kernel) + fc_bias)
+        return tf.matmul(x, out_kernel) + out_bias
+
+    def representative_dataset():
+        for row in calibration_rows:
+            yield [row[None].astype(np.float32)]
+
+    network = tf.Module()
+    network.logits = logits
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([logits.get_concrete_function()], network)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.int8
+    return converter.convert()
+
+
+def validate_quantized_model(model_path: Path, rows: np.ndarray, weights_path: Path | None = None) -> AgreementReport:
+    """
+    Compare the labels the quantized model gives the squares in `rows` with the ones the float model gives them, and
+      save the results next to the model, where `QuantizedBackend` checks them before using it
+    """
+    report = compare_backends(NumpyBackend(weights_path), QuantizedBackend(model_path, min_agreement=None), rows)
+    quantization_report_path(model_path).write_text(json.dumps(asdict(report), indent=2))
+    return report
+
+
+def save_quantized_model(calibration_rows: np.ndarray, validation_rows: np.ndarray, model_path: Path | None = None,
+                         weights_path: Path | None = None) -> AgreementReport:
+    """
+    Quantize the network, and validate the quantized model against the float one
+
+    :return: how well the quantized model agrees with the float one on `validation_rows`
+    """
+    model_path = model_path or saved_model_path(QUANTIZED_MODEL)
+    model_path.write_bytes(quantize_model(calibration_rows, weights_path))
+    log.info(f"Saved the quantized model to {model_path}, calibrated on {len(calibration_rows)} tiles")
+    return validate_quantized_model(model_path, validation_rows, weights_path)
@@ -1,21 +1,35 @@
+import copy
 import logging
 import multiprocessing as mp
+import queue
 import threading as thd
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
+
+import numpy as np
 
 import PIL.Image
 
+from video_processing import metrics
 from video_processing.data_loading import FrameSource
-from video_processing.db import save_position_sighting
-from video_processing.tensorflow.chessboard_finder import find_grayscale_tiles_in_image
-from video_processing.tensorflow.frame_analyzer import process_tiles
+from video_processing.db import PositionSightingWriter
+from video_processing.shared_ring_buffer import SharedRingBuffer
+from video_processing.tensorflow.chessboard_finder import ChessboardTracker, find_grayscale_tiles_in_image
+from video_processing.tensorflow.frame_analyzer import TilePredictionCache, process_tiles_batch
+from video_processing.warm_workers import WarmWorker, WarmWorkerPool
 
 log = logging.getLogger(__name__)
 
+# Size of the 32x32x64 uint8 tile tensor generated for each frame
+_TILE_BYTES = 32 * 32 * 64 * np.dtype(np.uint8).itemsize
+_TILE_SLOTS = 30
+
 
 class TileStreamingException(Exception):
-    img: PIL.Image.Image
+    img: Optional[np.ndarray]
     cause: Exception
 
     def __init__(self, img, cause):
@@ -29,111 +43,457 @@ def handle_failed_video(failed_img, failed_frame_num, failed_ts, video_id):
         bad_img_dir = Path("./errors")
         bad_img_dir.mkdir(exist_ok=True)
         bad_img_path = bad_img_dir / f"{video_id}_{failed_frame_num}.png"
-        failed_img.save(str(bad_img_path))
+        # Frames stay numpy arrays all the way through, this is the only place one becomes an image
+        PIL.Image.fromarray(failed_img).save(str(bad_img_path))
         msg += f"Failed frame persisted to: {str(bad_img_path)}"
     log.exception(msg)
 
 
-class VideoProcessingTask:
-    frame_source: FrameSource
-    _frame_processed_callback: Callable[[], None]
-    running: bool
-    _tile_queue: mp.Queue
+class FenStabilizer:
+    """
+    Decides when a detected position has been on screen long enough to be recorded as a sighting. A position is
+      recorded once it has been detected continuously for `stability_sec` seconds, and isn't recorded again until
+      some other position has been recorded in between
+    """
+    stability_sec: float
+    _prev_fen: Optional[str]
+    _run_fen: Optional[str]
+    _run_start: float
 
-    def __init__(self, frame_source: FrameSource):
-        self.frame_source = frame_source
-        self.running = True
-        self._tile_queue = mp.Queue(maxsize=30)
+    def __init__(self, stability_sec: float = 0.3):
+        """
+        :param stability_sec: number of seconds a position must stay on screen before it's recorded. The default is
+          10 frames at 30 fps
+        """
+        self.stability_sec = stability_sec
+        self._prev_fen = None
+        self._run_fen = None
+        self._run_start = 0.0
 
-    @property
-    def video_id(self):
-        return self.frame_source.video_id
+    def update(self, sec_into_video: float, fen: str) -> Optional[float]:
+        """
+        Feed the fen detected in the next frame (frames without a position should not be fed in)
+
+        :return: the number of seconds into the video where the position first appeared, if the position should be
+          recorded now, otherwise None
+        """
+        if fen != self._run_fen:
+            self._run_fen = fen
+            self._run_start = sec_into_video
+
+        # If the position hasn't changed, don't record a new position
+        if fen == self._prev_fen:
+            return None
+
+        # If this position hasn't been on screen long enough, don't do anything
+        if sec_into_video - self._run_start < self.stability_sec - 1e-6:
+            return None
+
+        self._prev_fen = fen
+        return self._run_start
+
+
+class FenTimeline:
+    """
+    The fens detected in a stretch of a video, as runs of consecutive detections of the same fen. Frames without a
+      position don't break a run, just like they aren't fed to `FenStabilizer`, so the timelines of consecutive
+      stretches of a video can be joined up and then stabilized, with the same result as stabilizing every frame
+    """
+    # [fen, sec_into_video of the first detection, sec_into_video of the last detection]
+    runs: list[list]
+
+    def __init__(self):
+        self.runs = []
 
-    def _stream_cb_tile_tensors(self):
+    def add(self, sec_into_video: float, fen: str):
+        if self.runs and self.runs[-1][0] == fen:
+            self.runs[-1][2] = sec_into_video
+        else:
+            self.runs.append([fen, sec_into_video, sec_into_video])
+
+    def extend(self, other: "FenTimeline"):
+        """
+        Append the timeline of the stretch of video that comes straight after this one
         """
-        This function streams frames from the video, finds the chessboard in each frame (if there is one), and formats
-          that section of the image appropriately for processing by the neural network. The resulting tensors are
-          put on the _tile_queue rather than being returned directly
+        for fen, first_sec, last_sec in other.runs:
+            self.add(first_sec, fen)
+            self.add(last_sec, fen)
 
-          This function is expected to be run in a forked process, sending the tensors back via self._tile_queue.
-          This dramatically improves performance (compared to just running in another thread) by sidestepping the GIL
+    def sightings(self, stability_sec: float) -> list[tuple[str, float]]:
+        """
+        :return: the `(fen, sec_into_video)` sightings that `FenStabilizer` records over the timeline
         """
+        stabilizer = FenStabilizer(stability_sec)
+        sightings = []
+        for fen, first_sec, last_sec in self.runs:
+            # Whether and where a run is recorded only depends on where it starts and ends
+            for sec_into_video in (first_sec, last_sec):
+                sighting_sec = stabilizer.update(sec_into_video, fen)
+                if sighting_sec is not None:
+                    sightings.append((fen, sighting_sec))
+        return sightings
+
+
+def stream_tile_tensors(frame_source: FrameSource, stream_kwargs: dict, tile_queue: SharedRingBuffer,
+                        coarse_scale: Optional[float] = None):
+    """
+    This function streams frames from the video, finds the chessboard in each frame (if there is one), and formats
+      that section of the image appropriately for processing by the neural network. The resulting tensors are
+      put on `tile_queue` rather than being returned directly, timestamped with their `sec_into_video`, followed by
+      "done"
+
+      This function is expected to be run in another process (a fresh one, or a warm worker), sending the tensors
+      back via `tile_queue`. This dramatically improves performance (compared to just running in another thread) by
+      sidestepping the GIL
+
+    :param stream_kwargs: passed on to `frame_source.stream_frames`
+    :param coarse_scale: search for the board coarse to fine, see `findChessboardCorners`
+    """
+    with metrics.exporting("tiles"):
+        tracker = ChessboardTracker(coarse_scale=coarse_scale)
+        sec_into_video = 0.0
+        img_queue = None
+        streaming_thread = None
         try:
-            streaming_thread = thd.Thread(target=self.frame_source.stream_frames)
+            # Create the lazily initialized queue before the streaming thread can race to create its own
+            img_queue = frame_source.img_output_queue
+            streaming_thread = thd.Thread(target=frame_source.stream_frames, kwargs=stream_kwargs)
             streaming_thread.start()
 
-            img_queue = self.frame_source.img_output_queue
             while True:
-                img = img_queue.get()
+                sec_into_video, img = img_queue.get()
+                metrics.record_queue('img_output_queue', img_queue.qsize(), img_queue.slots)
                 if img is None:
                     break
                 elif issubclass(type(img), Exception):
-                    self._tile_queue.put(TileStreamingException(None, img))
+                    tile_queue.put(TileStreamingException(None, img), sec_into_video)
                     break
                 try:
-                    tiles, _ = find_grayscale_tiles_in_image(img)
-                    self._tile_queue.put(tiles)
+                    tiles, _ = find_grayscale_tiles_in_image(img, tracker)
+                    frame_source.report_board(sec_into_video, tiles is not None)
+                    tile_queue.put(tiles, sec_into_video)
                 except Exception as e:
-                    self._tile_queue.put(TileStreamingException(img, e))
+                    # img is a view of the frame buffer, so it must be copied out before its slot is released
+                    tile_queue.put(TileStreamingException(img.copy(), e), sec_into_video)
+                finally:
+                    img_queue.release()
         finally:
-            self._tile_queue.put("done", timeout=1)
+            if streaming_thread is not None:
+                # If this stopped part way through, the decoder may be waiting for room in the frame buffer
+                frame_source.running = False
+                while streaming_thread.is_alive():
+                    try:
+                        img_queue.get(timeout=.1)
+                        img_queue.release()
+                    except queue.Empty:
+                        pass
+            # This process created the frame buffer, so it's the one to free it. A warm worker would otherwise leak
+            # one for every video that fails
+            if img_queue is not None:
+                img_queue.close()
+            log.info(f"{frame_source.video_id}: board location cache hits: {tracker.hits}, misses: {tracker.misses} "
+                     f"({tracker.hit_rate:.1%} hit rate)")
+            tile_queue.put("done", sec_into_video, timeout=1)
 
-    def run(self, frame_processed_callback: Callable[[], None] = None):
-        tile_loading_process = mp.Process(target=self._stream_cb_tile_tensors)
-        log.info(f"Starting subprocess from {mp.current_process().pid} for {self.video_id}")
-        tile_loading_process.start()
 
+class VideoProcessingTask:
+    frame_source: FrameSource
+    _frame_processed_callback: Callable[[], None]
+    running: bool
+    batch_size: int
+    batch_max_wait: float
+    stability_sec: float
+    sighting_writer: Optional[PositionSightingWriter]
+    reuse_tile_predictions: bool
+    segment: Optional[tuple[int, int]]
+    warmup_frames: int
+    worker_pool: Optional[WarmWorkerPool]
+    coarse_scale: Optional[float]
+    timeline: FenTimeline
+    _tile_queue: Optional[SharedRingBuffer]
+
+    def __init__(self, frame_source: FrameSource, batch_size: int = 8, batch_max_wait: float = 0.05,
+                 stability_sec: float = 0.3, sighting_writer: Optional[PositionSightingWriter] = None,
+                 reuse_tile_predictions: bool = True, segment: Optional[tuple[int, int]] = None,
+                 warmup_frames: int = 0, worker_pool: Optional[WarmWorkerPool] = None,
+                 coarse_scale: Optional[float] = None):
+        """
+        :param frame_source: the video to process
+        :param batch_size: max number of frames to run through the neural network in a single batch
+        :param batch_max_wait: max number of seconds to wait for a batch to fill up before running inference on
+          whatever has been received so far
+        :param stability_sec: number of seconds a position must stay on screen before it's recorded
+        :param sighting_writer: where to write the position sightings. If not given, the task creates its own writer
+          and closes it when the video is done
+        :param reuse_tile_predictions: only run the squares that changed since the previous frame through the network
+        :param segment: only process the frames from the first up to (but not including) the second frame number, and
+          collect the fens detected into `timeline` rather than recording sightings
+        :param warmup_frames: number of frames before the segment to process but not collect, so that the board
+          tracker and tile prediction cache are in the same state at the start of the segment as if the whole video
+          was being processed
+        :param worker_pool: where to get a warm worker to stream the tiles in. If not given, a process is started just
+          for this video
+        :param coarse_scale: search for the board coarse to fine, see `findChessboardCorners`
+        """
+        self.frame_source = frame_source
+        self.running = True
+        self.batch_size = batch_size
+        self.batch_max_wait = batch_max_wait
+        self.stability_sec = stability_sec
+        self.sighting_writer = sighting_writer
+        self.reuse_tile_predictions = reuse_tile_predictions
+        self.segment = segment
+        self.warmup_frames = warmup_frames
+        self.worker_pool = worker_pool
+        self.coarse_scale = coarse_scale
+        self.timeline = FenTimeline()
+        # Only allocated while the task runs, a warm worker comes with its own
+        self._tile_queue = None
+
+    @property
+    def video_id(self):
+        return self.frame_source.video_id
+
+    def _stream_kwargs(self) -> dict:
+        if self.segment is None:
+            return {}
+        return {"start_frame": max(0, self.segment[0] - self.warmup_frames), "stop_after_frames": self.segment[1]}
+
+    def _next_batch(self) -> tuple[list, bool]:
+        """
+        Pull items off of the _tile_queue until `batch_size` tile tensors have been received, `batch_max_wait` seconds
+          have passed since the first item arrived, or the video is over. Frames without tiles (no board, or an
+          exception) are included in the batch so that the frame order is preserved
+
+        :return: the `(sec_into_video, tiles)` items received (in order), and whether the end of the video was reached.
+          The tiles are views of the _tile_queue, which stay valid until the items are released
+        """
+        batch = []
+        n_tiles = 0
+        deadline = None
+        while self.running and n_tiles < self.batch_size:
+            try:
+                if deadline is None:
+                    sec_into_video, tiles = self._tile_queue.get()
+                    deadline = time.monotonic() + self.batch_max_wait
+                else:
+                    sec_into_video, tiles = self._tile_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            metrics.record_queue('tile_queue', self._tile_queue.qsize(), self._tile_queue.slots)
+            if type(tiles) == str and tiles == 'done':
+                # video is over
+                self._tile_queue.release()
+                return batch, True
+            batch.append((sec_into_video, tiles))
+            if isinstance(tiles, np.ndarray):
+                n_tiles += 1
+        return batch, False
+
+    def run(self, frame_processed_callback: Callable[[], None] = None):
+        tile_loading_process = None
+        worker = None
+        sighting_writer = None
+        tile_cache = TilePredictionCache() if self.reuse_tile_predictions else None
+        # Whether every item the tiles were streamed as was received and released
+        read_to_end = False
         try:
-            prev_fen = None
-            fen_history = [None] * 10
-            frame_num = 0
+            if self.worker_pool is None:
+                # Allocated here rather than up front, so that the shared memory is freed however the task ends
+                self._tile_queue = SharedRingBuffer(_TILE_SLOTS, _TILE_BYTES)
+                # Only what the process needs is sent to it, not the task, whose sighting writer can't be pickled
+                tile_loading_process = mp.Process(target=stream_tile_tensors,
+                                                  args=(self.frame_source, self._stream_kwargs(), self._tile_queue,
+                                                        self.coarse_scale))
+                log.info(f"Starting subprocess from {mp.current_process().pid} for {self.video_id}")
+                tile_loading_process.start()
+            else:
+                worker = self.worker_pool.acquire(_TILE_SLOTS, _TILE_BYTES)
+                log.info(f"Streaming {self.video_id} in warm worker {worker.pid}")
+                self._tile_queue = worker.output_queue
+                worker.submit(partial(stream_tile_tensors, self.frame_source, self._stream_kwargs(),
+                                      coarse_scale=self.coarse_scale))
 
-            while self.running:
-                tiles = self._tile_queue.get()
-                if type(tiles) == str and tiles == 'done':
-                    # video is over
-                    break
-                frame_num += 1
-                sec_into_video = (frame_num - 10) / self.frame_source.fps
+            if self.segment is None:
+                sighting_writer = self.sighting_writer or PositionSightingWriter()
+            segment_start_sec = self.segment[0] / self.frame_source.fps if self.segment is not None else 0.0
+            stabilizer = FenStabilizer(self.stability_sec)
+            frame_num = 0
 
-                if frame_processed_callback is not None:
-                    frame_processed_callback()
+            video_over = False
+            while self.running and not video_over:
+                batch, video_over = self._next_batch()
+                fens = iter(process_tiles_batch([tiles for _, tiles in batch if isinstance(tiles, np.ndarray)],
+                                                tile_cache))
 
-                if tiles is None:
-                    log.debug(f"{self.video_id}: No position for frame {frame_num} ({sec_into_video:0.3f}s), skipping")
-                    continue
-                elif issubclass(type(tiles), Exception):
-                    try:
-                        raise tiles
-                    except TileStreamingException as e:
-                        handle_failed_video(e.img, frame_num, sec_into_video, self.video_id)
-                    except Exception as e:
-                        handle_failed_video(None, frame_num, sec_into_video, self.video_id)
-                    continue
+                for sec_into_video, tiles in batch:
+                    frame_num += 1
 
-                fen = process_tiles(tiles)
-                fen_history = fen_history[1:] + [fen]
+                    if frame_processed_callback is not None:
+                        frame_processed_callback()
 
-                log.debug(f"{self.video_id}: Fen detected on frame {frame_num} ({sec_into_video:0.3f}s): {fen}")
+                    if tiles is None:
+                        log.debug(f"{self.video_id}: No position for frame {frame_num} ({sec_into_video:0.3f}s), "
+                                  f"skipping")
+                        continue
+                    elif issubclass(type(tiles), Exception):
+                        try:
+                            raise tiles
+                        except TileStreamingException as e:
+                            handle_failed_video(e.img, frame_num, sec_into_video, self.video_id)
+                        except Exception as e:
+                            handle_failed_video(None, frame_num, sec_into_video, self.video_id)
+                        continue
 
-                # If the position hasn't changed, don't record a new position
-                if fen == prev_fen:
-                    continue
+                    fen = next(fens)
+                    log.debug(f"{self.video_id}: Fen detected on frame {frame_num} ({sec_into_video:0.3f}s): {fen}")
 
-                # If this position hasn't been on screen long enough, don't do anything
-                if len(set(fen_history)) > 1:
-                    log.debug(f"{self.video_id}: Skipping {frame_num} because fen hasn't been around long enough yet")
-                    continue
+                    if self.segment is not None:
+                        if sec_into_video >= segment_start_sec:
+                            self.timeline.add(sec_into_video, fen)
+                        continue
+                    sighting_sec = stabilizer.update(sec_into_video, fen)
+                    if sighting_sec is not None:
+                        sighting_writer.add(self.video_id, fen, sighting_sec)
 
-                prev_fen = fen
-                save_position_sighting(self.frame_source.video_id, fen, sec_into_video)
+                self._tile_queue.release(len(batch))
+            read_to_end = video_over
         finally:
-            if tile_loading_process.is_alive():
-                log.info(f"Terminating child process for vid: {self.video_id}")
-                tile_loading_process.terminate()
+            if tile_cache is not None:
+                log.info(f"{self.video_id}: reused {tile_cache.reused} tile predictions, "
+                         f"inferred {tile_cache.inferred} ({tile_cache.reuse_rate:.1%} reuse rate)")
+            if worker is not None:
+                self._release_worker(worker, read_to_end)
+            elif self._tile_queue is not None:
+                # The process may never have started, if starting it is what failed
+                if tile_loading_process is not None and tile_loading_process.pid is not None:
+                    if self.running:
+                        # Give the child process a chance to clean up its frame buffer before resorting to
+                        # terminating it
+                        tile_loading_process.join(timeout=1)
+                    if tile_loading_process.is_alive():
+                        log.info(f"Terminating child process for vid: {self.video_id}")
+                        tile_loading_process.terminate()
+                self._tile_queue.close()
+                self._tile_queue = None
+            if sighting_writer is not None:
+                if self.sighting_writer is None:
+                    sighting_writer.close()
+                else:
+                    sighting_writer.flush()
+
+    def _release_worker(self, worker: WarmWorker, read_to_end: bool):
+        # The worker's queue can only be used for another video if this one was read to the end
+        if read_to_end and worker.wait(timeout=1):
+            self.worker_pool.release(worker)
+        else:
+            log.info(f"Terminating warm worker {worker.pid} for vid: {self.video_id}")
+            worker.terminate()
+        self._tile_queue = None
 
     def stop(self):
         if not self.running:
             return
         self.running = False
         self.frame_source.running = False
+
+
+class SegmentedVideoProcessingTask:
+    """
+    Processes a long video as several segments at once, each one a `VideoProcessingTask` with its own decoding and
+      board locating process, so that one long video doesn't hold up everything else. The fens detected in the
+      segments are joined into one timeline before the stability rule is applied, so the sightings are the same as
+      processing the video from start to finish. They're only written once every segment is done
+    """
+    frame_source: FrameSource
+    running: bool
+    segment_sec: float
+    workers: int
+    warmup_sec: float
+    stability_sec: float
+    sighting_writer: Optional[PositionSightingWriter]
+    _tasks: list[VideoProcessingTask]
+
+    def __init__(self, frame_source: FrameSource, segment_sec: float = 600.0, workers: int = 4,
+                 warmup_sec: float = 2.0, batch_size: int = 8, batch_max_wait: float = 0.05, stability_sec: float = 0.3,
+                 sighting_writer: Optional[PositionSightingWriter] = None, reuse_tile_predictions: bool = True,
+                 worker_pool: Optional[WarmWorkerPool] = None, coarse_scale: Optional[float] = None):
+        """
+        :param frame_source: the video to process. Each segment streams from its own copy of it
+        :param segment_sec: (approximate) length of each segment
+        :param workers: max number of segments processed at once
+        :param warmup_sec: how far before its start each segment starts decoding, see `VideoProcessingTask`
+        :param sighting_writer: where to write the position sightings. If not given, the task creates its own writer
+          and closes it when the video is done
+
+        The other parameters are as in `VideoProcessingTask`
+        """
+        self.frame_source = frame_source
+        self.running = True
+        self.segment_sec = segment_sec
+        self.workers = workers
+        self.warmup_sec = warmup_sec
+        self.stability_sec = stability_sec
+        self.sighting_writer = sighting_writer
+        self._task_kwargs = dict(batch_size=batch_size, batch_max_wait=batch_max_wait, stability_sec=stability_sec,
+                                 reuse_tile_predictions=reuse_tile_predictions, worker_pool=worker_pool,
+                                 coarse_scale=coarse_scale)
+        self._tasks = []
+
+    @property
+    def video_id(self):
+        return self.frame_source.video_id
+
+    def segments(self) -> list[tuple[int, int]]:
+        """
+        :return: the (first frame, end frame) of each segment. The end frame of the last one is past the end of the
+          video, in case its length is only approximate
+        """
+        fps = self.frame_source.fps
+        n_segments = max(1, round(self.frame_source.duration_sec / self.segment_sec))
+        segment_frames = int(self.frame_source.duration_sec * fps / n_segments)
+        starts = [i * segment_frames for i in range(n_segments)]
+        ends = starts[1:] + [int((self.frame_source.duration_sec + self.segment_sec) * fps)]
+        return list(zip(starts, ends))
+
+    def _segment_source(self) -> FrameSource:
+        frame_source = copy.copy(self.frame_source)
+        # The board detector keeps track of the board, so it can't be shared between segments streamed at once
+        frame_source.seek_ahead = copy.deepcopy(frame_source.seek_ahead)
+        return frame_source
+
+    def run(self, frame_processed_callback: Callable[[], None] = None):
+        warmup_frames = round(self.warmup_sec * self.frame_source.fps)
+        self._tasks = [VideoProcessingTask(self._segment_source(), segment=segment, warmup_frames=warmup_frames,
+                                           **self._task_kwargs)
+                       for segment in self.segments()]
+        log.info(f"Processing {self.video_id} as {len(self._tasks)} segments")
+
+        def run_segment(task: VideoProcessingTask):
+            if self.running:
+                task.run(frame_processed_callback)
+
+        with ThreadPool(min(self.workers, len(self._tasks))) as pool:
+            pool.map(run_segment, self._tasks)
+        if not self.running:
+            return
+
+        timeline = FenTimeline()
+        for task in self._tasks:
+            timeline.extend(task.timeline)
+        sighting_writer = self.sighting_writer or PositionSightingWriter()
+        try:
+            for fen, sighting_sec in timeline.sightings(self.stability_sec):
+                sighting_writer.add(self.video_id, fen, sighting_sec)
+        finally:
+            if self.sighting_writer is None:
+                sighting_writer.close()
+            else:
+                sighting_writer.flush()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        for task in self._tasks:
+            task.stop()
@@ -0,0 +1,148 @@
+import logging
+import multiprocessing as mp
+import threading as thd
+from typing import Callable, Optional
+
+from video_processing.shared_ring_buffer import SharedRingBuffer
+
+log = logging.getLogger(__name__)
+
+
+def _serve(conn, output_queue: SharedRingBuffer):
+    """
+    The loop a warm worker runs: call each function it's sent with the worker's output queue, and report back once it
+      has returned, until it's sent None or its parent goes away
+    """
+    while True:
+        try:
+            target = conn.recv()
+        except EOFError:
+            return
+        if target is None:
+            return
+        try:
+            target(output_queue)
+        except Exception:
+            log.exception("Warm worker job failed")
+        # Let go of everything the job brought with it before waiting for the next one
+        del target
+        conn.send(True)
+
+
+class WarmWorker:
+    """
+    A process that lives across many jobs, with its own ring buffer to send the results of each one back through. A
+      ring buffer can only be handed to a process as it starts, so the buffer belongs to the worker rather than the
+      job, and the functions sent to the worker are called with it
+    """
+    output_queue: SharedRingBuffer
+
+    def __init__(self, slots: int, slot_bytes: int):
+        self.output_queue = SharedRingBuffer(slots, slot_bytes)
+        self._conn, child_conn = mp.Pipe()
+        self._process = mp.Process(target=_serve, args=(child_conn, self.output_queue), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._busy = False
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid
+
+    def submit(self, target: Callable[[SharedRingBuffer], None]):
+        """
+        Start a job. `target` is pickled to the worker (so it can't hold anything that may only be passed to a process
+          as it starts, like a `SharedRingBuffer`), where it's called with `output_queue`
+        """
+        self._busy = True
+        self._conn.send(target)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        :return: whether the last job is done, waiting up to `timeout` seconds for it
+        """
+        if self._busy and self._conn.poll(timeout):
+            try:
+                self._conn.recv()
+            except EOFError:
+                # The worker died, which `alive` tells whoever asks next
+                pass
+            self._busy = False
+        return not self._busy
+
+    def alive(self) -> bool:
+        return self._process.is_alive()
+
+    def terminate(self):
+        """
+        Kill the worker (eg. if its job is stuck) and free its ring buffer
+        """
+        self._process.terminate()
+        self._process.join()
+        self._conn.close()
+        self.output_queue.close()
+
+    def close(self):
+        """
+        Stop the worker once it's done with its last job, and free its ring buffer
+        """
+        try:
+            self._conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._conn.close()
+        self.output_queue.close()
+
+
+class WarmWorkerPool:
+    """
+    Warm workers to run jobs in, so that processing a video doesn't pay for starting a process and importing
+      everything the job needs in it every time. Workers are started as they're needed, and kept for reuse (up to
+      `max_idle` of them) when they're given back. Thread safe
+    """
+    max_idle: int
+    # Number of workers started so far, which is only more than the number of workers needed at once when they
+    # couldn't be reused
+    started: int
+
+    def __init__(self, max_idle: int = 8):
+        self.max_idle = max_idle
+        self.started = 0
+        self._idle: list[WarmWorker] = []
+        self._lock = thd.Lock()
+
+    def acquire(self, slots: int, slot_bytes: int) -> WarmWorker:
+        """
+        :return: an idle worker whose ring buffer has `slots` slots of `slot_bytes`, or a new one if there isn't one
+        """
+        with self._lock:
+            for worker in self._idle:
+                if worker.output_queue.slots == slots and worker.output_queue.slot_bytes == slot_bytes:
+                    self._idle.remove(worker)
+                    if worker.alive():
+                        return worker
+                    worker.terminate()
+                    break
+            self.started += 1
+        return WarmWorker(slots, slot_bytes)
+
+    def release(self, worker: WarmWorker):
+        """
+        Give back a worker that's done with its job, and whose ring buffer has been read to the end. Workers that
+          can't be reused should be terminated instead
+        """
+        with self._lock:
+            if len(self._idle) < self.max_idle and worker.alive():
+                self._idle.append(worker)
+                return
+        worker.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()